@@ -1,6 +1,8 @@
-import os, json, subprocess, re, time, random
+import os, sys, io, json, glob, gzip, hashlib, shutil, subprocess, re, time, random, threading, queue, tempfile, contextlib, tarfile, fnmatch, lzma, bz2, atexit, signal, fcntl
+import http.client, ssl, urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timezone
-from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl, urlencode
 
 def env(k, d=""):
     return os.environ.get(k, d)
@@ -8,6 +10,113 @@ def env(k, d=""):
 def now_utc():
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
+# Timing spans: one record per timed stage, in the metadata "timings" section and the
+# optional trace-event file (TRACE_FILE). Starts are seconds since timing_epoch.
+timing_epoch = time.monotonic()
+timing_spans = []
+timing_lock = threading.Lock()
+timing_context = threading.local()  # .target: batch target key the current thread works on
+
+def cpu_seconds():
+    """CPU time of this process (all threads) plus its finished child processes."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+@contextlib.contextmanager
+def timed_span(name, **fields):
+    """
+    Record the wall time and CPU time of a block as a timing span.
+
+    Yields the span's field dict, so the block can add results such as "bytes".
+    CPU time is process-wide: spans that overlap (concurrent scans, batch stages)
+    each include the others' CPU.
+
+    Args:
+        name: Stage name (e.g., "download", "grype")
+        **fields: Extra span fields (ident, protocol, attempt, ...)
+    """
+    span_fields = dict(fields)
+    started, cpu_started = time.monotonic(), cpu_seconds()
+    try:
+        yield span_fields
+    except BaseException:
+        span_fields["error"] = True
+        raise
+    finally:
+        span = {
+            "name": name,
+            "start": round(started - timing_epoch, 6),
+            "seconds": round(time.monotonic() - started, 6),
+            "cpu_seconds": round(cpu_seconds() - cpu_started, 6),
+            "thread": threading.current_thread().name
+        }
+        target = getattr(timing_context, "target", None)
+        if target:
+            span["target"] = target
+        span.update(span_fields)
+        with timing_lock:
+            timing_spans.append(span)
+
+def timing_section(target=None, idents=None):
+    """
+    Build the metadata "timings" section from the spans recorded so far.
+
+    Args:
+        target: Batch target key to report (None: every span of this process)
+        idents: Habitat idents to report (None: all). Spans that name another ident
+            (ident field, or the label of a per-ident grype/syft run) are left out;
+            run-wide spans (hab CLI, grype DB, single-pass scans) are kept
+
+    Returns:
+        Dict with "spans" (in start order) and per-name "totals" (count, seconds,
+        cpu_seconds, bytes)
+    """
+    with timing_lock:
+        spans = sorted((s for s in timing_spans if (target is None or s.get("target") == target)
+                        and (idents is None or span_habitat_ident(s) in idents or span_habitat_ident(s) is None)),
+                       key=lambda s: s["start"])
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(span["name"], {"count": 0, "seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0})
+        total["count"] += 1
+        total["seconds"] = round(total["seconds"] + span["seconds"], 6)
+        total["cpu_seconds"] = round(total["cpu_seconds"] + span["cpu_seconds"], 6)
+        total["bytes"] += span.get("bytes") or 0
+    return {"spans": spans, "totals": totals}
+
+def span_habitat_ident(span):
+    """The Habitat ident (origin/name/version/release) a span was recorded for, or None."""
+    owner = span.get("ident") or span.get("label") or ""
+    return owner if len(owner.split("/")) == 4 else None
+
+def drop_timing_spans(target):
+    """Forget the spans of a finished target (a long-running worker would otherwise keep them all)."""
+    with timing_lock:
+        timing_spans[:] = [s for s in timing_spans if s.get("target") != target]
+
+def write_trace_file(path):
+    """
+    Write every recorded span as a trace-event JSON file (chrome://tracing, Perfetto).
+
+    Spans become complete ("X") events on one track per thread; the other span fields
+    are the event args.
+    """
+    with timing_lock:
+        spans = list(timing_spans)
+    threads = {}
+    events = []
+    for span in spans:
+        tid = threads.setdefault(span["thread"], len(threads) + 1)
+        args = {k: v for k, v in span.items() if k not in ("name", "start", "seconds", "thread")}
+        events.append({"name": span["name"], "cat": span["name"].split(".")[0], "ph": "X", "pid": 1, "tid": tid,
+                       "ts": round(span["start"] * 1e6), "dur": round(span["seconds"] * 1e6), "args": args})
+    for thread_name, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread_name}})
+    ensure_dir(os.path.dirname(path) or ".")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"Wrote {len(spans)} timing spans to {path}")
+
 def run(cmd, check=True, retry_config=None):
     """
     Execute command with optional retry logic.
@@ -93,20 +202,288 @@ def is_retryable_error(stderr, stdout):
         if code in error_text:
             return True
     
-    # Check for HTTP server errors (5xx)
-    if any(code in error_text for code in ["500", "502", "503", "504"]):
-        return True
-    
-    # Non-retryable conditions
-    if any(code in error_text for code in ["401", "403", "404", "400"]):
-        return False
+    # HTTP status reported by curl -f ("The requested URL returned error: 503")
+    status = http_status_from_curl(error_text)
+    if status is not None:
+        return is_retryable_status(status)
     
     # Default: don't retry unless explicitly identified as retryable
     return False
 
-def http_json(url):
-    rc, out, err = run(["bash", "-lc", f"curl -fsSL '{url}'"], check=True)
-    return json.loads(out)
+def http_status_from_curl(text):
+    """Extract the HTTP status code from curl -f error output, or None if there is none."""
+    m = re.search(r"returned error:\s*(\d{3})", text or "")
+    return int(m.group(1)) if m else None
+
+def is_retryable_status(status):
+    """
+    Determine if an HTTP status is worth retrying.
+
+    Server errors (500, 502, 503, 504) are retryable; everything else, including
+    client errors (400, 401, 403, 404), is not.
+    """
+    return status in (500, 502, 503, 504)
+
+class HttpError(RuntimeError):
+    """
+    HTTP request failure raised by http_request().
+
+    status is the HTTP status code, or None when no response was received
+    (connection refused or reset, timeout, too many redirects).
+    """
+    def __init__(self, method, url, status, message, body=""):
+        self.url = url
+        self.status = status
+        self.body = body
+        detail = f"\n{body.strip()[:500]}" if body.strip() else ""
+        super().__init__(f"HTTP {status if status is not None else 'error'}: {method} {redact_url(url)}: {message}{detail}")
+
+def redact_url(url):
+    """Replace license_id (and other credential-like) query values with ***."""
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    q = [(k, "***" if "license" in k.lower() or "token" in k.lower() else v) for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(q, doseq=True, safe="*"), parts.fragment))
+
+HTTP_TIMEOUT = 60
+HTTP_USER_AGENT = "chef-download-grype-snapshot"
+HTTP_REDIRECTS = (301, 302, 303, 307, 308)
+
+# Keep-alive connections, one per (scheme, host, port) and thread: http.client
+# connections must not be shared between the threads of a ThreadPoolExecutor
+http_local = threading.local()
+
+def http_connection(scheme, host, port, fresh=False):
+    """
+    Return the calling thread's pooled connection to scheme://host:port.
+
+    HTTPS connections honour https_proxy / no_proxy (CONNECT tunnel), like curl.
+
+    Args:
+        fresh: Drop any pooled connection and open a new one
+    """
+    pool = getattr(http_local, "connections", None)
+    if pool is None:
+        pool = http_local.connections = {}
+    key = (scheme, host, port)
+    if fresh and key in pool:
+        pool.pop(key).close()
+    if key not in pool:
+        if scheme == "https":
+            proxy = urllib.request.getproxies().get("https")
+            if proxy and not urllib.request.proxy_bypass(host):
+                proxy_parts = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+                conn = http.client.HTTPSConnection(proxy_parts.hostname, proxy_parts.port or 8080,
+                                                   timeout=HTTP_TIMEOUT, context=ssl.create_default_context())
+                conn.set_tunnel(host, port or 443)
+            else:
+                conn = http.client.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT, context=ssl.create_default_context())
+        elif scheme == "http":
+            conn = http.client.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+        else:
+            raise HttpError("GET", f"{scheme}://{host}", None, f"unsupported URL scheme '{scheme}'")
+        pool[key] = conn
+    return pool[key]
+
+def http_request_once(url, method="GET", headers=None, max_redirects=5, sink=None):
+    """
+    Single attempt of http_request() (redirects included, no retries).
+
+    Args:
+        sink: Optional callable sink(status, headers) for 2xx responses, returning a
+              write(chunk) callable the body is streamed to instead of being returned
+              (body is then b""); exceptions it raises abort the request
+    """
+    headers = dict(headers or {})
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        request_headers = {"User-Agent": HTTP_USER_AGENT, "Accept": "*/*", **headers}
+        # A pooled connection may have been closed by the server while idle: re-send once on a new one
+        for fresh in (False, True):
+            conn = http_connection(parts.scheme, parts.hostname, parts.port, fresh=fresh)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, headers=request_headers)
+                resp = conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if fresh or not reused:
+                    raise HttpError(method, url, None, f"{type(e).__name__}: {e}")
+        try:
+            if sink is not None and 200 <= resp.status < 300:
+                write = sink(resp.status, resp.headers)
+                while True:
+                    chunk = resp.read(1 << 16)
+                    if not chunk:
+                        break
+                    write(chunk)
+                body = b""
+            else:
+                body = resp.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise HttpError(method, url, None, f"{type(e).__name__}: {e}")
+        except Exception:
+            conn.close()  # Body left unread: the connection cannot be reused
+            raise
+
+        location = resp.getheader("Location")
+        if resp.status in HTTP_REDIRECTS and location:
+            next_url = urljoin(url, location)
+            if urlsplit(next_url).netloc != parts.netloc:
+                # Like curl -L: credentials are not forwarded to another host
+                headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+            if resp.status == 303:
+                method = "GET"
+            url = next_url
+            continue
+        if resp.status >= 400:
+            raise HttpError(method, url, resp.status, resp.reason, body.decode("utf-8", "replace"))
+        return resp.status, resp.headers, body
+    raise HttpError(method, url, None, f"more than {max_redirects} redirects")
+
+def http_request(url, method="GET", headers=None, retry_config=None, max_redirects=5):
+    """
+    Perform an HTTP request over a pooled keep-alive connection, following redirects.
+
+    Args:
+        url: http(s) URL
+        method: HTTP method
+        headers: Extra request headers
+        retry_config: Same settings and backoff as run() (if None, no retry); only connection
+                      failures and retryable statuses (see is_retryable_status()) are retried
+        max_redirects: Redirect limit
+
+    Returns:
+        (status, headers, body) tuple; body is bytes
+
+    Raises:
+        HttpError: With .status set to the final HTTP status (None if no response was received)
+    """
+    if retry_config is None:
+        return http_request_once(url, method, headers, max_redirects)
+
+    max_retries = retry_config.get("max_retries", 5)
+    base_delay = retry_config.get("base_delay", 2)
+    max_delay = retry_config.get("max_delay", 30)
+    for attempt in range(max_retries):
+        try:
+            return http_request_once(url, method, headers, max_redirects)
+        except HttpError as e:
+            if e.status is not None and not is_retryable_status(e.status):
+                raise
+            if attempt == max_retries - 1:
+                raise HttpError(method, url, e.status, f"failed after {max_retries} attempts: {e}") from e
+            jitter = random.uniform(0, 1)
+            sleep_time = min((base_delay * (2 ** attempt)) + jitter, max_delay)
+            print(f"⚠️  Retryable error on attempt {attempt + 1}/{max_retries}")
+            print(f"   Error: {str(e)[:200]}")
+            print(f"   Retrying in {sleep_time:.1f}s...")
+            time.sleep(sleep_time)
+
+def http_json(url, headers=None, retry_config=None):
+    """GET url and parse the JSON response (see http_request())."""
+    status, resp_headers, body = http_request(url, headers=headers, retry_config=retry_config)
+    return json.loads(body)
+
+# Version-API responses (/versions/latest, /versions/all) shared by every target of a
+# run: memoized per URL in-process, and kept on disk in version_cache_dir (set from
+# VERSION_CACHE_DIR) for version_cache_ttl seconds, then revalidated with the ETag.
+version_cache_dir = ""
+version_cache_ttl = 300
+version_response_memo = {}
+version_memo_locks = {}
+version_memo_lock = threading.Lock()
+version_cache_stats = {"memo": 0, "fresh": 0, "revalidated": 0, "fetched": 0}
+
+def version_cache_path(url):
+    """On-disk cache file for a version-API URL (hashed: the URL may carry a license_id)."""
+    return os.path.join(version_cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+def fetch_version_json(url):
+    """
+    GET a version-API document through the on-disk cache (see cached_version_json()).
+
+    Returns:
+        (document, outcome) where outcome is "fresh", "revalidated" or "fetched"
+    """
+    cache_path = version_cache_path(url) if version_cache_dir else None
+    entry = None
+    if cache_path:
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+    if entry and time.time() - entry.get("fetched", 0) < version_cache_ttl:
+        return entry["body"], "fresh"
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    status, resp_headers, body = http_request(url, headers=headers)
+    if status == 304 and entry:
+        doc, outcome = entry["body"], "revalidated"
+    else:
+        doc, outcome = json.loads(body), "fetched"
+        entry = {"url": redact_url(url), "etag": resp_headers.get("ETag"), "last_modified": resp_headers.get("Last-Modified"), "body": doc}
+
+    if cache_path:
+        entry["fetched"] = time.time()
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Warning: Unable to write version cache entry: {e}")
+    return doc, outcome
+
+def cached_version_json(url):
+    """
+    GET a version-API JSON document once per run.
+
+    Repeated URLs are answered from memory (concurrent callers wait for the first fetch).
+    With version_cache_dir set, a response younger than version_cache_ttl is used without
+    a request, and an older one is revalidated with If-None-Match/If-Modified-Since.
+    Errors are not cached.
+
+    Raises:
+        HttpError: As http_json()
+    """
+    with version_memo_lock:
+        url_lock = version_memo_locks.setdefault(url, threading.Lock())
+    with url_lock:
+        if url in version_response_memo:
+            outcome = "memo"
+            doc = version_response_memo[url]
+        else:
+            doc, outcome = fetch_version_json(url)
+            version_response_memo[url] = doc
+    with version_memo_lock:
+        version_cache_stats[outcome] += 1
+    return doc
+
+def version_cache_summary():
+    """One-line summary of how version-API lookups were answered this run."""
+    return ", ".join(f"{count} {outcome}" for outcome, count in version_cache_stats.items())
+
+def reset_version_memo():
+    """
+    Forget the version-API responses memoised by cached_version_json().
+
+    For long-running processes (run.py worker), so each job sees current versions; the
+    on-disk cache (version_cache_dir) and pooled connections are kept.
+    """
+    with version_memo_lock:
+        version_response_memo.clear()
+        version_memo_locks.clear()
+    stable_version_indexes.clear()
 
 def parse_version(version_str):
     """
@@ -155,6 +532,28 @@ def get_major_version(version_str):
     parsed = parse_version(version_str)
     return parsed[0] if parsed else None
 
+stable_version_indexes = {}
+
+def major_version_index(all_stable_versions):
+    """
+    Group a version list by major version, each group sorted ascending by (major, minor, patch).
+
+    Parsed once per distinct list; later lookups for any major reuse the index. Versions
+    that compare equal keep their list order (the last one wins, as before).
+    """
+    key = tuple(all_stable_versions)
+    index = stable_version_indexes.get(key)
+    if index is None:
+        index = {}
+        for ver_str in all_stable_versions:
+            parsed = parse_version(ver_str)
+            if parsed:
+                index.setdefault(parsed[0], []).append((parsed, ver_str))
+        for matching_versions in index.values():
+            matching_versions.sort(key=lambda x: x[0])
+        stable_version_indexes[key] = index
+    return index
+
 def find_best_stable_version_for_major(all_stable_versions, target_major):
     """
     Find the highest stable version matching a specific major version.
@@ -166,20 +565,11 @@ def find_best_stable_version_for_major(all_stable_versions, target_major):
     Returns:
         Highest matching version string, or None if no match found
     """
-    matching_versions = []
-    
-    for ver_str in all_stable_versions:
-        parsed = parse_version(ver_str)
-        if parsed and parsed[0] == target_major:
-            matching_versions.append((parsed, ver_str))
-    
+    matching_versions = major_version_index(all_stable_versions).get(target_major)
     if not matching_versions:
         return None
     
-    # Sort by (major, minor, patch) tuple - highest last
-    matching_versions.sort(key=lambda x: x[0])
-    
-    # Return the version string of the highest match
+    # Sorted by (major, minor, patch) tuple - highest last
     return matching_versions[-1][1]
 
 def ensure_dir(path):
@@ -189,12 +579,178 @@ def write_text(path, content):
     with open(path, "w", encoding="utf-8") as f:
         f.write(content)
 
-def get_directory_size(path):
+def write_resolved_versions(out_dir, versions):
+    """
+    Write the resolved_version / resolved_versions action outputs to out_dir.
+
+    _resolved_version.txt holds the version when exactly one was resolved (empty when a
+    multi-package habitat run resolved several); _resolved_versions.json lists them all.
+    """
+    write_text(os.path.join(out_dir, "_resolved_version.txt"), versions[0] if len(versions) == 1 else "")
+    write_text(os.path.join(out_dir, "_resolved_versions.json"), json.dumps(versions))
+
+# On-disk format of published JSON artifacts (grype.latest.json, {release}.json,
+# *metadata.json, index.json); set from OUTPUT_FORMAT. File names never change:
+# readers sniff the format from the first bytes (see read_json()).
+JSON_OUTPUT_FORMATS = ("pretty", "compact", "gzip", "zstd")
+json_output_format = "pretty"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def zstd_module():
+    """Import the optional zstandard package (only needed for OUTPUT_FORMAT=zstd, reading zstd files, or zstd .deb members)."""
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd support needs the 'zstandard' Python package (pip install zstandard)")
+    return zstandard
+
+def zstd_available():
+    """True if the optional zstandard package can be imported."""
+    try:
+        zstd_module()
+    except RuntimeError:
+        return False
+    return True
+
+def json_file_format(path):
+    """
+    Detect the format of a JSON artifact written by write_json().
+
+    Returns:
+        "gzip" or "zstd" by magic bytes, "pretty" for indented JSON, otherwise "compact"
+    """
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return "pretty" if head[1:2] == b"\n" else "compact"
+
+@contextlib.contextmanager
+def open_json_output(path, fmt=None):
+    """
+    Open path for writing JSON text in the given output format (default: json_output_format).
+
+    gzip output has a zeroed mtime so unchanged content keeps identical bytes in the data repo.
+    """
+    fmt = fmt or json_output_format
+    if fmt == "gzip":
+        with open(path, "wb") as raw, gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8") as out:
+            yield out
+    elif fmt == "zstd":
+        with open(path, "wb") as raw, zstd_module().ZstdCompressor().stream_writer(raw, closefd=False) as zw, \
+                io.TextIOWrapper(zw, encoding="utf-8") as out:
+            yield out
+    else:
+        with open(path, "w", encoding="utf-8") as out:
+            yield out
+
+def write_json(obj, path, fmt=None):
+    """Write obj to path in the given output format (default: json_output_format)."""
+    fmt = fmt or json_output_format
+    with open_json_output(path, fmt) as f:
+        if fmt == "pretty":
+            json.dump(obj, f, indent=2)
+        else:
+            json.dump(obj, f, separators=(",", ":"))
+
+def read_json(path):
+    """Load a JSON artifact in any of JSON_OUTPUT_FORMATS."""
+    fmt = json_file_format(path)
+    if fmt == "gzip":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    if fmt == "zstd":
+        with open(path, "rb") as raw, zstd_module().ZstdDecompressor().stream_reader(raw) as zr, \
+                io.TextIOWrapper(zr, encoding="utf-8") as f:
+            return json.load(f)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def copy_json(src, dst, fmt=None):
+    """Copy a JSON artifact, re-encoding it only if src is not already in the requested format."""
+    fmt = fmt or json_output_format
+    if json_file_format(src) == fmt:
+        shutil.copyfile(src, dst)
+    else:
+        write_json(read_json(src), dst, fmt)
+
+def scan_dir_sizes(path):
+    """
+    Sum the non-directory entries of a single directory.
+
+    Matches os.walk(path) semantics: symlinks are lstat'ed and counted as files,
+    except symlinks to directories, which (like os.walk without followlinks) are
+    neither counted nor descended into. Unreadable directories count as empty.
+
+    Returns:
+        (bytes, file_count, subdirectories) tuple
+    """
+    total_size = 0
+    file_count = 0
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    try:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    # Use lstat to not follow symlinks (avoid double-counting)
+                    total_size += entry.stat(follow_symlinks=False).st_size
+                    file_count += 1
+                except OSError:
+                    # Skip files we can't stat (permissions, removed during walk, etc.)
+                    pass
+    except OSError:
+        pass
+    return total_size, file_count, subdirs
+
+def walk_dir_sizes(path):
+    """
+    Total size and file count of a tree, walked serially with scan_dir_sizes().
+
+    No thread pool: for small trees and for walking many trees one after another
+    (cache entries), where get_directory_size() would start a pool per tree.
+
+    Returns:
+        (bytes, file_count) tuple
+    """
+    total_size = 0
+    file_count = 0
+    pending = [path]
+    while pending:
+        dir_bytes, dir_files, subdirs = scan_dir_sizes(pending.pop())
+        total_size += dir_bytes
+        file_count += dir_files
+        pending.extend(subdirs)
+    return total_size, file_count
+
+def get_directory_size(path, workers=1):
     """
     Calculate the total size of all files in a directory (recursively).
     
+    Directories are listed with os.scandir; totals are identical to an os.walk +
+    os.lstat pass. The serial walk (the default) is the fastest on a warm page cache
+    (see bench/). workers > 1 lists directories concurrently, which can only pay off
+    when stat calls wait on I/O: pass it from the measured SIZE_WALK_WORKERS setting,
+    never from a thread that is already a scan-pool worker.
+    
     Args:
         path: Directory path to calculate size for
+        workers: Maximum concurrent directory listings (1: serial walk, no pool)
         
     Returns:
         Dictionary with size information:
@@ -206,17 +762,19 @@ def get_directory_size(path):
     file_count = 0
     
     try:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                try:
-                    # Use lstat to not follow symlinks (avoid double-counting)
-                    total_size += os.lstat(filepath).st_size
-                    file_count += 1
-                except (OSError, FileNotFoundError):
-                    # Skip files we can't stat (permissions, removed during walk, etc.)
-                    pass
-        
+        if workers <= 1:
+            total_size, file_count = walk_dir_sizes(path)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = {pool.submit(scan_dir_sizes, path)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dir_bytes, dir_files, subdirs = future.result()
+                        total_size += dir_bytes
+                        file_count += dir_files
+                        pending.update(pool.submit(scan_dir_sizes, d) for d in subdirs)
+    
         # Format human-readable size
         size_bytes = total_size
         for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -224,7 +782,7 @@ def get_directory_size(path):
                 human_readable = f"{size_bytes:.2f} {unit}"
                 break
             size_bytes = size_bytes / 1024.0
-            
+        
         # Return original bytes value
         return {
             "bytes": total_size,
@@ -240,519 +798,280 @@ def get_directory_size(path):
             "error": str(e)
         }
 
-def download_with_fallback(url, output_path, timeout=300):
-    """
-    Download file with HTTP/2 fallback to HTTP/1.1 and retry logic.
-    
-    This addresses the curl (92) HTTP/2 stream errors by:
-    1. Trying HTTP/2 first with retries
-    2. Falling back to HTTP/1.1 if HTTP/2 consistently fails
-    3. Using exponential backoff with jitter
+def resolve_scan_concurrency(value=""):
     """
-    print(f"Downloading: {output_path}")
-    print(f"URL (redacted): {url.split('?')[0]}...")
-    
-    # HTTP version strategies to try in order
-    http_strategies = [
-        {
-            "name": "HTTP/2",
-            "flags": ["--http2"],
-            "retries": 3  # Try HTTP/2 3 times before falling back
-        },
-        {
-            "name": "HTTP/1.1",
-            "flags": ["--http1.1"],
-            "retries": 5  # Try HTTP/1.1 more times as fallback
-        }
-    ]
-    
-    retry_config = {
-        "max_retries": 5,
-        "base_delay": 2,
-        "max_delay": 30
-    }
-    
-    last_error = None
-    
-    for strategy in http_strategies:
-        print(f"Attempting download with {strategy['name']}...")
-        
-        for attempt in range(strategy["retries"]):
-            try:
-                cmd = [
-                    "bash", "-lc",
-                    " ".join([
-                        "curl",
-                        "-fsSL",
-                        *strategy["flags"],
-                        "--connect-timeout", "30",
-                        "--max-time", str(timeout),
-                        "--keepalive-time", "60",
-                        "--tcp-nodelay",
-                        "--compressed",
-                        "-o", f"'{output_path}'",
-                        f"'{url}'"
-                    ])
-                ]
-                
-                # Execute with retry logic
-                run(cmd, check=True, retry_config=retry_config)
-                
-                # Verify download
-                if os.path.exists(output_path):
-                    size = os.path.getsize(output_path)
-                    print(f"✓ Download successful ({size} bytes) using {strategy['name']}")
-                    return True
-                else:
-                    raise RuntimeError(f"Download completed but file not found: {output_path}")
-                
-            except RuntimeError as e:
-                last_error = e
-                error_str = str(e)
-                
-                # Check if this is a protocol error specific to current HTTP version
-                if "(92)" in error_str or "http/2" in error_str.lower():
-                    print(f"✗ {strategy['name']} protocol error, will try fallback strategy")
-                    break  # Move to next HTTP version
-                elif not is_retryable_error(error_str, ""):
-                    # Non-retryable error, fail immediately
-                    print(f"✗ Non-retryable error: {error_str[:200]}")
-                    raise
-                else:
-                    # Retryable error, continue with current strategy
-                    if attempt < strategy["retries"] - 1:
-                        jitter = random.uniform(0, 1)
-                        sleep_time = min(2 ** attempt + jitter, 30)
-                        print(f"⚠️  Attempt {attempt + 1}/{strategy['retries']} failed, retrying in {sleep_time:.1f}s...")
-                        time.sleep(sleep_time)
-                    else:
-                        print(f"✗ All {strategy['retries']} attempts with {strategy['name']} failed")
-                        break  # Try next strategy
-    
-    # All strategies exhausted
-    raise RuntimeError(
-        f"Download failed after all retry strategies:\n"
-        f"  URL: {url.split('?')[0]}\n"
-        f"  Last error: {last_error}"
-    )
+    Determine how many grype scans may run at the same time.
 
-def map_cinc_product_name(product):
+    Args:
+        value: SCAN_CONCURRENCY setting ("" or "auto" for automatic sizing)
+
+    Returns:
+        Worker count (>= 1). Automatic sizing uses the CPU count, capped by
+        available memory since every grype process loads its own copy of the
+        vulnerability DB (GRYPE_SCAN_MEMORY_MB per scan, default 1024).
     """
-    Map Chef product names to CINC product names for API endpoints.
-    CINC (Cinc Is Not Chef) uses different package names.
+    value = (value or "").strip().lower()
+    if value and value != "auto":
+        try:
+            return max(1, int(value))
+        except ValueError:
+            print(f"Warning: Invalid SCAN_CONCURRENCY '{value}', using automatic sizing")
+
+    workers = os.cpu_count() or 1
+
+    # Cap by MemAvailable (Linux only; other platforms just use CPU count)
+    try:
+        per_scan_kb = int(env("GRYPE_SCAN_MEMORY_MB", "1024")) * 1024
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available_kb = int(line.split()[1])
+                    workers = min(workers, available_kb // per_scan_kb)
+                    break
+    except (OSError, ValueError):
+        pass
+
+    return max(1, workers)
+
+ensured_tools = set()  # Tools found or installed by ensure_tool() in this process
+
+def ensure_tool(tool, version, install_script_url):
     """
-    cinc_mapping = {
-        "chef": "cinc",
-        "chef-server": "cinc-server",
-        "chef-workstation": "cinc-workstation",
-        "inspec": "cinc-auditor"
-    }
-    return cinc_mapping.get(product, product)
+    Make sure an anchore tool (grype, syft) is on PATH, installing the pinned version if needed.
 
-def check_existing_version(scan_mode, data_repo_path, product, channel, download_site, os_name, os_ver, arch, resolved_version=None, hab_ident=None):
+    Checked once per process: batch and worker runs call this for every target.
+
+    Args:
+        tool: Binary name
+        version: Version to install when missing (e.g., "0.109.0")
+        install_script_url: The tool's install.sh URL
     """
-    Check if existing scan data matches the resolved version.
-    Returns (should_skip, reason) tuple.
-    For native mode: checks metadata.json in native/ path
-    For modern mode: checks metadata.json in modern/ path
-    For habitat mode: checks index.json and extracts version from directory structure
+    if tool in ensured_tools:
+        return
+    if os.path.isfile(f"/usr/local/bin/{tool}"):
+        # Ensure executable permissions (cache may not preserve them)
+        run(["chmod", "+x", f"/usr/local/bin/{tool}"], check=False)
+        print(f"✓ {tool.title()} found in cache")
+        ensured_tools.add(tool)
+        return
+    rc, _, _ = run(["bash", "-lc", f"command -v {tool} >/dev/null 2>&1"], check=False)
+    if rc == 0:
+        print(f"✓ {tool.title()} already installed")
+        ensured_tools.add(tool)
+        return
+    # Install with retry logic for GitHub releases API
+    print(f"Installing {tool.title()} {version}...")
+    install_cmd = f"curl -sSfL {install_script_url} | sh -s -- -b /usr/local/bin v{version}"
+    run(["bash", "-lc", install_cmd], check=True, retry_config={"max_retries": 5, "base_delay": 2, "max_delay": 30})
+    ensured_tools.add(tool)
+
+def ensure_grype():
+    ensure_tool("grype", os.getenv("GRYPE_VERSION", "0.109.0"), "https://raw.githubusercontent.com/anchore/grype/main/install.sh")
+
+def ensure_syft():
+    ensure_tool("syft", os.getenv("SYFT_VERSION", "1.40.0"), "https://raw.githubusercontent.com/anchore/syft/main/install.sh")
+
+def stream_grype_report(stream, json_path, chunk_size=1 << 16, fmt=None, on_value=None):
     """
-    if not data_repo_path or not os.path.exists(data_repo_path):
-        return False, "No existing data repository found"
-    
-    try:
-        if scan_mode == "native":
-            # Native mode: check metadata.json
-            metadata_path = os.path.join(
-                data_repo_path,
-                "native",
-                product,
-                channel,
-                download_site,
-                os_name,
-                os_ver,
-                arch,
-                "metadata.json"
-            )
-            
-            if os.path.exists(metadata_path):
-                with open(metadata_path, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                existing_version = metadata.get("target", {}).get("resolved_version", "")
-                
-                print(f"Version comparison: existing='{existing_version}' vs resolved='{resolved_version}'")
-                if existing_version == resolved_version:
-                    return True, f"Version {resolved_version} already scanned (found in metadata.json)"
-                else:
-                    return False, f"Version mismatch: existing={existing_version}, resolved={resolved_version}"
-            
-            return False, "No existing metadata found"
-        
-        elif scan_mode == "habitat":
-            # Habitat mode: check for existing version directory under habitat/{product}/{channel}/{os}/{arch}/
-            # Structure: habitat/{product}/{channel}/{os}/{arch}/{origin}/{name}/{version}/index.json
-            hab_base_path = os.path.join(
-                data_repo_path,
-                "habitat",
-                product,
-                channel,
-                os_name,
-                arch
-            )
-            
-            if not os.path.exists(hab_base_path):
-                return False, "No existing habitat data found"
-            
-            # Parse hab_ident to get origin/name for path lookup
-            # Expected format: origin/name or origin/name/version/release
-            if hab_ident:
-                parts = hab_ident.split("/")
-                if len(parts) >= 2:
-                    origin, name = parts[0], parts[1]
-                    origin_name_path = os.path.join(hab_base_path, origin, name)
-                    
-                    if os.path.exists(origin_name_path):
-                        # Get list of existing version directories
-                        existing_versions = [d for d in os.listdir(origin_name_path) 
-                                           if os.path.isdir(os.path.join(origin_name_path, d))]
-                        
-                        # Check if any existing version has an index.json with matching version
-                        for version_dir in existing_versions:
-                            index_path = os.path.join(origin_name_path, version_dir, "index.json")
-                            if os.path.exists(index_path):
-                                with open(index_path, "r", encoding="utf-8") as f:
-                                    index = json.load(f)
-                                existing_ident = index.get("target", {}).get("package", {}).get("ident", "")
-                                
-                                # Compare full ident (origin/name/version/release)
-                                if resolved_version and existing_ident == resolved_version:
-                                    return True, f"Habitat package {resolved_version} already scanned (found in index.json)"
-            
-            return False, "No existing habitat scan or version mismatch"
-        
-        elif scan_mode == "modern":
-            # Modern mode: check metadata.json (same as native but under modern/ path)
-            metadata_path = os.path.join(
-                data_repo_path,
-                "modern",
-                product,
-                channel,
-                download_site,
-                os_name,
-                os_ver,
-                arch,
-                "metadata.json"
-            )
-            
-            if os.path.exists(metadata_path):
-                with open(metadata_path, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                existing_version = metadata.get("target", {}).get("resolved_version", "")
-                
-                print(f"Version comparison: existing='{existing_version}' vs resolved='{resolved_version}'")
-                if existing_version == resolved_version:
-                    return True, f"Version {resolved_version} already scanned (found in metadata.json)"
-                else:
-                    return False, f"Version mismatch: existing={existing_version}, resolved={resolved_version}"
-            
-            return False, "No existing metadata found"
-    
-    except Exception as e:
-        print(f"Warning: Error checking existing version: {e}")
-        return False, f"Error checking existing version: {e}"
-    
-    return False, "Unknown check result"
+    Write a grype JSON report read from stream to json_path in its final form,
+    counting match severities on the way.
 
-# Inputs
-product       = env("PRODUCT")
-channel       = env("CHANNEL")
-download_site = env("DOWNLOAD_SITE", "commercial")
-os_name       = env("OS", "ubuntu")
-os_ver        = env("OS_VERSION", "")
-arch          = env("ARCH", "x86_64")
-package_manager = env("PACKAGE_MANAGER", "")
-scan_mode     = env("SCAN_MODE", "native")
-scan_root     = env("SCAN_ROOT", "")
-resolve_ver   = env("RESOLVE_VERSION", "latest")
-pinned_ver    = env("PINNED_VERSION", "")
-license_id    = env("LICENSE_ID", "")
-base_url_override = env("BASE_URL_OVERRIDE", "")
-out_dir       = env("OUT_DIR", "out")
-work_dir      = env("WORK_DIR", "work")
-data_repo_path = env("DATA_REPO_PATH", "")
-full_product_scan = env("FULL_PRODUCT_SCAN", "false").lower() in ("true", "1", "yes")
-hab_ident     = env("HAB_IDENT", "")
-hab_channel   = env("HAB_CHANNEL", "stable")
-hab_origin    = env("HAB_ORIGIN", "")
-hab_auth_token = env("HAB_AUTH_TOKEN", "")
+    Top-level arrays (matches, ignoredMatches) are decoded one element at a time, so
+    peak memory is bounded by the largest single match rather than the report size.
+    The file is byte-identical to write_json(json.load(stream), json_path, fmt).
 
-ensure_dir(out_dir)
-ensure_dir(work_dir)
+    Args:
+        stream: Text stream with grype's JSON output (e.g., a Popen stdout)
+        json_path: Output path
+        chunk_size: Minimum read size
+        fmt: One of JSON_OUTPUT_FORMATS (default: json_output_format)
+        on_value: Optional callback on_value(key, value, element) for each top-level value
+            as it is decoded. Top-level arrays are passed one element at a time
+            (element=True); an empty array is passed as [] with element=False.
 
-# Create scanners output directory (for native/modern mode)
-if scan_mode in ["native", "modern"]:
-    scanners_dir = os.path.join(out_dir, "scanners")
-    ensure_dir(scanners_dir)
+    Returns:
+        (matches_total, severity_counts) tuple
 
-# Branch based on scan_mode
-if scan_mode == "habitat":
-    # HABITAT MODE: Install hab package, enumerate deps, scan each separately
-    
-    # Guard: habitat mode requires hab_ident or hab_origin
-    if not hab_ident.strip() and not hab_origin.strip():
-        raise RuntimeError(
-            "Habitat scan_mode requires HAB_IDENT (e.g., 'core/chef-infra-client') or HAB_ORIGIN (e.g., 'chef'). "
-            "Set one in the target configuration."
-        )
-    
-    # Ensure hab CLI is available
-    # Note: chef/hab itself now requires HAB_AUTH_TOKEN even from stable channel.
-    # sudo strips environment variables by default, so pass the token inline when available.
-    if hab_auth_token:
-        install_hab_cmd = f"command -v hab >/dev/null 2>&1 || (curl -fsSL https://raw.githubusercontent.com/habitat-sh/habitat/master/components/hab/install.sh | sudo HAB_AUTH_TOKEN={hab_auth_token} bash)"
-    else:
-        install_hab_cmd = "command -v hab >/dev/null 2>&1 || (curl -fsSL https://raw.githubusercontent.com/habitat-sh/habitat/master/components/hab/install.sh | sudo bash)"
-    run(["bash", "-lc", install_hab_cmd], check=True)
-    
-    # Accept the Chef License for Habitat (CI environment - create marker file for root)
-    run(["bash", "-lc", "sudo mkdir -p /hab/accepted-licenses && sudo touch /hab/accepted-licenses/habitat"], check=True)
-    
-    # Determine package identifier
-    pkg_to_install = hab_ident if hab_ident else f"{hab_origin}/{product}"
-    
-    # Install the package (with channel if specified) - requires sudo for /hab/pkgs/ access
-    # Note: Chef packages now require HAB_AUTH_TOKEN even for stable channel
-    install_cmd = f"sudo hab pkg install {pkg_to_install}"
-    if hab_channel and hab_channel != "stable":
-        install_cmd += f" --channel {hab_channel}"
-    
-    # Set HAB_AUTH_TOKEN if provided (required for protected packages including chef/* in stable)
-    if hab_auth_token:
-        if hab_channel and hab_channel != "stable":
-            install_cmd = f"sudo HAB_AUTH_TOKEN={hab_auth_token} hab pkg install {pkg_to_install} --channel {hab_channel}"
-        else:
-            install_cmd = f"sudo HAB_AUTH_TOKEN={hab_auth_token} hab pkg install {pkg_to_install}"
-    
-    run(["bash", "-lc", install_cmd], check=True)
-    
-    # Get installed package details
-    rc, out, err = run(["bash", "-lc", f"sudo hab pkg path {pkg_to_install}"], check=True)
-    installed_path = out.strip()
-    
-    # Parse origin/name/version/release from path
-    # Expected: /hab/pkgs/<origin>/<name>/<version>/<release> or C:\hab\pkgs\<origin>\<name>\<version>\<release>
-    path_parts = installed_path.replace("\\", "/").split("/")
-    if len(path_parts) >= 4:
-        origin, name, version, release = path_parts[-4:]
-        resolved_version = f"{origin}/{name}/{version}/{release}"
-    else:
-        raise RuntimeError(f"Unable to parse habitat package path: {installed_path}")
-    
-    # Check if this version is already scanned (unless full_product_scan is enabled)
-    if not full_product_scan:
-        should_skip, skip_reason = check_existing_version(
-            scan_mode="habitat",
-            data_repo_path=data_repo_path,
-            product=product,
-            channel=hab_channel,
-            download_site="",  # Not used for habitat
-            os_name=os_name,
-            os_ver=os_ver,
-            arch=arch,
-            resolved_version=resolved_version,
-            hab_ident=hab_ident
-        )
-        
-        if should_skip:
-            print(f"SKIP: {skip_reason}")
-            print(f"::debug::Skipping habitat scan for {product} {hab_channel}: {skip_reason}")
-            # Write minimal outputs for workflow to continue
-            write_text(os.path.join(out_dir, "_resolved_version.txt"), resolved_version)
-            write_text(os.path.join(out_dir, "_download_url_redacted.txt"), f"habitat://{resolved_version}@{hab_channel}")
-            write_text(os.path.join(out_dir, "_skipped.txt"), "true")
-            exit(0)
-    else:
-        print(f"INFO: Full product scan enabled - bypassing version check")
+    Raises:
+        ValueError: If the stream is not a JSON object
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    matches_total = 0
+    sev_counts = count_severities([])
 
-    
-    # Enumerate direct dependencies (from DEPS file)
-    main_ident = f"{origin}/{name}/{version}/{release}"
-    deps_file = f"{installed_path}/DEPS"
-    rc, out, err = run(["bash", "-lc", f"sudo cat {deps_file} 2>/dev/null || echo ''"], check=False)
-    if rc == 0 and out.strip():
-        direct_dep_idents = [line.strip() for line in out.split("\n") if line.strip() and "/" in line]
-    else:
-        direct_dep_idents = []
-    
-    # Enumerate transitive dependencies (full tree - includes direct deps per Habitat definition)
-    rc, out, err = run(["bash", "-lc", f"sudo hab pkg dependencies -t {pkg_to_install}"], check=True)
-    transitive_dep_idents = [line.strip() for line in out.split("\n") if line.strip() and "/" in line and line.strip() != main_ident]
-    
-    # Build combined list for scanning: main package + direct deps + all transitive deps
-    # Note: Direct deps will be scanned twice (once in direct-deps/, once in transitive-deps/)
-    # Tag each with its type for proper directory placement
-    deps_to_scan = [
-        {"ident": main_ident, "type": "main"},
-    ]
-    for ident in direct_dep_idents:
-        deps_to_scan.append({"ident": ident, "type": "direct"})
-    for ident in transitive_dep_idents:
-        deps_to_scan.append({"ident": ident, "type": "transitive"})
-    
-    # Ensure grype (may be restored from cache)
-    grype_version = os.getenv("GRYPE_VERSION", "0.109.0")
-    if os.path.isfile("/usr/local/bin/grype"):
-        # Ensure executable permissions (cache may not preserve them)
-        run(["chmod", "+x", "/usr/local/bin/grype"], check=False)
-        print("✓ Grype found in cache")
+    if (fmt or json_output_format) == "pretty":
+        key_sep, item_sep, colon, end_list, end_obj = "\n  ", "\n    ", ": ", "\n  ]", "\n}"
+        encode = lambda v, pad: json.dumps(v, indent=2).replace("\n", pad)
     else:
-        rc, _, _ = run(["bash", "-lc", "command -v grype >/dev/null 2>&1"], check=False)
-        if rc == 0:
-            print("✓ Grype already installed")
-        else:
-            # Install with retry logic for GitHub releases API
-            print(f"Installing Grype {grype_version}...")
-            install_cmd = f"curl -sSfL https://raw.githubusercontent.com/anchore/grype/main/install.sh | sh -s -- -b /usr/local/bin v{grype_version}"
-            run(["bash", "-lc", install_cmd], check=True, retry_config={"max_retries": 5, "base_delay": 2, "max_delay": 30})
-    
-    # Create main package directory structure: {origin}/{name}/{version}/
-    main_pkg_dir = os.path.join(out_dir, origin, name, version)
-    ensure_dir(main_pkg_dir)
-    
-    # Log what we're scanning
-    print(f"Habitat scan: {main_ident}")
-    print(f"Channel: {hab_channel}")
-    print(f"Total dependencies to scan: {len(deps_to_scan)}")
-    print(f"  - Main package: 1")
-    print(f"  - Direct dependencies: {len(direct_dep_idents)}")
-    print(f"  - Transitive dependencies: {len(transitive_dep_idents)}")
-    
-    # Scan each dependency separately
-    dep_results = []
-    
-    for dep_info in deps_to_scan:
-        dep_ident = dep_info["ident"]
-        dep_type = dep_info["type"]
-        # Parse dependency ident: origin/name/version/release
-        dep_parts = dep_ident.split("/")
-        if len(dep_parts) != 4:
-            print(f"Skipping malformed dependency ident: {dep_ident}")
-            continue
-        
-        dep_origin, dep_name, dep_version, dep_release = dep_parts
-        
-        # Determine scan path
-        if os_name == "windows":
-            dep_scan_path = f"C:\\hab\\pkgs\\{dep_origin}\\{dep_name}\\{dep_version}\\{dep_release}"
-        else:
-            dep_scan_path = f"/hab/pkgs/{dep_origin}/{dep_name}/{dep_version}/{dep_release}"
-        
-        # Determine output location based on dependency type
-        if dep_type == "main":
-            # Main package files go directly in main_pkg_dir
-            dep_out_dir = main_pkg_dir
-        elif dep_type == "direct":
-            # Direct dependencies go under direct-deps/{origin}/{name}/{version}/
-            dep_out_dir = os.path.join(main_pkg_dir, "direct-deps", dep_origin, dep_name, dep_version)
-        else:  # transitive
-            # Transitive dependencies go under transitive-deps/{origin}/{name}/{version}/
-            dep_out_dir = os.path.join(main_pkg_dir, "transitive-deps", dep_origin, dep_name, dep_version)
-        
-        ensure_dir(dep_out_dir)
-        
-        dep_json_path = os.path.join(dep_out_dir, f"{dep_release}.json")
-        dep_metadata_path = os.path.join(dep_out_dir, f"{dep_release}.metadata.json")
-        
-        # Calculate installed size for this Habitat package
-        dep_size = get_directory_size(dep_scan_path)
-        
-        # Run grype scan
+        key_sep, item_sep, colon, end_list, end_obj = "", "", ":", "]", "}"
+        encode = lambda v, pad: json.dumps(v, separators=(",", ":"))
+
+    def fill(min_size):
+        nonlocal buf, pos, eof
+        buf = buf[pos:]
+        pos = 0
+        chunk = stream.read(max(chunk_size, min_size))
+        if not chunk:
+            eof = True
+        buf += chunk
+
+    def peek():
+        # Next non-whitespace character (not consumed)
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError("Unexpected end of grype JSON output")
+            fill(0)
+
+    def take(expected):
+        nonlocal pos
+        ch = peek()
+        if ch not in expected:
+            raise ValueError(f"Malformed grype JSON output: expected one of {expected!r}, got {ch!r}")
+        pos += 1
+        return ch
+
+    def value():
+        # Decode one complete value; retry with a larger buffer when it is cut off
+        # (the buffer grows geometrically, so retries stay linear in the value size)
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(len(buf))
+
+    with open_json_output(json_path, fmt) as out:
+        take("{")
+        if peek() == "}":
+            out.write("{}")
+            return matches_total, sev_counts
+        out.write("{")
+        first_key = True
+        while True:
+            key = value()
+            take(":")
+            out.write(("" if first_key else ",") + key_sep + json.dumps(key) + colon)
+            first_key = False
+            if peek() == "[":
+                take("[")
+                if peek() == "]":
+                    take("]")
+                    out.write("[]")
+                    if on_value:
+                        on_value(key, [], False)
+                else:
+                    out.write("[")
+                    first_item = True
+                    while True:
+                        item = value()
+                        if key == "matches":
+                            matches_total += 1
+                            add_match_severity(sev_counts, item)
+                        if on_value:
+                            on_value(key, item, True)
+                        out.write(("" if first_item else ",") + item_sep + encode(item, "\n    "))
+                        first_item = False
+                        if take(",]") == "]":
+                            break
+                    out.write(end_list)
+            else:
+                item = value()
+                if on_value:
+                    on_value(key, item, False)
+                out.write(encode(item, "\n  "))
+            if take(",}") == "}":
+                break
+        out.write(end_obj)
+    return matches_total, sev_counts
+
+def grype_scan_to_file(source, name, json_path, sbom_path=None, excludes=(), fmt=None, on_value=None):
+    """
+    Run grype against a source and stream its JSON report to json_path (in json_output_format).
+
+    Args:
+        source: grype source (e.g., "dir:/hab/pkgs/core/zlib/1.3/20240105173710", "sbom:/path/sbom.json")
+        name: Name recorded in the report (--name)
+        json_path: Output path for the grype JSON report
+        sbom_path: When set (and source is a dir: source), catalog with syft first, keep the
+            syft-json SBOM at sbom_path and match against it with `grype sbom:`. The SBOM can
+            later be re-matched against a newer DB without the original files.
+        excludes: grype --exclude globs (relative to a dir: source, e.g. "./core/zlib/**")
+        fmt, on_value: Passed to stream_grype_report()
+
+    Returns:
+        (matches_total, severity_counts) tuple (see stream_grype_report())
+
+    Raises:
+        RuntimeError: If syft or grype fails, or grype's output is not valid JSON
+    """
+    if sbom_path and source.startswith("dir:"):
+        with timed_span("syft", label=name) as span:
+            run(["bash", "-lc", f"syft '{source}' --source-name '{name}' -o syft-json='{sbom_path}'"], check=True)
+            span["bytes"] = os.path.getsize(sbom_path)
+        source = f"sbom:{sbom_path}"
+    exclude_args = "".join(f" --exclude '{pattern}'" for pattern in excludes)
+    cmd = ["bash", "-lc", f"grype '{source}' --name '{name}'{exclude_args} --output json"]
+    # stderr goes to a temp file so a chatty grype can't block the stdout pipe
+    with timed_span("grype", label=name, source=source.split(":", 1)[0]) as span, \
+            tempfile.TemporaryFile(mode="w+", encoding="utf-8") as err_file:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_file, text=True, encoding="utf-8")
+        parse_error = None
         try:
-            run(["bash", "-lc", f"grype dir:'{dep_scan_path}' --name '{dep_ident}' --output json > '{dep_json_path}'"], check=True)
-            
-            # Parse and pretty-print
-            dep_doc = json.load(open(dep_json_path, "r", encoding="utf-8"))
-            json.dump(dep_doc, open(dep_json_path, "w", encoding="utf-8"), indent=2)
-            
-            # Count vulnerabilities by severity
-            dep_matches = dep_doc.get("matches", []) or []
-            buckets = ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]
-            dep_sev_counts = {k: 0 for k in buckets}
-            
-            for m in dep_matches:
-                sev = (m.get("vulnerability", {}) or {}).get("severity", "Unknown") or "Unknown"
-                sev_norm = sev.strip().title()
-                if sev_norm in ("Negligible", "Minimal"):
-                    sev_norm = "Negligible"
-                if sev_norm not in dep_sev_counts:
-                    sev_norm = "Unknown"
-                dep_sev_counts[sev_norm] += 1
-            
-            # Create per-dependency metadata
-            dep_metadata = {
-                "schema_version": "1.0",
-                "dependency": {
-                    "ident": dep_ident,
-                    "origin": dep_origin,
-                    "name": dep_name,
-                    "version": dep_version,
-                    "release": dep_release,
-                    "scan_path": dep_scan_path,
-                    "size": {
-                        "installed_bytes": dep_size["bytes"],
-                        "installed_human_readable": dep_size["human_readable"],
-                        "file_count": dep_size["file_count"]
-                    }
-                },
-                "scan": {
-                    "timestamp_utc": now_utc(),
-                    "matches_total": len(dep_matches),
-                    "severity_counts": dep_sev_counts
-                }
-            }
-            json.dump(dep_metadata, open(dep_metadata_path, "w", encoding="utf-8"), indent=2)
-            
-            # Track for rollup
-            # Build json_path based on dependency type
-            if dep_type == "main":
-                json_rel_path = f"{dep_release}.json"
-            elif dep_type == "direct":
-                json_rel_path = f"direct-deps/{dep_origin}/{dep_name}/{dep_version}/{dep_release}.json"
-            else:  # transitive
-                json_rel_path = f"transitive-deps/{dep_origin}/{dep_name}/{dep_version}/{dep_release}.json"
-            
-            dep_results.append({
-                "ident": dep_ident,
-                "origin": dep_origin,
-                "name": dep_name,
-                "version": dep_version,
-                "release": dep_release,
-                "matches_total": len(dep_matches),
-                "severity_counts": dep_sev_counts,
-                "json_path": json_rel_path,
-                "dependency_type": dep_type,
-                "size": {
-                    "installed_bytes": dep_size["bytes"],
-                    "installed_human_readable": dep_size["human_readable"],
-                    "file_count": dep_size["file_count"]
-                }
-            })
-            
-            print(f"Scanned dependency: {dep_ident} - {dep_size['human_readable']} ({len(dep_matches)} matches)")
-            
-        except Exception as e:
-            print(f"Failed to scan dependency {dep_ident}: {e}")
-            # Continue with other dependencies
-    
-    # Create index.json rollup
-    # Grype version + DB status
-    grype_version = ""
+            result = stream_grype_report(proc.stdout, json_path, fmt=fmt, on_value=on_value)
+        except ValueError as e:
+            parse_error = e
+            proc.stdout.read()  # Drain so grype can exit
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0 or parse_error:
+            err_file.seek(0)
+            raise RuntimeError(f"Command failed: {cmd}\nparse error: {parse_error}\nstderr:\n{err_file.read()}")
+        span["matches"] = result[0]
+        span["bytes"] = os.path.getsize(json_path)
+    return result
+
+def rematch_sbom(sbom_path, name, json_path, fmt=None):
+    """
+    Match a stored syft SBOM against the current grype DB.
+
+    Writes the grype JSON report to json_path (in fmt, default: json_output_format).
+
+    Returns:
+        (matches_total, severity_counts) tuple
+    """
+    return grype_scan_to_file(f"sbom:{sbom_path}", name, json_path, fmt=fmt)
+
+def get_grype_version():
+    """Return the installed grype version string (e.g., "0.109.0"), or "" if unknown."""
     rc, out, err = run(["bash", "-lc", "grype version"], check=False)
     if rc == 0:
         m = re.search(r"Version:\s*([0-9]+\.[0-9]+\.[0-9]+(?:[-+.\w]+)?)", out)
         if m:
-            grype_version = m.group(1)
-    
+            return m.group(1)
+    return ""
+
+def get_grype_db_info():
+    """
+    Collect grype vulnerability DB status (best effort).
+
+    Returns:
+        Dict with any of: status_raw, status_raw_text, built_utc, schema, checksum
+    """
     db_info = {}
     rc, out, err = run(["bash", "-lc", "grype db status -o json"], check=False)
     if rc == 0 and out.startswith("{"):
@@ -773,49 +1092,2531 @@ if scan_mode == "habitat":
                     break
         except Exception:
             db_info["status_raw_text"] = out
+    else:
+        rc2, out2, err2 = run(["bash", "-lc", "grype db status"], check=False)
+        if rc2 == 0:
+            db_info["status_raw_text"] = out2
+            m = re.search(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)", out2)
+            if m:
+                db_info["built_utc"] = m.group(1)
+    return db_info
+
+def grype_db_identity(db_info):
+    """
+    Return a string identifying the exact grype DB build, for use in cache keys.
+
+    Prefers the DB checksum; falls back to schema + build timestamp. Returns None
+    when the DB cannot be identified (caching must then be skipped).
+    """
+    if db_info.get("checksum"):
+        return str(db_info["checksum"])
+    if db_info.get("built_utc"):
+        return f"{db_info.get('schema', '')}@{db_info['built_utc']}"
+    return None
+
+# Grype toolchain: the vulnerability DB is made ready once per process (imported from
+# grype_db_archive, set from GRYPE_DB_ARCHIVE, or updated once), later grype runs skip
+# their own update checks, and grype's version/DB info is collected once.
+grype_db_archive = ""
+grype_toolchain_info = None
+grype_toolchain_prepared = 0.0  # time.monotonic() of the last DB preparation
+grype_toolchain_lock = threading.Lock()
+
+def grype_db_cache_dir():
+    """Directory grype keeps its DB in (GRYPE_DB_CACHE_DIR, default ~/.cache/grype/db)."""
+    return os.path.expanduser(os.environ.get("GRYPE_DB_CACHE_DIR") or "~/.cache/grype/db")
+
+def import_grype_db_archive(archive_path):
+    """
+    Import a grype DB archive (from `grype db list`) unless the DB cache already holds it.
+
+    A marker next to the DB records the imported archive (path, size, mtime), so jobs that
+    share a DB cache directory import a given archive only once.
+    """
+    st = os.stat(archive_path)
+    archive_id = f"{os.path.abspath(archive_path)}|{st.st_size}|{int(st.st_mtime)}"
+    marker_path = os.path.join(grype_db_cache_dir(), ".imported-archive")
+    try:
+        if open(marker_path, "r", encoding="utf-8").read() == archive_id:
+            print(f"✓ Grype DB archive already imported: {archive_path}")
+            return
+    except OSError:
+        pass
+    print(f"Importing grype DB archive: {archive_path}")
+    run(["bash", "-lc", f"grype db import '{archive_path}'"], check=True)
+    ensure_dir(grype_db_cache_dir())
+    write_text(marker_path, archive_id)
+
+def grype_toolchain():
+    """
+    Prepare the grype DB once per process and return grype's version and DB info.
+
+    With grype_db_archive set, that archive is the DB. It is imported (see
+    import_grype_db_archive()) and used read-only: DB auto-update and the DB age check
+    are disabled for every later grype run, so a pinned DB older than grype's maximum
+    age still works. Otherwise the DB is updated once, and auto-update is disabled
+    afterwards as long as the DB can be identified, so hundreds of per-dependency
+    scans don't each re-check it. grype's own application update check is always off.
+
+    Returns:
+        Dict with "version" (see get_grype_version()), "db" (see get_grype_db_info()) and
+        "db_identity" (see grype_db_identity(); the cache key for anything grype produced)
+    """
+    global grype_toolchain_info, grype_toolchain_prepared
+    with grype_toolchain_lock:
+        if grype_toolchain_info is not None:
+            return grype_toolchain_info
+        os.environ["GRYPE_CHECK_FOR_APP_UPDATE"] = "false"
+        with timed_span("grype_db", archive=bool(grype_db_archive)):
+            if grype_db_archive:
+                import_grype_db_archive(grype_db_archive)
+                os.environ["GRYPE_DB_AUTO_UPDATE"] = "false"
+                os.environ["GRYPE_DB_VALIDATE_AGE"] = "false"
+            else:
+                run(["bash", "-lc", "grype db update"], check=False)
+            db_info = get_grype_db_info()
+        db_identity = grype_db_identity(db_info)
+        if db_identity:
+            os.environ["GRYPE_DB_AUTO_UPDATE"] = "false"
+        elif grype_db_archive:
+            raise RuntimeError(f"Imported grype DB archive {grype_db_archive} but `grype db status` cannot identify it")
+        grype_toolchain_info = {"version": get_grype_version(), "db": db_info, "db_identity": db_identity}
+        grype_toolchain_prepared = time.monotonic()
+        print(f"Grype {grype_toolchain_info['version'] or 'unknown'}, DB {db_identity or 'unknown'}"
+              f"{' (pinned archive)' if grype_db_archive else ''}")
+        return grype_toolchain_info
+
+def refresh_grype_toolchain(max_age):
+    """
+    Prepare the grype DB again if it was prepared more than max_age seconds ago.
+
+    For long-running processes (run.py worker): grype_toolchain() disables DB auto-update,
+    so without this a resident worker would keep matching against its first DB. A pinned
+    grype_db_archive is never refreshed. Call it only while no grype scan is running.
+
+    Returns:
+        grype_toolchain() info
+    """
+    global grype_toolchain_info
+    with grype_toolchain_lock:
+        if grype_toolchain_info is not None and not grype_db_archive and time.monotonic() - grype_toolchain_prepared > max_age:
+            print(f"Grype DB prepared {int(time.monotonic() - grype_toolchain_prepared)}s ago - updating")
+            grype_toolchain_info = None
+    return grype_toolchain()
+
+def rematch_db_info(previous_db_info):
+    """
+    Update the grype DB and compare it with the DB a stored scan was matched against.
+
+    Args:
+        previous_db_info: scan.grype.db from the stored metadata.json / index.json
+
+    Returns:
+        (db_info, previous_identity) when the current DB differs, or (None, previous_identity)
+        when it is unchanged or cannot be identified.
+    """
+    toolchain = grype_toolchain()
+    db_info = toolchain["db"]
+    previous_identity = grype_db_identity(previous_db_info or {})
+    db_identity = toolchain["db_identity"]
+    if not db_identity or db_identity == previous_identity:
+        print(f"Rematch: grype DB unchanged ({db_identity or 'unknown'}) - nothing to rematch")
+        return None, previous_identity
+    print(f"Rematch: grype DB changed ({previous_identity or 'unknown'} -> {db_identity})")
+    return db_info, previous_identity
+
+def pipeline_snapshot():
+    """Return the metadata "snapshot" section for this run (timestamp + GitHub Actions context)."""
+    gha_run_id = env("GITHUB_RUN_ID", "")
+    return {
+        "timestamp_utc": now_utc(),
+        "run_id": f"gha-{gha_run_id}" if gha_run_id else "",
+        "pipeline": {"repo": env("GITHUB_REPOSITORY", ""), "workflow": env("GITHUB_WORKFLOW", ""), "git_sha": env("GITHUB_SHA", "")}
+    }
+
+def prune_lru_cache(cache_root, max_bytes):
+    """
+    Evict least-recently-used entries until the cache fits in max_bytes.
+
+    Cache layout: {cache_root}/{key[:2]}/{key}/ with an entry.json whose mtime is
+    bumped on every hit (see touch_cache_entry). Entries are removed whole.
+
+    Returns:
+        Number of entries evicted
+    """
+    entries = []
+    total = 0
+    if not os.path.isdir(cache_root):
+        return 0
+    for shard in os.listdir(cache_root):
+        shard_path = os.path.join(cache_root, shard)
+        if not os.path.isdir(shard_path):
+            continue
+        for key in os.listdir(shard_path):
+            entry_dir = os.path.join(shard_path, key)
+            try:
+                last_used = os.stat(os.path.join(entry_dir, "entry.json")).st_mtime
+            except OSError:
+                last_used = 0  # Incomplete entry: evict first
+            size = walk_dir_sizes(entry_dir)[0]
+            entries.append((last_used, size, entry_dir))
+            total += size
+
+    evicted = 0
+    for last_used, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(entry_dir))  # Drop the shard directory once empty
+        except OSError:
+            pass
+        total -= size
+        evicted += 1
+    return evicted
+
+def touch_cache_entry(entry_dir):
+    """Mark a cache entry as recently used (LRU bookkeeping)."""
+    try:
+        os.utime(os.path.join(entry_dir, "entry.json"))
+    except OSError:
+        pass
+
+def store_cache_entry(cache_root, key, files, entry):
+    """
+    Atomically add an entry to an LRU cache directory.
+
+    Args:
+        cache_root: Cache root directory
+        key: Hex cache key
+        files: Dict of {name_in_entry: source_path} to copy into the entry
+        entry: JSON-serializable dict written as entry.json
+
+    Returns:
+        Path of the entry directory
+    """
+    entry_dir = os.path.join(cache_root, key[:2], key)
+    if os.path.isdir(entry_dir):
+        return entry_dir
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{random.randint(0, 1 << 30)}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        for name, src in files.items():
+            shutil.copyfile(src, os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, "entry.json"), "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=2)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another writer won the race (or the cache is unwritable) - not fatal
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return entry_dir
+
+def habitat_size_cache_key(ident):
+    """Cache key for a Habitat ident's installed size (independent of grype)."""
+    return hashlib.sha256(f"habitat-size|{ident}".encode("utf-8")).hexdigest()
+
+def habitat_deps_cache_key(ident):
+    """Cache key for a Habitat ident's dependency closure (DEPS/TDEPS never change for a release)."""
+    return hashlib.sha256(f"habitat-deps|{ident}".encode("utf-8")).hexdigest()
+
+def habitat_scan_cache_key(ident, grype_version, db_identity):
+    """Cache key for a Habitat ident scan: idents are immutable, so results only change with grype or its DB."""
+    return hashlib.sha256(f"habitat-scan|{ident}|{grype_version}|{db_identity}".encode("utf-8")).hexdigest()
+
+def native_package_cache_key(download_site, product, version, os_name, os_ver, arch, package_manager):
+    """Cache key for a downloaded package: a released version's artifact for a platform never changes."""
+    parts = ["native-package", download_site, product, version, os_name, os_ver, arch, package_manager]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+def load_cached_package(cache_dir, cache_key, dest_path):
+    """
+    Copy a cached package to dest_path after checking it against its recorded SHA-256.
+
+    A corrupted entry is dropped so the next store replaces it.
+
+    Returns:
+        The entry.json dict on a verified hit, or None on a miss
+    """
+    entry_dir = os.path.join(cache_dir, cache_key[:2], cache_key)
+    try:
+        entry = read_json(os.path.join(entry_dir, "entry.json"))
+        shutil.copyfile(os.path.join(entry_dir, "package"), dest_path)
+    except (OSError, ValueError):
+        return None  # Missing or unreadable entry: download normally
+    if file_sha256(dest_path) != entry.get("sha256"):
+        print(f"Warning: Cached package {cache_key[:12]} failed its checksum - discarding it")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.remove(dest_path)
+        return None
+    touch_cache_entry(entry_dir)
+    return entry
+
+def store_cached_package(cache_dir, cache_key, pkg_path, entry):
+    """Add a validated package to the package cache (entry gains its sha256 and size)."""
+    entry = dict(entry, sha256=file_sha256(pkg_path), bytes=os.path.getsize(pkg_path), created_utc=now_utc())
+    store_cache_entry(cache_dir, cache_key, {"package": pkg_path}, entry)
+    return entry
+
+def parse_curl_headers(headers_path):
+    """
+    Parse the final response of a curl -D header dump (redirect hops come first).
+
+    Returns:
+        (status, headers) tuple; headers has lower-case names. (None, {}) if nothing was received.
+    """
+    try:
+        with open(headers_path, "r", encoding="latin-1") as f:
+            text = f.read()
+    except OSError:
+        return None, {}
+    blocks = [b for b in re.split(r"\r?\n\r?\n", text) if b.strip().startswith("HTTP/")]
+    if not blocks:
+        return None, {}
+    lines = blocks[-1].strip().splitlines()
+    status_parts = lines[0].split()
+    status = int(status_parts[1]) if len(status_parts) > 1 and status_parts[1].isdigit() else None
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return status, headers
+
+def download_total_size(status, headers):
+    """Full size of the file being downloaded: from Content-Range on 206, Content-Length on 200 (else None)."""
+    if status == 206:
+        m = re.search(r"/(\d+)\s*$", headers.get("content-range", ""))
+        return int(m.group(1)) if m else None
+    if status == 200 and headers.get("content-length", "").isdigit():
+        return int(headers["content-length"])
+    return None
+
+def download_validator(headers):
+    """Strong ETag, else Last-Modified, usable in If-Range (weak ETags are not)."""
+    etag = headers.get("etag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified") or None
+
+# curl attempts per protocol in download_with_fallback(): the counts of the original
+# downloader. Its attempts each also retried curl up to 5 times internally (run() with a
+# retry_config), restarting from byte 0; those hidden retries are gone. Every curl run is
+# now one recorded attempt that resumes the partial file, so the budget is 3 + 5 runs.
+DOWNLOAD_ATTEMPTS_HTTP2 = 3
+DOWNLOAD_ATTEMPTS_HTTP1 = 5
+
+def download_with_fallback(url, output_path, timeout=300):
+    """
+    Download file with HTTP/2 fallback to HTTP/1.1 and retry logic.
+    
+    This addresses the curl (92) HTTP/2 stream errors by:
+    1. Trying HTTP/2 first with retries
+    2. Falling back to HTTP/1.1 if HTTP/2 consistently fails
+    3. Using exponential backoff with jitter
+    
+    A failed attempt keeps its partial file ({output_path}.part) and the next attempt
+    resumes it with a Range request (curl -C -), guarded by If-Range with the ETag or
+    Last-Modified of the first response, so a retry only transfers the missing bytes.
+    If the server ignores the range or the file changed, the download restarts.
+    The result is checked against the length reported by the server.
+    
+    Returns:
+        Dict with "bytes", "seconds", "resumed" and per-attempt "attempts" records
+        (strategy, attempt number within the strategy, resumed_from, bytes transferred,
+        seconds, http_status, result)
+    """
+    print(f"Downloading: {output_path}")
+    print(f"URL (redacted): {url.split('?')[0]}...")
+    
+    # HTTP version strategies to try in order
+    http_strategies = [
+        {
+            "name": "HTTP/2",
+            "flags": ["--http2"],
+            "retries": DOWNLOAD_ATTEMPTS_HTTP2  # Try HTTP/2 3 times before falling back
+        },
+        {
+            "name": "HTTP/1.1",
+            "flags": ["--http1.1"],
+            "retries": DOWNLOAD_ATTEMPTS_HTTP1  # Try HTTP/1.1 more times as fallback
+        }
+    ]
+    
+    partial_path = output_path + ".part"
+    headers_path = output_path + ".headers"
+    for path in (partial_path, headers_path):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    validator = None    # ETag/Last-Modified of the file the partial data belongs to
+    total_size = None   # Full length reported by the server
+    attempts = []
+    started = time.monotonic()
+    last_error = None
+    
+    def restart(reason):
+        nonlocal validator, total_size
+        print(f"   {reason} - restarting from byte 0")
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        validator, total_size = None, None
+    
+    for strategy in http_strategies:
+        print(f"Attempting download with {strategy['name']}...")
+        
+        for attempt in range(strategy["retries"]):
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            resume_flags = []
+            if offset:
+                print(f"Resuming at byte {offset:,}" + (f" of {total_size:,}" if total_size else ""))
+                resume_flags = ["-C", "-"]
+                if validator:
+                    resume_flags += ["-H", f"'If-Range: {validator}'"]
+            cmd = [
+                "bash", "-lc",
+                " ".join([
+                    "curl",
+                    "-fsSL",
+                    *strategy["flags"],
+                    "--connect-timeout", "30",
+                    "--max-time", str(timeout),
+                    "--keepalive-time", "60",
+                    "--tcp-nodelay",
+                    # No --compressed: byte ranges must refer to the file itself
+                    *resume_flags,
+                    "-D", f"'{headers_path}'",
+                    "-o", f"'{partial_path}'",
+                    f"'{url}'"
+                ])
+            ]
+            
+            attempt_started = time.monotonic()
+            with timed_span("download.attempt", protocol=strategy["name"], attempt=attempt + 1, resumed_from=offset) as span:
+                rc, out, err = run(cmd, check=False)
+                status, headers = parse_curl_headers(headers_path)
+                size = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+                span.update(bytes=max(0, size - offset), http_status=status)
+            record = {
+                "strategy": strategy["name"],
+                "attempt": attempt + 1,
+                "resumed_from": offset,
+                "bytes": max(0, size - offset),
+                "seconds": round(time.monotonic() - attempt_started, 3),
+                "http_status": status
+            }
+            attempts.append(record)
+            
+            # Track which file the data belongs to; a different validator means it changed upstream
+            if status in (200, 206):
+                new_validator = download_validator(headers)
+                if status == 206 and validator and new_validator and new_validator != validator:
+                    record["result"] = "changed"
+                    restart("File changed on the server")
+                    continue
+                validator = new_validator or validator
+                total_size = download_total_size(status, headers) or total_size
+            
+            if rc == 0 and offset and status == 200:
+                # Full body appended to the partial file (range ignored without an error)
+                record["result"] = "restarted"
+                restart("Server ignored the range request")
+                continue
+            if rc == 0 or (status == 416 and total_size and offset == total_size):
+                if total_size is not None and size != total_size:
+                    record["result"] = "short"
+                    last_error = RuntimeError(f"Downloaded {size} of {total_size} bytes from {redact_url(url)}")
+                    print(f"⚠️  Incomplete download ({size:,}/{total_size:,} bytes), resuming")
+                    continue
+                record["result"] = "ok"
+                os.replace(partial_path, output_path)
+                os.remove(headers_path)
+                stats = {
+                    "bytes": size,
+                    "seconds": round(time.monotonic() - started, 3),
+                    "resumed": any(a["resumed_from"] for a in attempts),
+                    "attempts": attempts
+                }
+                print(f"✓ Download successful ({size} bytes) using {strategy['name']}"
+                      f"{' after ' + str(len(attempts)) + ' attempts' if len(attempts) > 1 else ''}")
+                return stats
+            
+            record["result"] = "error"
+            error_str = f"Command failed: {redact_url(url)} ({strategy['name']})\nstdout:\n{out}\nstderr:\n{err}"
+            last_error = RuntimeError(error_str)
+            
+            # Range not honoured (33: server ignored it, or If-Range did not match) or unsatisfiable
+            if rc == 33 or status == 416 or (offset and status == 200):
+                restart("Server did not resume the transfer")
+                continue
+            
+            # Check if this is a protocol error specific to current HTTP version
+            if "(92)" in error_str or "http/2" in err.lower():
+                print(f"✗ {strategy['name']} protocol error, will try fallback strategy")
+                break  # Move to next HTTP version
+            elif not is_retryable_error(err, out):
+                # Non-retryable error, fail immediately
+                print(f"✗ Non-retryable error: {err[:200]}")
+                raise last_error
+            else:
+                # Retryable error (the partial file is kept), continue with current strategy
+                if attempt < strategy["retries"] - 1:
+                    jitter = random.uniform(0, 1)
+                    sleep_time = min(2 * (2 ** attempt) + jitter, 30)
+                    print(f"⚠️  Attempt {attempt + 1}/{strategy['retries']} failed ({err.strip()[:120]}), "
+                          f"{size:,} bytes kept, retrying in {sleep_time:.1f}s...")
+                    time.sleep(sleep_time)
+                else:
+                    print(f"✗ All {strategy['retries']} attempts with {strategy['name']} failed")
+                    break  # Try next strategy
+    
+    # All strategies exhausted
+    raise RuntimeError(
+        f"Download failed after all retry strategies:\n"
+        f"  URL: {url.split('?')[0]}\n"
+        f"  Last error: {last_error}"
+    )
+
+DOWNLOAD_MIN_SEGMENT_BYTES = 8 * 1024 * 1024
+
+def published_package_checksum(download_url):
+    """
+    Look up the SHA-256 the download API publishes for a package (best effort).
+
+    Queries the /metadata endpoint that sits next to /download for the same parameters.
+
+    Returns:
+        Lower-case hex digest, or None if the API has no metadata for it
+    """
+    parts = urlsplit(download_url)
+    if not parts.path.endswith("/download"):
+        return None
+    metadata_url = urlunsplit((parts.scheme, parts.netloc, parts.path[:-len("download")] + "metadata", parts.query, parts.fragment))
+    try:
+        doc = http_json(metadata_url)
+    except (HttpError, ValueError) as e:
+        print(f"No published checksum ({str(e).splitlines()[0][:200]})")
+        return None
+    sha256 = doc.get("sha256") if isinstance(doc, dict) else None
+    return sha256.lower() if isinstance(sha256, str) and re.fullmatch(r"[0-9a-fA-F]{64}", sha256) else None
+
+def file_sha256(path):
+    """Return the hex SHA-256 of a file."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def download_segmented(url, output_path, segments, max_retries=5):
+    """
+    Download a file as concurrent byte ranges written into a preallocated file.
+
+    Probes the URL with HEAD first; needs "Accept-Ranges: bytes" and a Content-Length.
+    Each segment is fetched on its own pooled connection (see http_request()) and
+    retried from its last written byte; If-Range pins every range to the probed
+    ETag/Last-Modified so segments of different file versions are never mixed.
+
+    Args:
+        url: Download URL (redirects are followed)
+        output_path: Destination file
+        segments: Maximum number of concurrent ranges (segments are at least
+                  DOWNLOAD_MIN_SEGMENT_BYTES long)
+        max_retries: Attempts per segment
+
+    Returns:
+        Stats dict like download_with_fallback() plus "segments", or None when the server
+        (or file) does not allow a segmented download - the caller then falls back to a
+        single stream.
+    """
+    try:
+        status, headers, _ = http_request(url, method="HEAD", retry_config={"max_retries": 3, "base_delay": 2, "max_delay": 30})
+    except HttpError as e:
+        print(f"Segmented download unavailable (HEAD failed: {str(e).splitlines()[0][:200]})")
+        return None
+    size = int(headers.get("Content-Length") or 0)
+    if (headers.get("Accept-Ranges") or "").lower() != "bytes" or size <= 0:
+        print("Segmented download unavailable (server does not advertise byte ranges)")
+        return None
+    count = min(segments, size // DOWNLOAD_MIN_SEGMENT_BYTES)
+    if count < 2:
+        print(f"Package is {size:,} bytes - single-stream download")
+        return None
+    validator = download_validator({k.lower(): v for k, v in headers.items()})
+
+    bounds = [(i * size // count, (i + 1) * size // count - 1) for i in range(count)]
+    partial_path = output_path + ".part"
+    with open(partial_path, "wb") as f:
+        f.truncate(size)
+    print(f"Segmented download: {size:,} bytes in {count} ranges")
+
+    attempts = []
+    attempts_lock = threading.Lock()
+    abandon = threading.Event()  # Set when one segment fails for good: the others stop early
+    started = time.monotonic()
+
+    batch_target = getattr(timing_context, "target", None)
+
+    def fetch(index):
+        timing_context.target = batch_target  # Pool threads: keep the spans on the batch target
+        try:
+            fetch_segment(index)
+        except Exception:
+            abandon.set()
+            raise
+
+    def fetch_segment(index):
+        start, end = bounds[index]
+        written = 0
+        with open(partial_path, "r+b") as f:
+            for attempt in range(max_retries):
+                offset = start + written
+                range_headers = {"Range": f"bytes={offset}-{end}"}
+                if validator:
+                    range_headers["If-Range"] = validator
+                f.seek(offset)
+                before = written
+                attempt_started = time.monotonic()
+                record = {"strategy": "HTTP/1.1", "attempt": attempt + 1, "segment": index, "resumed_from": offset, "http_status": None}
+
+                def sink(status, resp_headers):
+                    record["http_status"] = status
+                    if abandon.is_set():
+                        raise ValueError("abandoned")
+                    content_range = resp_headers.get("Content-Range") or ""
+                    if status != 206 or not content_range.startswith(f"bytes {offset}-"):
+                        # Range ignored, or If-Range did not match (file changed): no segmented download
+                        raise ValueError(f"segment {index}: HTTP {status} ({content_range or 'no Content-Range'}) instead of 206 for bytes {offset}-{end}")
+
+                    def write(chunk):
+                        nonlocal written
+                        if abandon.is_set():
+                            raise ValueError("abandoned")
+                        if written + len(chunk) > end - start + 1:
+                            raise ValueError(f"segment {index}: server sent more than the requested range")
+                        f.write(chunk)
+                        written += len(chunk)
+                    return write
+
+                try:
+                    with timed_span("download.attempt", protocol="HTTP/1.1", segment=index, attempt=attempt + 1, resumed_from=offset) as span:
+                        try:
+                            http_request_once(url, headers=range_headers, sink=sink)
+                        finally:
+                            span.update(bytes=written - before, http_status=record["http_status"])
+                    result = "ok" if written == end - start + 1 else "short"
+                except HttpError as e:
+                    record["http_status"] = e.status
+                    result = "error"
+                    if e.status is not None and not is_retryable_status(e.status):
+                        record.update(bytes=written - before, seconds=round(time.monotonic() - attempt_started, 3), result=result)
+                        with attempts_lock:
+                            attempts.append(record)
+                        raise
+                record.update(bytes=written - before, seconds=round(time.monotonic() - attempt_started, 3), result=result)
+                with attempts_lock:
+                    attempts.append(record)
+                if result == "ok":
+                    return
+                if attempt < max_retries - 1:
+                    time.sleep(min(2 * (2 ** attempt) + random.uniform(0, 1), 30))
+        raise HttpError("GET", url, None, f"segment {index} incomplete after {max_retries} attempts ({written} of {end - start + 1} bytes)")
+
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        futures = [pool.submit(fetch, i) for i in range(count)]
+        wait(futures)
+    errors = [f.exception() for f in futures if f.exception() and str(f.exception()) != "abandoned"]
+    if errors:
+        os.remove(partial_path)
+        e = errors[0]
+        if isinstance(e, HttpError) and e.status is not None and not is_retryable_status(e.status):
+            raise e
+        print(f"Segmented download abandoned ({str(e).splitlines()[0][:200]}) - falling back to a single stream")
+        return None
+
+    if os.path.getsize(partial_path) != size:
+        raise RuntimeError(f"Segmented download of {redact_url(url)} has {os.path.getsize(partial_path)} bytes, expected {size}")
+    os.replace(partial_path, output_path)
+    stats = {
+        "bytes": size,
+        "seconds": round(time.monotonic() - started, 3),
+        "segments": count,
+        "resumed": any(a["resumed_from"] != bounds[a["segment"]][0] for a in attempts),
+        "attempts": sorted(attempts, key=lambda a: (a["segment"], a["resumed_from"]))
+    }
+    print(f"✓ Segmented download successful ({size} bytes, {count} ranges, {stats['seconds']:.1f}s)")
+    return stats
+
+AR_MAGIC = b"!<arch>\n"
+
+class TeeReader:
+    """Read-only file object that counts, hashes and optionally copies everything read from a stream."""
+
+    def __init__(self, raw, tee=None):
+        self.raw = raw
+        self.tee = tee
+        self.bytes = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, n=-1):
+        chunk = self.raw.read(n)
+        self.bytes += len(chunk)
+        self.sha256.update(chunk)
+        if self.tee:
+            self.tee.write(chunk)
+        return chunk
+
+    def read_exact(self, n):
+        """Read exactly n bytes (fewer only at end of stream)."""
+        parts = []
+        while n > 0:
+            chunk = self.read(min(n, 1 << 20))
+            if not chunk:
+                break
+            parts.append(chunk)
+            n -= len(chunk)
+        return b"".join(parts)
+
+class ArMemberReader:
+    """File object over one member of an ar archive being read sequentially."""
+
+    def __init__(self, src, size):
+        self.src = src
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        chunk = self.src.read_exact(n) if n else b""
+        self.remaining -= len(chunk)
+        return chunk
+
+def iter_ar_members(src):
+    """
+    Walk an ar archive (the .deb container) from a TeeReader without seeking.
+
+    Yields (name, ArMemberReader) per member; whatever the caller leaves unread is
+    skipped before the next header.
+
+    Raises:
+        ValueError: Not an ar archive, or a truncated/malformed member header
+    """
+    if src.read_exact(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("not an ar archive (missing !<arch> header)")
+    while True:
+        header = src.read_exact(60)
+        if not header:
+            return
+        if len(header) != 60 or header[58:60] != b"`\n":
+            raise ValueError("malformed ar member header")
+        name = header[0:16].decode("ascii", "replace").strip().rstrip("/")
+        size = int(header[48:58].decode("ascii").strip() or "0")
+        member = ArMemberReader(src, size)
+        yield name, member
+        while member.read(1 << 20):
+            pass
+        if member.remaining:
+            raise ValueError(f"ar member '{name}' is truncated")
+        if size % 2:
+            src.read_exact(1)  # Members are 2-byte aligned
+
+# Extraction profiles for extract_filter=scannable: which regular files grype/syft
+# catalogers can use. Directories, symlinks and executables are always extracted; a
+# product entry replaces the default profile for that product.
+SCANNABLE_GLOBS = (
+    # OS package databases
+    "var/lib/dpkg/*", "var/lib/rpm/*", "usr/lib/sysimage/rpm/*", "lib/apk/db/*",
+    # Ruby
+    "*.gemspec", "*Gemfile.lock", "*gems.locked",
+    # Python
+    "*.dist-info/*", "*.egg-info", "*.egg-info/*", "*requirements*.txt", "*poetry.lock", "*Pipfile.lock", "*uv.lock", "*setup.py", "*pyproject.toml",
+    # JavaScript
+    "*package.json", "*package-lock.json", "*npm-shrinkwrap.json", "*yarn.lock", "*pnpm-lock.yaml",
+    # Go / Rust / PHP / Erlang / Elixir / .NET
+    "*go.mod", "*go.sum", "*Cargo.lock", "*composer.lock", "*installed.json", "*rebar.lock", "*mix.lock", "*.app", "*.deps.json", "*.dll", "*.exe",
+    # Java (archives, Maven metadata, JVM installs)
+    "*.jar", "*.war", "*.ear", "*.par", "*.sar", "*.nar", "*.jpi", "*.hpi", "*pom.xml", "*pom.properties", "*/release",
+    # Shared libraries (binary cataloger: openssl, libpython, libruby, ...)
+    "*.so", "*.so.*",
+    # Nested Habitat bundle of migration packages (extracted separately)
+    "hab/migration/bundle/*.tar.gz",
+)
+UNSCANNABLE_GLOBS = (
+    "usr/share/doc/*", "usr/share/man/*", "usr/share/info/*", "usr/share/locale/*",
+    "*/share/doc/*", "*/share/man/*", "*/share/info/*", "*/share/locale/*", "*/share/ri/*",
+)
+EXTRACT_PROFILES = {
+    "default": {"keep": SCANNABLE_GLOBS, "skip": UNSCANNABLE_GLOBS},
+}
+
+def compile_extract_profile(product):
+    """Return the extraction profile for a product with its globs compiled to regexes."""
+    profile = EXTRACT_PROFILES.get(product, EXTRACT_PROFILES["default"])
+    return {
+        "name": product if product in EXTRACT_PROFILES else "default",
+        "keep": re.compile("|".join(fnmatch.translate(g) for g in profile["keep"])),
+        "skip": re.compile("|".join(fnmatch.translate(g) for g in profile["skip"])),
+    }
+
+def new_skip_stats():
+    """Counters for files left out by a filtered extraction."""
+    return {"files": 0, "bytes": 0, "dirs": {}}
+
+def scannable_member(tarinfo, profile):
+    """Decide whether a tar member is extracted under an extraction profile."""
+    if not (tarinfo.isreg() or tarinfo.islnk()):
+        return True  # Directories, symlinks and devices cost nothing and keep the tree walkable
+    name = tarinfo.name[2:] if tarinfo.name.startswith("./") else tarinfo.name
+    if profile["skip"].match(name):
+        return False
+    return bool(tarinfo.mode & 0o111) or bool(profile["keep"].match(name))
+
+def decompressed_stream(fileobj, name):
+    """
+    Wrap a sequential stream in the decompressor its file name calls for.
+
+    tarfile's own "r|gz"/"r|xz" layer re-slices one growing buffer per read, which is
+    quadratic on large members; the module readers hand out bounded chunks instead.
+    """
+    if name.endswith((".gz", ".tgz")):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if name.endswith((".xz", ".lzma")):
+        return lzma.LZMAFile(fileobj, mode="rb")
+    if name.endswith(".bz2"):
+        return bz2.BZ2File(fileobj, mode="rb")
+    if name.endswith(".zst"):
+        return zstd_module().ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+def extract_tar_stream(fileobj, extract_dir, profile=None, skipped=None):
+    """
+    Extract a sequentially read tar stream (gz/xz/bz2/plain, see tarfile "r|*").
+
+    Args:
+        profile: compile_extract_profile() result; None extracts everything
+        skipped: new_skip_stats() dict updated with the files the profile left out
+            (bytes are the on-disk sizes, aggregated per top-three-level directory)
+
+    Returns:
+        Number of extracted entries
+    """
+    entries = 0
+    sizes = {}  # Regular file sizes (hard links report 0), and whether they were kept
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for tarinfo in tar:
+            if tarinfo.isreg():
+                keep = profile is None or scannable_member(tarinfo, profile)
+                sizes[tarinfo.name] = (tarinfo.size, keep)
+            elif tarinfo.islnk():
+                size, target_kept = sizes.get(tarinfo.linkname, (0, True))
+                keep = target_kept and (profile is None or scannable_member(tarinfo, profile))
+            else:
+                keep = True
+            if not keep:
+                size = tarinfo.size if tarinfo.isreg() else size
+                skipped["files"] += 1
+                skipped["bytes"] += size
+                name = tarinfo.name[2:] if tarinfo.name.startswith("./") else tarinfo.name
+                top = "/".join(name.split("/")[:3])
+                skipped["dirs"][top] = skipped["dirs"].get(top, 0) + size
+                continue
+            # Absolute symlinks are normal in packages; "tar" only strips unsafe modes/paths
+            if hasattr(tarfile, "tar_filter"):
+                tar.extract(tarinfo, extract_dir, filter="tar")
+            else:
+                tar.extract(tarinfo, extract_dir)
+            entries += 1
+    return entries
+
+def skip_summary(skipped, top=10):
+    """Metadata view of new_skip_stats() counters: totals plus the largest skipped directories."""
+    largest = sorted(skipped["dirs"].items(), key=lambda kv: (-kv[1], kv[0]))[:top]
+    return {
+        "files": skipped["files"],
+        "bytes": skipped["bytes"],
+        "largest_dirs": [{"path": path, "bytes": size} for path, size in largest]
+    }
+
+def match_keys(grype_doc):
+    """Set of (vulnerability id, artifact name, version, type) for a grype report's matches."""
+    return {
+        (m["vulnerability"]["id"], m["artifact"]["name"], m["artifact"]["version"], m["artifact"].get("type", ""))
+        for m in grype_doc.get("matches", [])
+    }
+
+def verify_extraction_parity(pkg_path, full_dir, name, filtered_json_path):
+    """
+    Scan a full dpkg-deb extraction of a package and compare it with a filtered scan.
+
+    Used by EXTRACT_VERIFY to check that an extraction profile does not lose findings.
+
+    Returns:
+        Dict with "parity", match totals, and up to 20 "missing" (only in the full scan)
+        and "extra" (only in the filtered scan) findings
+    """
+    print("Verifying the filtered extraction against a full extraction...")
+    run(["bash","-lc", f"rm -rf '{full_dir}' && mkdir -p '{full_dir}' && dpkg-deb -x '{pkg_path}' '{full_dir}'"], check=True)
+    for bundle_tarball in sorted(glob.glob(os.path.join(full_dir, "hab", "migration", "bundle", "*.tar.gz")))[:1]:
+        run(["bash", "-lc", f"tar -xzf '{bundle_tarball}' -C '{full_dir}'"], check=True)
+    full_json_path = os.path.join(os.path.dirname(full_dir), "grype.full.json")
+    grype_scan_to_file(f"dir:{full_dir}", name, full_json_path)
+    full_keys = match_keys(read_json(full_json_path))
+    filtered_keys = match_keys(read_json(filtered_json_path))
+    shutil.rmtree(full_dir, ignore_errors=True)
+    os.remove(full_json_path)
+
+    def label(key):
+        return f"{key[0]} {key[1]}@{key[2]} ({key[3]})"
+    missing = sorted(full_keys - filtered_keys)
+    extra = sorted(filtered_keys - full_keys)
+    result = {
+        "parity": not missing and not extra,
+        "full_matches": len(full_keys),
+        "filtered_matches": len(filtered_keys),
+        "missing": [label(k) for k in missing[:20]],
+        "extra": [label(k) for k in extra[:20]]
+    }
+    if result["parity"]:
+        print(f"✓ Filtered extraction matches the full extraction ({len(full_keys)} findings)")
+    else:
+        print(f"::warning::Filtered extraction differs from the full extraction: {len(missing)} findings missing, {len(extra)} extra")
+    return result
+
+def extract_deb_stream(src, extract_dir, profile=None, skipped=None):
+    """
+    Extract the data.tar.* member of a .deb read sequentially from src (like dpkg-deb -x).
+
+    The container is validated on the way: it must be an ar archive whose first member
+    is debian-binary (format 2.x). The rest of the stream is drained so src sees every byte.
+
+    Args:
+        profile, skipped: Optional filtering, see extract_tar_stream()
+
+    Returns:
+        Dict with "data_member" and the number of extracted "entries"
+
+    Raises:
+        ValueError: The stream is not a Debian package or has no data member
+    """
+    data_member = None
+    entries = 0
+    for index, (name, member) in enumerate(iter_ar_members(src)):
+        if index == 0:
+            if name != "debian-binary" or not member.read(4).startswith(b"2."):
+                raise ValueError("not a Debian package (first member is not debian-binary 2.x)")
+            continue
+        if not name.startswith("data.tar") or data_member:
+            continue
+        data_member = name
+        entries = extract_tar_stream(decompressed_stream(member, name), extract_dir, profile, skipped)
+    if not data_member:
+        raise ValueError("Debian package has no data.tar member")
+    return {"data_member": data_member, "entries": entries}
+
+def stream_download_extract(url, extract_dir, keep_path=None, timeout=300, profile=None, skipped=None):
+    """
+    Download a .deb and extract it while it arrives, without writing the package first.
+
+    curl streams the body to a pipe that is parsed as ar and untarred on the fly, so
+    download, validation and extraction overlap. The streamed transfer is a single
+    HTTP/2 attempt with no retry and no resume: any failure, including a transient
+    one, is raised, and the caller then downloads the whole package again with
+    download_with_fallback (retries, HTTP/1.1 fallback) + dpkg-deb.
+
+    Args:
+        keep_path: Also write the package here (e.g. for the package cache); None keeps nothing
+        profile, skipped: Optional filtering, see extract_tar_stream()
+
+    Returns:
+        Dict with "bytes", "seconds", "sha256", "streamed", "data_member" and "entries"
+
+    Raises:
+        RuntimeError: curl failed, or the body could not be extracted (not a valid
+            Debian package, a missing decompressor, a write error, ...). curl is
+            stopped and the partial keep_path download removed first.
+    """
+    print(f"Streaming download into {extract_dir}")
+    started = time.monotonic()
+    cmd = ["curl", "-fsSL", "--http2", "--connect-timeout", "30", "--max-time", str(timeout), url]
+    keep = open(keep_path + ".part", "wb") if keep_path else None
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+        src = TeeReader(proc.stdout, keep)
+        try:
+            extracted = extract_deb_stream(src, extract_dir, profile, skipped)
+        except Exception as e:
+            proc.kill()
+            extract_error = e
+        else:
+            extract_error = None
+        finally:
+            proc.stdout.close()
+            rc = proc.wait()
+            if keep:
+                keep.close()
+        stderr_file.seek(0)
+        err = stderr_file.read().decode("utf-8", "replace").strip()
+    if rc != 0 or extract_error:
+        if keep_path and os.path.exists(keep_path + ".part"):
+            os.remove(keep_path + ".part")
+        # curl's own error explains a broken body better than the parser's
+        reason = f"curl exit {rc}: {err}" if rc > 0 and err else str(extract_error or f"curl exit {rc}")
+        raise RuntimeError(f"Streaming download failed: {redact_url(url)}: {reason}")
+    if keep_path:
+        os.replace(keep_path + ".part", keep_path)
+    stats = {
+        "bytes": src.bytes,
+        "seconds": round(time.monotonic() - started, 3),
+        "sha256": src.sha256.hexdigest(),
+        "streamed": True,
+        **extracted
+    }
+    print(f"✓ Streamed and extracted {src.bytes} bytes ({extracted['data_member']}, {extracted['entries']} entries)")
+    return stats
+
+def map_cinc_product_name(product):
+    """
+    Map Chef product names to CINC product names for API endpoints.
+    CINC (Cinc Is Not Chef) uses different package names.
+    """
+    cinc_mapping = {
+        "chef": "cinc",
+        "chef-server": "cinc-server",
+        "chef-workstation": "cinc-workstation",
+        "inspec": "cinc-auditor"
+    }
+    return cinc_mapping.get(product, product)
+
+def native_download_base(download_site, base_url_override=""):
+    """Return the download API base URL for a native/modern download site (or the override)."""
+    if base_url_override:
+        base = base_url_override.rstrip("/")
+    elif download_site == "cinc":
+        base = "https://omnitruck.cinc.sh"
+    else:
+        base = "https://chefdownload-commercial.chef.io" if download_site == "commercial" else "https://chefdownload-community.chef.io"
+    return base
+
+def resolve_native_version(base, api_product, product, channel, download_site, license_id, resolve_ver="latest", pinned_ver=""):
+    """
+    Resolve the version to scan for a native/modern target.
+
+    For the stable channel, picks the newest stable version with the same major version
+    as current's latest (falling back to stable's /latest).
+
+    Args:
+        base: Download API base URL (see native_download_base())
+        api_product: Product name in the API (CINC names for download_site cinc)
+        product: Product name (error messages)
+        license_id: License for commercial/community downloads
+        resolve_ver: "latest" to resolve, anything else to use pinned_ver
+        pinned_ver: Pinned version
+
+    Returns:
+        The resolved version string
+
+    Raises:
+        RuntimeError: With a license-specific explanation when the API rejects license_id
+    """
+    resolved_version = pinned_ver
+    if resolve_ver == "latest" or not resolved_version:
+        # For stable channel, implement major version matching logic
+        # to ensure we compare stable against the same major version as current
+        if channel == "stable":
+            try:
+                print("🔍 Major version matching enabled for stable channel")
+                
+                # Step 1: Get the latest version from current channel, fetching all
+                # stable versions (step 3) at the same time
+                current_ver_url = f"{base}/current/{api_product}/versions/latest"
+                stable_all_url = f"{base}/stable/{api_product}/versions/all"
+                if license_id and download_site != "cinc":
+                    current_ver_url += f"?license_id={license_id}"
+                    stable_all_url += f"?license_id={license_id}"
+                
+                print(f"Fetching current channel latest: {current_ver_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
+                print(f"Fetching all stable versions: {stable_all_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
+                version_pool = ThreadPoolExecutor(max_workers=2)
+                try:
+                    stable_all_future = version_pool.submit(cached_version_json, stable_all_url)
+                    current_ver_doc = cached_version_json(current_ver_url)
+                finally:
+                    version_pool.shutdown(wait=False)
+                
+                current_version = None
+                if isinstance(current_ver_doc, dict):
+                    current_version = (
+                        current_ver_doc.get("version")
+                        or current_ver_doc.get("latest")
+                        or current_ver_doc.get("artifact_version")
+                        or current_ver_doc.get("value")
+                    )
+                    if not current_version:
+                        current_version = str(current_ver_doc)
+                else:
+                    current_version = str(current_ver_doc).strip().strip('"')
+                
+                print(f"Current channel latest version: {current_version}")
+                
+                # Step 2: Extract major version from current
+                current_major = get_major_version(current_version)
+                
+                if current_major is not None:
+                    print(f"Current channel major version: {current_major}")
+                    
+                    # Step 3: All stable versions (requested alongside step 1)
+                    stable_all_versions = stable_all_future.result()
+                    
+                    if isinstance(stable_all_versions, list) and stable_all_versions:
+                        print(f"Found {len(stable_all_versions)} stable versions")
+                        
+                        # Step 4: Find the best matching version in stable
+                        best_stable = find_best_stable_version_for_major(stable_all_versions, current_major)
+                        
+                        if best_stable:
+                            print(f"✅ Best stable version matching major {current_major}: {best_stable}")
+                            resolved_version = best_stable
+                        else:
+                            print(f"⚠️  No stable version found matching major {current_major}, falling back to /latest")
+                            # Fall back to regular latest logic below
+                            resolved_version = None
+                    else:
+                        print(f"⚠️  Could not fetch stable versions list, falling back to /latest")
+                        resolved_version = None
+                else:
+                    print(f"⚠️  Could not parse major version from current ({current_version}), falling back to /latest")
+                    resolved_version = None
+                    
+            except Exception as e:
+                print(f"⚠️  Major version matching failed: {e}")
+                print(f"   Falling back to standard /latest endpoint")
+                resolved_version = None
+        
+        # Fall back to standard /latest logic if major version matching was skipped or failed
+        if not resolved_version:
+            ver_url = f"{base}/{channel}/{api_product}/versions/latest"
+            # Commercial and community require license_id, but CINC does not
+            if license_id and download_site != "cinc":
+                ver_url += f"?license_id={license_id}"
+            
+            print(f"Fetching latest version from: {ver_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
+            try:
+                ver_doc = cached_version_json(ver_url)
+                print(f"API response type: {type(ver_doc).__name__}")
+                print(f"API response value: {ver_doc}")
+                if isinstance(ver_doc, dict):
+                    resolved_version = (
+                        ver_doc.get("version")
+                        or ver_doc.get("latest")
+                        or ver_doc.get("artifact_version")
+                        or ver_doc.get("value")
+                    )
+                    if not resolved_version:
+                        resolved_version = str(ver_doc)
+                else:
+                    resolved_version = str(ver_doc).strip().strip('"')
+            except RuntimeError as e:
+                error_msg = str(e)
+                status = getattr(e, "status", None)
+                # CINC doesn't require licenses, so skip license-specific error handling
+                if download_site != "cinc" and (status in (401, 403) or "Missing license_id" in error_msg or "License Id is not valid" in error_msg or "Only Free license" in error_msg):
+                    site_type = "commercial" if download_site == "commercial" else "community"
+                    license_secret = "GA_DOWNLOAD_GRYPE_LICENSE_ID" if download_site == "commercial" else "GA_DOWNLOAD_GRYPE_LICENSE_ID_FREE"
+                    
+                    if "Missing license_id" in error_msg:
+                        raise RuntimeError(
+                            f"LICENSE ERROR ({site_type}): Missing license_id parameter.\n"
+                            f"  Download site: {download_site}\n"
+                            f"  Required secret: {license_secret}\n"
+                            f"  Solution: Ensure the {license_secret} secret is set in the orchestrator repository"
+                        ) from e
+                    elif "License Id is not valid" in error_msg or status == 403:
+                        raise RuntimeError(
+                            f"LICENSE ERROR ({site_type}): Invalid or expired license_id.\n"
+                            f"  Download site: {download_site}\n"
+                            f"  Product: {product}, Channel: {channel}\n"
+                            f"  Secret used: {license_secret}\n"
+                            f"  Solution: Update the {license_secret} secret with a valid {'commercial' if download_site == 'commercial' else 'Free'} license"
+                        ) from e
+                    elif "Only Free license" in error_msg:
+                        raise RuntimeError(
+                            f"LICENSE ERROR (community): Wrong license type provided.\n"
+                            f"  Download site: community\n"
+                            f"  Error: Community downloads require a 'Free' license, but a commercial license was provided\n"
+                            f"  Solution: Update GA_DOWNLOAD_GRYPE_LICENSE_ID_FREE secret with a valid Free license (not commercial)"
+                        ) from e
+                    else:
+                        raise RuntimeError(
+                            f"LICENSE ERROR ({site_type}): Authentication failed.\n"
+                            f"  Download site: {download_site}\n"
+                            f"  Product: {product}, Channel: {channel}\n"
+                            f"  Secret used: {license_secret}\n"
+                            f"  Solution: Verify the {license_secret} secret contains a valid license for {download_site} downloads"
+                        ) from e
+                raise
+
+    return resolved_version
+
+def native_data_dir(data_repo_path, scan_mode, product, channel, download_site, os_name, os_ver, arch):
+    """Return the data-repo directory holding metadata.json for a native/modern target."""
+    return os.path.join(data_repo_path, scan_mode, product, channel, download_site, os_name, os_ver, arch)
+
+# Data-repo root file mapping every native/modern target to its last scan:
+# {"schema_version": "1.0", "targets": {"{mode}/{product}/{channel}/{site}/{os}/{os_ver}/{arch}": {...}}}
+SCAN_MANIFEST = "scan-manifest.json"
+
+def scan_manifest_key(scan_mode, product, channel, download_site, os_name, os_ver, arch):
+    """Return the manifest key of a native/modern target (its data-repo path, see native_data_dir())."""
+    return native_data_dir("", scan_mode, product, channel, download_site, os_name, os_ver, arch).replace(os.sep, "/")
+
+def read_scan_manifest_entry(target_dir):
+    """
+    Build the manifest entry for a native/modern target from its published metadata.json.
+
+    Returns:
+        Dict with resolved_version, grype_version, grype_db, timestamp_utc and sbom, or None
+        when target_dir holds no (readable) metadata.json.
+    """
+    try:
+        metadata = read_json(os.path.join(target_dir, "metadata.json"))
+    except (OSError, ValueError):
+        return None
+    grype = metadata.get("scan", {}).get("grype", {}) or {}
+    return {
+        "resolved_version": metadata.get("target", {}).get("resolved_version", ""),
+        "grype_version": grype.get("version", ""),
+        "grype_db": grype_db_identity(grype.get("db") or {}),
+        "timestamp_utc": metadata.get("snapshot", {}).get("timestamp_utc", ""),
+        "sbom": os.path.isfile(os.path.join(target_dir, "sbom.json"))
+    }
+
+def load_scan_manifest(data_repo_path):
+    """
+    Read {data_repo_path}/scan-manifest.json.
+
+    Returns:
+        The manifest's "targets" dict, or None if it is missing or unreadable.
+    """
+    path = os.path.join(data_repo_path, SCAN_MANIFEST)
+    if not data_repo_path or not os.path.isfile(path):
+        return None
+    try:
+        targets = read_json(path).get("targets")
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable {path}: {e}")
+        return None
+    return targets if isinstance(targets, dict) else None
+
+def build_scan_manifest(data_repo_path):
+    """
+    Build the scan manifest from every native/ and modern/ metadata.json in a data repo.
+
+    Returns:
+        Manifest dict ready for write_json()
+    """
+    targets = {}
+    for scan_mode in ("native", "modern"):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(data_repo_path, scan_mode)):
+            dirnames.sort()
+            if "metadata.json" not in filenames:
+                continue
+            entry = read_scan_manifest_entry(dirpath)
+            if entry:
+                targets[os.path.relpath(dirpath, data_repo_path).replace(os.sep, "/")] = entry
+    return {"schema_version": "1.0", "targets": dict(sorted(targets.items()))}
+
+def plan_native_target(target, manifest, data_repo_path, db_identity=None, full_scan=False, base_url_override=""):
+    """
+    Decide whether one matrix target needs a scan job.
+
+    Args:
+        target: Dict of action inputs (product, channel, download_site, os, os_version, arch,
+                scan_mode, resolve_version, pinned_version, ...); license ids come from
+                LICENSE_ID_COMMERCIAL / LICENSE_ID_COMMUNITY (or LICENSE_ID)
+        manifest: "targets" of scan-manifest.json, or None to read each metadata.json instead
+        data_repo_path: Data repo checkout
+        db_identity: Current grype DB identity when planning for SBOM_MODE=rematch, else None
+        full_scan: FULL_PRODUCT_SCAN - every target needs a scan
+        base_url_override: BASE_URL_OVERRIDE - download API base for every site ("" for the defaults)
+
+    Returns:
+        Copy of target with "resolved_version", "scan" (bool) and "reason"
+    """
+    planned = dict(target)
+    scan_mode = target.get("scan_mode") or "native"
+    if scan_mode == "habitat":
+        return dict(planned, resolved_version="", scan=True, reason="habitat targets are checked by their own job")
+
+    product = target["product"]
+    channel = target["channel"]
+    download_site = target.get("download_site") or "commercial"
+    os_name = target.get("os") or "ubuntu"
+    os_ver = target.get("os_version") or ""
+    arch = target.get("arch") or "x86_64"
+    site_license_id = env(f"LICENSE_ID_{download_site.upper()}", "") or env("LICENSE_ID", "")
+
+    api_product = map_cinc_product_name(product) if download_site == "cinc" else product
+    try:
+        resolved_version = resolve_native_version(
+            native_download_base(download_site, base_url_override), api_product, product, channel, download_site,
+            site_license_id, target.get("resolve_version") or "latest", target.get("pinned_version") or "")
+    except RuntimeError as e:
+        # Let the scan job resolve again and report the error properly
+        error = str(e).splitlines()[0]
+        if site_license_id:
+            error = error.replace(site_license_id, "***")
+        return dict(planned, resolved_version="", scan=True, reason=f"version resolution failed: {error}")
+    planned["resolved_version"] = resolved_version
+    if full_scan:
+        return dict(planned, scan=True, reason="full_product_scan")
+
+    key = scan_manifest_key(scan_mode, product, channel, download_site, os_name, os_ver, arch)
+    if manifest is not None:
+        entry = manifest.get(key)
+    else:
+        entry = read_scan_manifest_entry(os.path.join(data_repo_path, key)) if data_repo_path else None
+    if not entry:
+        return dict(planned, scan=True, reason="not scanned yet")
+    if entry.get("resolved_version") != resolved_version:
+        return dict(planned, scan=True, reason=f"new version {resolved_version} (last scanned {entry.get('resolved_version')})")
+    if db_identity and entry.get("sbom") and entry.get("grype_db") != db_identity:
+        return dict(planned, scan=True, reason=f"grype DB changed since {entry.get('timestamp_utc')} (rematch)")
+    return dict(planned, scan=False, reason=f"version {resolved_version} already scanned")
+
+def plan_native_targets(targets, data_repo_path, workers=8, db_identity=None, full_scan=False, base_url_override=""):
+    """
+    Resolve versions for a whole target matrix (concurrently) and decide which targets need a scan job.
+
+    db_identity, full_scan and base_url_override are passed to plan_native_target().
+
+    Returns:
+        List of plan_native_target() results, in input order
+    """
+    manifest = load_scan_manifest(data_repo_path)
+    if manifest is None:
+        print(f"No {SCAN_MANIFEST} in the data repo - reading each target's metadata.json")
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as pool:
+        return list(pool.map(lambda t: plan_native_target(t, manifest, data_repo_path, db_identity, full_scan, base_url_override), targets))
+
+def habitat_data_dir(data_repo_path, product, channel, os_name, arch, origin, name):
+    """Return the data-repo directory holding the {version}/index.json trees of a Habitat origin/name."""
+    return os.path.join(data_repo_path, "habitat", product, channel, os_name, arch, origin, name)
+
+# Per origin/name lookup table next to the version directories:
+# {"schema_version": "1.0", "idents": {ident: {"path": "{version}/index.json", ...}}}
+HABITAT_IDENT_INDEX = "ident-index.json"
+
+def habitat_ident_index_entry(index, rel_path):
+    """Build the ident-index.json record for one published index.json."""
+    grype = index.get("scan", {}).get("grype", {}) or {}
+    return {
+        "path": rel_path,
+        "timestamp_utc": index.get("snapshot", {}).get("timestamp_utc", ""),
+        "matches_total": index.get("summary", {}).get("total_matches", 0),
+        "grype_version": grype.get("version", ""),
+        "grype_db": grype_db_identity(grype.get("db") or {})
+    }
+
+def load_habitat_ident_index(origin_name_path):
+    """
+    Read {origin_name_path}/ident-index.json.
+
+    Returns:
+        The ident index dict, or None if it is missing or unreadable (callers then
+        fall back to reading the index.json files).
+    """
+    path = os.path.join(origin_name_path, HABITAT_IDENT_INDEX)
+    if not os.path.isfile(path):
+        return None
+    try:
+        ident_index = read_json(path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable {path}: {e}")
+        return None
+    if not isinstance(ident_index.get("idents"), dict):
+        return None
+    return ident_index
+
+def build_habitat_ident_index(origin_name_path):
+    """
+    Build an ident index from the {version}/index.json files under origin_name_path.
+
+    Returns:
+        Ident index dict (empty "idents" if the directory does not exist)
+    """
+    idents = {}
+    if os.path.isdir(origin_name_path):
+        for version_dir in sorted(os.listdir(origin_name_path)):
+            index_path = os.path.join(origin_name_path, version_dir, "index.json")
+            if not os.path.isfile(index_path):
+                continue
+            try:
+                index = read_json(index_path)
+            except (OSError, ValueError) as e:
+                print(f"Warning: skipping unreadable {index_path}: {e}")
+                continue
+            ident = index.get("target", {}).get("package", {}).get("ident", "")
+            if ident:
+                idents[ident] = habitat_ident_index_entry(index, f"{version_dir}/index.json")
+    return {"schema_version": "1.0", "idents": idents}
+
+def update_habitat_ident_index(out_dir, index_path, origin_name_path):
+    """
+    Record a freshly written index.json in {out_dir}/{origin}/{name}/ident-index.json.
+
+    The first update in a run starts from the published ident index in the data repo
+    (built from its index.json files if there is none yet), so the copy published
+    alongside the new index.json keeps every previously scanned ident.
+
+    Args:
+        out_dir: Output directory the index was written under
+        index_path: The index.json just written
+        origin_name_path: Data-repo directory of the same origin/name (see habitat_data_dir()); may be ""
+
+    Returns:
+        Path of the written ident-index.json
+    """
+    index = read_json(index_path)
+    package = index["target"]["package"]
+    out_origin_name_path = os.path.join(out_dir, package["origin"], package["name"])
+    ident_index = load_habitat_ident_index(out_origin_name_path)
+    if ident_index is None and origin_name_path:
+        ident_index = load_habitat_ident_index(origin_name_path) or build_habitat_ident_index(origin_name_path)
+    if ident_index is None:
+        ident_index = build_habitat_ident_index("")
+
+    # A version directory holds one index.json, so a new release replaces the old one's entry
+    rel_path = f"{package['version']}/index.json"
+    idents = {i: e for i, e in ident_index["idents"].items() if e.get("path") != rel_path}
+    idents[package["ident"]] = habitat_ident_index_entry(index, rel_path)
+    ident_index["idents"] = dict(sorted(idents.items()))
+
+    ident_index_path = os.path.join(out_origin_name_path, HABITAT_IDENT_INDEX)
+    write_json(ident_index, ident_index_path)
+    return ident_index_path
+
+def rebuild_habitat_ident_indexes(data_repo_path):
+    """
+    Rebuild every habitat/{product}/{channel}/{os}/{arch}/{origin}/{name}/ident-index.json in a data repo.
+
+    Returns:
+        Number of ident indexes written
+    """
+    written = 0
+    seen = set()
+    for index_path in sorted(glob.glob(os.path.join(data_repo_path, "habitat", "*", "*", "*", "*", "*", "*", "*", "index.json"))):
+        origin_name_path = os.path.dirname(os.path.dirname(index_path))
+        if origin_name_path in seen:
+            continue
+        seen.add(origin_name_path)
+        ident_index = build_habitat_ident_index(origin_name_path)
+        write_json(ident_index, os.path.join(origin_name_path, HABITAT_IDENT_INDEX))
+        print(f"Rebuilt {os.path.relpath(os.path.join(origin_name_path, HABITAT_IDENT_INDEX), data_repo_path)} ({len(ident_index['idents'])} idents)")
+        written += 1
+    return written
+
+def find_habitat_index(data_repo_path, product, channel, os_name, arch, hab_ident, resolved_version):
+    """
+    Find the published index.json for a Habitat package in the data repo.
+
+    Layout: habitat/{product}/{channel}/{os}/{arch}/{origin}/{name}/{version}/index.json
+
+    Uses {origin}/{name}/ident-index.json when present (one small read); otherwise
+    reads each version's index.json.
+
+    Args:
+        hab_ident: Requested ident (origin/name or origin/name/version/release)
+        resolved_version: Installed ident (origin/name/version/release) to look for
+
+    Returns:
+        Path of the index.json whose package ident equals resolved_version, or None.
+    """
+    parts = (hab_ident or "").split("/")
+    if not data_repo_path or not resolved_version or len(parts) < 2:
+        return None
+    origin_name_path = habitat_data_dir(data_repo_path, product, channel, os_name, arch, parts[0], parts[1])
+    if not os.path.isdir(origin_name_path):
+        return None
+    ident_index = load_habitat_ident_index(origin_name_path)
+    if ident_index is not None:
+        entry = ident_index["idents"].get(resolved_version)
+        index_path = os.path.join(origin_name_path, entry["path"]) if entry else None
+        return index_path if index_path and os.path.isfile(index_path) else None
+    for version_dir in os.listdir(origin_name_path):
+        index_path = os.path.join(origin_name_path, version_dir, "index.json")
+        if os.path.isfile(index_path):
+            index = read_json(index_path)
+            if index.get("target", {}).get("package", {}).get("ident", "") == resolved_version:
+                return index_path
+    return None
+
+def find_latest_habitat_index(data_repo_path, product, channel, os_name, arch, origin, name):
+    """
+    Find the most recently published index.json for origin/name (any version) in the data repo.
+
+    Uses {origin}/{name}/ident-index.json when present; otherwise reads each version's index.json.
+
+    Returns:
+        Path of the index.json with the newest snapshot timestamp, or None.
+    """
+    if not data_repo_path:
+        return None
+    origin_name_path = habitat_data_dir(data_repo_path, product, channel, os_name, arch, origin, name)
+    if not os.path.isdir(origin_name_path):
+        return None
+    latest_path, latest_ts = None, ""
+    ident_index = load_habitat_ident_index(origin_name_path)
+    if ident_index is not None:
+        for entry in ident_index["idents"].values():
+            index_path = os.path.join(origin_name_path, entry["path"])
+            if (latest_path is None or entry.get("timestamp_utc", "") > latest_ts) and os.path.isfile(index_path):
+                latest_path, latest_ts = index_path, entry.get("timestamp_utc", "")
+        return latest_path
+    for version_dir in os.listdir(origin_name_path):
+        index_path = os.path.join(origin_name_path, version_dir, "index.json")
+        if not os.path.isfile(index_path):
+            continue
+        try:
+            ts = read_json(index_path).get("snapshot", {}).get("timestamp_utc", "")
+        except (OSError, ValueError):
+            continue
+        if latest_path is None or ts > latest_ts:
+            latest_path, latest_ts = index_path, ts
+    return latest_path
+
+def check_existing_version(scan_mode, data_repo_path, product, channel, download_site, os_name, os_ver, arch, resolved_version=None, hab_ident=None):
+    """
+    Check if existing scan data matches the resolved version.
+    Returns (should_skip, reason) tuple.
+    For native mode: checks metadata.json in native/ path
+    For modern mode: checks metadata.json in modern/ path
+    For habitat mode: checks index.json and extracts version from directory structure
+    """
+    if not data_repo_path or not os.path.exists(data_repo_path):
+        return False, "No existing data repository found"
+    
+    try:
+        if scan_mode == "native":
+            # Native mode: check metadata.json
+            metadata_path = os.path.join(
+                data_repo_path,
+                "native",
+                product,
+                channel,
+                download_site,
+                os_name,
+                os_ver,
+                arch,
+                "metadata.json"
+            )
+            
+            if os.path.exists(metadata_path):
+                metadata = read_json(metadata_path)
+                existing_version = metadata.get("target", {}).get("resolved_version", "")
+                
+                print(f"Version comparison: existing='{existing_version}' vs resolved='{resolved_version}'")
+                if existing_version == resolved_version:
+                    return True, f"Version {resolved_version} already scanned (found in metadata.json)"
+                else:
+                    return False, f"Version mismatch: existing={existing_version}, resolved={resolved_version}"
+            
+            return False, "No existing metadata found"
+        
+        elif scan_mode == "habitat":
+            # Habitat mode: check for existing version directory under habitat/{product}/{channel}/{os}/{arch}/
+            # Structure: habitat/{product}/{channel}/{os}/{arch}/{origin}/{name}/{version}/index.json
+            hab_base_path = os.path.join(
+                data_repo_path,
+                "habitat",
+                product,
+                channel,
+                os_name,
+                arch
+            )
+            
+            if not os.path.exists(hab_base_path):
+                return False, "No existing habitat data found"
+            
+            # Compare full ident (origin/name/version/release) against each published index.json
+            if find_habitat_index(data_repo_path, product, channel, os_name, arch, hab_ident, resolved_version):
+                return True, f"Habitat package {resolved_version} already scanned (found in index.json)"
+            
+            return False, "No existing habitat scan or version mismatch"
+        
+        elif scan_mode == "modern":
+            # Modern mode: check metadata.json (same as native but under modern/ path)
+            metadata_path = os.path.join(
+                data_repo_path,
+                "modern",
+                product,
+                channel,
+                download_site,
+                os_name,
+                os_ver,
+                arch,
+                "metadata.json"
+            )
+            
+            if os.path.exists(metadata_path):
+                metadata = read_json(metadata_path)
+                existing_version = metadata.get("target", {}).get("resolved_version", "")
+                
+                print(f"Version comparison: existing='{existing_version}' vs resolved='{resolved_version}'")
+                if existing_version == resolved_version:
+                    return True, f"Version {resolved_version} already scanned (found in metadata.json)"
+                else:
+                    return False, f"Version mismatch: existing={existing_version}, resolved={resolved_version}"
+            
+            return False, "No existing metadata found"
+    
+    except Exception as e:
+        print(f"Warning: Error checking existing version: {e}")
+        return False, f"Error checking existing version: {e}"
+    
+    return False, "Unknown check result"
+
+def habitat_pkg_path(ident, os_name):
+    """Return the install path of a fully qualified Habitat ident (origin/name/version/release)."""
+    dep_origin, dep_name, dep_version, dep_release = ident.split("/")
+    if os_name == "windows":
+        return f"C:\\hab\\pkgs\\{dep_origin}\\{dep_name}\\{dep_version}\\{dep_release}"
+    return f"/hab/pkgs/{dep_origin}/{dep_name}/{dep_version}/{dep_release}"
+
+def read_habitat_ident_list(pkg_path, filename):
+    """
+    Read an ident-list metadata file (DEPS, TDEPS) of an installed Habitat package.
+
+    Falls back to `sudo cat` when the file is not readable by the current user.
+
+    Returns:
+        List of idents ([] when the package has no such file), or None if unreadable.
+    """
+    path = os.path.join(pkg_path, filename)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return []
+    except OSError:
+        rc, content, err = run(["bash", "-lc", f"sudo cat '{path}'"], check=False)
+        if rc != 0:
+            return None
+    return [line.strip() for line in content.split("\n") if line.strip() and "/" in line]
+
+habitat_closure_memo = {}
+
+def resolve_habitat_closure(ident, os_name, cache_dir=""):
+    """
+    Resolve the direct and transitive dependencies of an installed Habitat ident.
+
+    Reads the package's own DEPS/TDEPS files in-process (TDEPS is what
+    `hab pkg dependencies -t` prints), so no hab CLI or sudo round trip is needed.
+    Closures are memoised per ident in this process and, when cache_dir is set,
+    in the scan-result cache.
+
+    Args:
+        ident: Fully qualified ident (origin/name/version/release)
+        os_name: Target OS (selects /hab/pkgs vs C:\\hab\\pkgs)
+        cache_dir: Scan-result cache root (SCAN_CACHE_DIR); "" disables the on-disk memo
+
+    Returns:
+        Dict with "direct" and "transitive" ident lists (transitive includes the
+        direct deps, per Habitat's definition, but never ident itself)
+    """
+    if ident in habitat_closure_memo:
+        return habitat_closure_memo[ident]
+
+    entry_dir = None
+    if cache_dir:
+        key = habitat_deps_cache_key(ident)
+        entry_dir = os.path.join(cache_dir, key[:2], key)
+        try:
+            entry = read_json(os.path.join(entry_dir, "entry.json"))
+            if entry.get("ident") == ident:
+                touch_cache_entry(entry_dir)
+                closure = {"direct": entry["direct"], "transitive": entry["transitive"]}
+                habitat_closure_memo[ident] = closure
+                return closure
+        except (OSError, ValueError, KeyError):
+            pass
+
+    pkg_path = habitat_pkg_path(ident, os_name)
+    direct = read_habitat_ident_list(pkg_path, "DEPS") or []
+    transitive = read_habitat_ident_list(pkg_path, "TDEPS")
+    if transitive is None:
+        rc, out, err = run(["bash", "-lc", f"sudo hab pkg dependencies -t {ident}"], check=True)
+        transitive = [line.strip() for line in out.split("\n") if line.strip() and "/" in line]
+    closure = {"direct": direct, "transitive": [i for i in transitive if i != ident]}
+
+    if cache_dir:
+        store_cache_entry(cache_dir, habitat_deps_cache_key(ident), {}, dict(closure, ident=ident))
+    habitat_closure_memo[ident] = closure
+    return closure
+
+habitat_size_memo = {}
+habitat_size_memo_lock = threading.Lock()
+
+def habitat_ident_size(ident, os_name, cache_dir=""):
+    """
+    Installed size of a Habitat ident, memoised per (immutable) ident.
+
+    Looked up in this process first, then in the scan-result cache (when cache_dir
+    is set), and only then walked with get_directory_size().
+
+    Returns:
+        get_directory_size()-style dict
+    """
+    with habitat_size_memo_lock:
+        if ident in habitat_size_memo:
+            return habitat_size_memo[ident]
+
+    size = None
+    entry_dir = None
+    if cache_dir:
+        key = habitat_size_cache_key(ident)
+        entry_dir = os.path.join(cache_dir, key[:2], key)
+        try:
+            entry = read_json(os.path.join(entry_dir, "entry.json"))
+            if entry.get("ident") == ident:
+                size = entry["size"]
+                touch_cache_entry(entry_dir)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if size is None:
+        pkg_path = habitat_pkg_path(ident, os_name)
+        with timed_span("installed_size", ident=ident) as span:
+            # Serial: this runs on habitat scan-pool workers (no pool inside a pool)
+            size = get_directory_size(pkg_path, workers=1)
+            span["bytes"] = size["bytes"]
+        # Don't memoise partial results (size walk errors)
+        if "error" in size:
+            return size
+        if cache_dir:
+            store_cache_entry(cache_dir, habitat_size_cache_key(ident), {}, {"ident": ident, "size": size})
+
+    with habitat_size_memo_lock:
+        habitat_size_memo[ident] = size
+    return size
+
+def add_match_severity(sev_counts, m):
+    """Add one grype match to a count_severities() bucket dict."""
+    sev = (m.get("vulnerability", {}) or {}).get("severity", "Unknown") or "Unknown"
+    sev_norm = sev.strip().title()
+    if sev_norm in ("Negligible", "Minimal"):
+        sev_norm = "Negligible"
+    if sev_norm not in sev_counts:
+        sev_norm = "Unknown"
+    sev_counts[sev_norm] += 1
+
+def count_severities(matches):
+    """Bucket grype matches by normalized severity (Critical, High, Medium, Low, Negligible, Unknown)."""
+    buckets = ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]
+    sev_counts = {k: 0 for k in buckets}
+
+    for m in matches:
+        add_match_severity(sev_counts, m)
+
+    return sev_counts
+
+def load_cached_habitat_scan(ident, os_name, cache_dir, cache_salt, sbom=False):
+    """
+    Look up a Habitat ident in the scan-result cache.
+
+    Args:
+        sbom: Require the entry to carry an SBOM (SBOM_MODE write/rematch)
+
+    Returns:
+        A scan_habitat_ident()-style result with cache="hit", or None on a miss
+        (or when caching is disabled).
+    """
+    if not cache_dir or not cache_salt:
+        return None
+    cache_key = habitat_scan_cache_key(ident, *cache_salt)
+    entry_dir = os.path.join(cache_dir, cache_key[:2], cache_key)
+    try:
+        entry = read_json(os.path.join(entry_dir, "entry.json"))
+        cached_json_path = os.path.join(entry_dir, "grype.json")
+        cached_sbom_path = os.path.join(entry_dir, "sbom.json")
+        if entry.get("ident") != ident or not os.path.isfile(cached_json_path):
+            return None
+        if sbom and not os.path.isfile(cached_sbom_path):
+            return None
+        touch_cache_entry(entry_dir)
+        print(f"Cached dependency: {ident} - {entry['size']['human_readable']} ({entry['matches_total']} matches)")
+        return {
+            "json_path": cached_json_path,
+            "sbom_path": cached_sbom_path if sbom else None,
+            "scan_path": habitat_pkg_path(ident, os_name),
+            "matches_total": entry["matches_total"],
+            "severity_counts": entry["severity_counts"],
+            "size": entry["size"],
+            "timestamp_utc": now_utc(),
+            "cache": "hit"
+        }
+    except (OSError, ValueError, KeyError):
+        return None  # Missing or unreadable entry: scan normally
+
+def store_cached_habitat_scan(ident, result, cache_dir, cache_salt):
+    """Add a fresh scan_habitat_ident()-style result to the scan-result cache (marks it cache="miss")."""
+    # Don't cache partial results (size walk errors)
+    if not cache_dir or not cache_salt or "error" in result["size"]:
+        return
+    files = {"grype.json": result["json_path"]}
+    if result.get("sbom_path"):
+        files["sbom.json"] = result["sbom_path"]
+    store_cache_entry(cache_dir, habitat_scan_cache_key(ident, *cache_salt), files, {
+        "ident": ident,
+        "grype_version": cache_salt[0],
+        "db": cache_salt[1],
+        "created_utc": result["timestamp_utc"],
+        "matches_total": result["matches_total"],
+        "severity_counts": result["severity_counts"],
+        "size": result["size"]
+    })
+    result["cache"] = "miss"
+
+def staged_habitat_json_path(ident, staging_dir):
+    """Return (creating its directory) the staging path for an ident's grype JSON."""
+    dep_parts = ident.split("/")
+    staged_dir = os.path.join(staging_dir, *dep_parts[:3])
+    ensure_dir(staged_dir)
+    return os.path.join(staged_dir, f"{dep_parts[3]}.json")
+
+def scan_habitat_ident(ident, os_name, staging_dir, cache_dir="", cache_salt=None, sbom=False):
+    """
+    Run grype and the size calculation once for a single Habitat ident.
+
+    The pretty-printed grype JSON is written under staging_dir; write_habitat_dependency()
+    then copies it to every place the ident appears in the output tree (main, direct-deps,
+    transitive-deps).
+
+    Args:
+        ident: Fully qualified ident (origin/name/version/release)
+        os_name: Target OS (selects the /hab/pkgs vs C:\\hab\\pkgs scan path)
+        staging_dir: Directory for the staged scan JSON (e.g., {work_dir}/habitat-scans)
+        cache_dir: Scan-result cache root (SCAN_CACHE_DIR); "" disables the cache
+        cache_salt: (grype_version, db_identity) tuple; None disables the cache
+        sbom: Also keep a syft SBOM next to the staged JSON (SBOM_MODE write/rematch)
+
+    Returns:
+        Dict with json_path, sbom_path, scan_path, matches_total, severity_counts, size,
+        timestamp_utc and cache ("hit", "miss" or "off"), or None if the ident is
+        malformed or the scan failed. Safe to call from multiple threads for
+        distinct idents.
+    """
+    if len(ident.split("/")) != 4:
+        print(f"Skipping malformed dependency ident: {ident}")
+        return None
+
+    # Cache hit: skip both grype and the directory walk
+    cached = load_cached_habitat_scan(ident, os_name, cache_dir, cache_salt, sbom)
+    if cached:
+        return cached
+
+    dep_scan_path = habitat_pkg_path(ident, os_name)
+    staged_json_path = staged_habitat_json_path(ident, staging_dir)
+    staged_sbom_path = staged_json_path[:-len(".json")] + ".sbom.json" if sbom else None
+
+    # Calculate installed size for this Habitat package
+    dep_size = habitat_ident_size(ident, os_name, cache_dir)
+
+    # Run grype scan
+    try:
+        # Streamed straight to its pretty-printed form, counting severities on the way
+        matches_total, dep_sev_counts = grype_scan_to_file(f"dir:{dep_scan_path}", ident, staged_json_path, staged_sbom_path)
+
+        print(f"Scanned dependency: {ident} - {dep_size['human_readable']} ({matches_total} matches)")
+
+        result = {
+            "json_path": staged_json_path,
+            "sbom_path": staged_sbom_path,
+            "scan_path": dep_scan_path,
+            "matches_total": matches_total,
+            "severity_counts": dep_sev_counts,
+            "size": dep_size,
+            "timestamp_utc": now_utc(),
+            "cache": "off"
+        }
+        store_cached_habitat_scan(ident, result, cache_dir, cache_salt)
+        return result
+
+    except Exception as e:
+        print(f"Failed to scan dependency {ident}: {e}")
+        # Continue with other dependencies
+        return None
+
+def habitat_ident_from_location(location_path, pkgs_root):
+    """
+    Map a grype artifact location back to the Habitat ident that owns it.
+
+    Args:
+        location_path: artifact.locations[].path from grype JSON (absolute, or relative to the scan root)
+        pkgs_root: Habitat package root that was scanned (/hab/pkgs or C:\\hab\\pkgs)
+
+    Returns:
+        (ident, path_within_package) - e.g. ("core/glibc/2.35/20240105171810", "/lib/libc.so.6") -
+        or (None, None) if the path is not inside a package
+    """
+    path = location_path.replace("\\", "/")
+    root = pkgs_root.replace("\\", "/").rstrip("/")
+    # Windows paths may carry a drive letter (C:/hab/pkgs/...)
+    for prefix in (root, root.split(":", 1)[-1]):
+        if prefix and path.startswith(prefix + "/"):
+            path = path[len(prefix):]
+            break
+    parts = [p for p in path.split("/") if p]
+    if len(parts) < 4:
+        return None, None
+    return "/".join(parts[:4]), "/" + "/".join(parts[4:])
+
+def habitat_single_pass_excludes(pkgs_root, idents):
+    """
+    grype --exclude globs that keep a single-pass scan of pkgs_root to the given idents.
+
+    Every installed package outside idents is excluded at the highest directory level
+    (origin, name, version or release) that holds none of them.
+
+    Args:
+        pkgs_root: Habitat package root (/hab/pkgs or C:\\hab\\pkgs)
+        idents: Fully qualified idents to keep
+
+    Returns:
+        List of globs relative to pkgs_root (e.g., "./core/zlib/**")
+    """
+    wanted = {tuple(i.split("/")[:depth]) for i in idents for depth in range(1, 5)}
+    excludes = []
+
+    def walk(parts):
+        try:
+            names = sorted(e.name for e in os.scandir(os.path.join(pkgs_root, *parts)) if e.is_dir(follow_symlinks=False))
+        except OSError:
+            return
+        for name in names:
+            path = parts + (name,)
+            if path not in wanted:
+                excludes.append("./" + "/".join(path) + "/**")
+            elif len(path) < 4:
+                walk(path)
+
+    walk(())
+    return excludes
+
+def scan_habitat_single_pass(idents, os_name, staging_dir, workers, cache_dir="", cache_salt=None):
+    """
+    Scan a set of Habitat idents with a single grype run over the package root.
+
+    Installed packages outside `idents` (e.g., the hab CLI itself) are excluded from
+    the run (see habitat_single_pass_excludes()). Every ident is still reported
+    separately: grype's report is streamed, each match is attributed to the ident(s)
+    owning its artifact locations, and a per-ident grype document is written under
+    staging_dir with only those matches. Matches outside `idents` are dropped.
+    Installed sizes are computed by the worker pool while grype runs.
+
+    Args:
+        idents: Fully qualified idents to report (order is irrelevant)
+        os_name: Target OS (selects /hab/pkgs vs C:\\hab\\pkgs)
+        staging_dir: Directory for the staged per-ident JSON
+        workers: Worker pool size for the size calculations
+        cache_dir, cache_salt: Scan-result cache (see scan_habitat_ident); hits are
+            reused, misses are stored after partitioning
+
+    Returns:
+        Dict of ident -> scan_habitat_ident()-style result (None for malformed idents)
+
+    Raises:
+        RuntimeError: If the grype run fails (callers fall back to per-dep scanning)
+    """
+    results = {}
+    pending = []
+    for ident in idents:
+        if len(ident.split("/")) != 4:
+            print(f"Skipping malformed dependency ident: {ident}")
+            results[ident] = None
+            continue
+        cached = load_cached_habitat_scan(ident, os_name, cache_dir, cache_salt)
+        if cached:
+            results[ident] = cached
+        else:
+            pending.append(ident)
+
+    if not pending:
+        return results
+
+    pkgs_root = "C:\\hab\\pkgs" if os_name == "windows" else "/hab/pkgs"
+    combined_json_path = os.path.join(staging_dir, "single-pass.json")
+    spool_dir = os.path.join(staging_dir, "single-pass")
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    ensure_dir(spool_dir)
+    spool_paths = {ident: os.path.join(spool_dir, f"{n}.jsonl") for n, ident in enumerate(pending)}
+    excludes = habitat_single_pass_excludes(pkgs_root, pending)
+
+    # Partition matches (and ignored matches) by owning ident as grype's report streams in:
+    # each owned match is appended to its ident's spool file, so memory stays bounded by
+    # one match (plus the small top-level sections) rather than the whole closure's report
+    wanted = set(pending)
+    top_level = {}
+    dropped = 0
+
+    def partition(key, value, element):
+        nonlocal dropped
+        if not element:
+            top_level[key] = value
+            return
+        if key not in ("matches", "ignoredMatches"):
+            top_level.setdefault(key, []).append(value)
+            return
+        top_level[key] = []
+        # Group the artifact's locations by owning ident, rewriting each path to be
+        # relative to the package root (as a per-dep `grype dir:` scan reports it)
+        owned_locations = {}
+        for loc in (value.get("artifact", {}) or {}).get("locations", []) or []:
+            owner, rel_path = habitat_ident_from_location(loc.get("path", ""), pkgs_root)
+            if owner not in wanted:
+                continue
+            loc = dict(loc, path=rel_path)
+            if "accessPath" in loc:
+                loc["accessPath"] = habitat_ident_from_location(loc["accessPath"], pkgs_root)[1] or loc["accessPath"]
+            owned_locations.setdefault(owner, []).append(loc)
+        if not owned_locations:
+            dropped += 1
+        for owner, locations in owned_locations.items():
+            with open(spool_paths[owner], "a", encoding="utf-8") as f:
+                f.write(json.dumps([key, dict(value, artifact=dict(value["artifact"], locations=locations))]) + "\n")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        size_futures = {ident: pool.submit(habitat_ident_size, ident, os_name, cache_dir) for ident in pending}
+
+        print(f"Single-pass grype scan of {pkgs_root} for {len(pending)} idents ({len(excludes)} other paths excluded)...")
+        grype_scan_to_file(f"dir:{pkgs_root}", "habitat-closure", combined_json_path, excludes=excludes, fmt="compact", on_value=partition)
+
+        sizes = {ident: f.result() for ident, f in size_futures.items()}
+    if dropped:
+        print(f"Single-pass: {dropped} matches outside the dependency closure were dropped")
+
+    for ident in pending:
+        # Same document shape as a per-dep scan, restricted to this ident
+        partitioned = {key: [] for key in ("matches", "ignoredMatches") if key in top_level}
+        if os.path.exists(spool_paths[ident]):
+            with open(spool_paths[ident], "r", encoding="utf-8") as f:
+                for line in f:
+                    key, m = json.loads(line)
+                    partitioned[key].append(m)
+            os.remove(spool_paths[ident])
+        dep_doc = {}
+        for key, value in top_level.items():
+            if key in partitioned:
+                dep_doc[key] = partitioned[key]
+            elif key == "source" and isinstance(value, dict):
+                dep_doc[key] = dict(value, target=habitat_pkg_path(ident, os_name))
+                if "name" in value:
+                    dep_doc[key]["name"] = ident
+            else:
+                dep_doc[key] = value
+        staged_json_path = staged_habitat_json_path(ident, staging_dir)
+        write_json(dep_doc, staged_json_path)
+
+        dep_matches = dep_doc.get("matches", []) or []
+        dep_size = sizes[ident]
+        print(f"Scanned dependency: {ident} - {dep_size['human_readable']} ({len(dep_matches)} matches)")
+        results[ident] = {
+            "json_path": staged_json_path,
+            "scan_path": habitat_pkg_path(ident, os_name),
+            "matches_total": len(dep_matches),
+            "severity_counts": count_severities(dep_matches),
+            "size": dep_size,
+            "timestamp_utc": now_utc(),
+            "cache": "off"
+        }
+        store_cached_habitat_scan(ident, results[ident], cache_dir, cache_salt)
+
+    return results
+
+def write_habitat_dependency(dep_info, scan_result, main_pkg_dir):
+    """
+    Materialise a scanned ident into the output tree for one dependency entry.
+
+    Args:
+        dep_info: Dict with "ident" (origin/name/version/release) and "type" (main, direct, transitive)
+        scan_result: Result of scan_habitat_ident() for dep_info["ident"]
+        main_pkg_dir: Output directory of the main package ({out_dir}/{origin}/{name}/{version})
+
+    Returns:
+        The dep_results entry for index.json.
+    """
+    dep_ident = dep_info["ident"]
+    dep_type = dep_info["type"]
+    dep_origin, dep_name, dep_version, dep_release = dep_ident.split("/")
+    dep_size = scan_result["size"]
+
+    # Determine output location based on dependency type
+    if dep_type == "main":
+        # Main package files go directly in main_pkg_dir
+        dep_out_dir = main_pkg_dir
+        json_rel_path = f"{dep_release}.json"
+    elif dep_type == "direct":
+        # Direct dependencies go under direct-deps/{origin}/{name}/{version}/
+        dep_out_dir = os.path.join(main_pkg_dir, "direct-deps", dep_origin, dep_name, dep_version)
+        json_rel_path = f"direct-deps/{dep_origin}/{dep_name}/{dep_version}/{dep_release}.json"
+    else:  # transitive
+        # Transitive dependencies go under transitive-deps/{origin}/{name}/{version}/
+        dep_out_dir = os.path.join(main_pkg_dir, "transitive-deps", dep_origin, dep_name, dep_version)
+        json_rel_path = f"transitive-deps/{dep_origin}/{dep_name}/{dep_version}/{dep_release}.json"
+
+    ensure_dir(dep_out_dir)
+
+    dep_json_path = os.path.join(dep_out_dir, f"{dep_release}.json")
+    dep_metadata_path = os.path.join(dep_out_dir, f"{dep_release}.metadata.json")
+
+    copy_json(scan_result["json_path"], dep_json_path)
+    if scan_result.get("sbom_path"):
+        shutil.copyfile(scan_result["sbom_path"], os.path.join(dep_out_dir, f"{dep_release}.sbom.json"))
+
+    # Create per-dependency metadata
+    dep_metadata = {
+        "schema_version": "1.0",
+        "dependency": {
+            "ident": dep_ident,
+            "origin": dep_origin,
+            "name": dep_name,
+            "version": dep_version,
+            "release": dep_release,
+            "scan_path": scan_result["scan_path"],
+            "size": {
+                "installed_bytes": dep_size["bytes"],
+                "installed_human_readable": dep_size["human_readable"],
+                "file_count": dep_size["file_count"]
+            }
+        },
+        "scan": {
+            "timestamp_utc": scan_result["timestamp_utc"],
+            "matches_total": scan_result["matches_total"],
+            "severity_counts": scan_result["severity_counts"]
+        }
+    }
+    write_json(dep_metadata, dep_metadata_path)
+
+    # Track for rollup
+    return {
+        "ident": dep_ident,
+        "origin": dep_origin,
+        "name": dep_name,
+        "version": dep_version,
+        "release": dep_release,
+        "matches_total": scan_result["matches_total"],
+        "severity_counts": dict(scan_result["severity_counts"]),
+        "json_path": json_rel_path,
+        "dependency_type": dep_type,
+        "size": {
+            "installed_bytes": dep_size["bytes"],
+            "installed_human_readable": dep_size["human_readable"],
+            "file_count": dep_size["file_count"]
+        }
+    }
+
+def summarize_habitat_dependencies(dep_results):
+    """
+    Build the index.json rollup for a list of write_habitat_dependency() entries.
+
+    Returns:
+        (summary, size) tuple: the index "summary" section and the "target.size" section.
+    """
+    # Calculate aggregate counts
+    total_matches = sum(d["matches_total"] for d in dep_results)
+    aggregate_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
+    main_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
+    direct_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
+    transitive_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
+    for d in dep_results:
+        for sev, count in d["severity_counts"].items():
+            aggregate_counts[sev] += count
+        dtype = d.get("dependency_type", "main")
+        type_bucket = main_counts if dtype == "main" else direct_counts if dtype == "direct" else transitive_counts
+        for sev, count in d["severity_counts"].items():
+            type_bucket[sev] += count
+    
+    # Calculate aggregate size (total disk footprint of all dependencies)
+    total_size_bytes = sum(d.get("size", {}).get("installed_bytes", 0) for d in dep_results)
+    total_file_count = sum(d.get("size", {}).get("file_count", 0) for d in dep_results)
+    
+    # Format aggregate size
+    size_bytes = total_size_bytes
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size_bytes < 1024.0 or unit == 'TB':
+            total_size_human = f"{size_bytes:.2f} {unit}"
+            break
+        size_bytes = size_bytes / 1024.0
+    
+    summary = {
+        "dependencies_scanned": len(dep_results),
+        "total_matches": total_matches,
+        "aggregate_severity_counts": aggregate_counts,
+        "main_severity_counts": main_counts,
+        "direct_severity_counts": direct_counts,
+        "transitive_severity_counts": transitive_counts
+    }
+    size = {
+        "total_installed_bytes": total_size_bytes,
+        "total_installed_human_readable": total_size_human,
+        "total_file_count": total_file_count
+    }
+    return summary, size
+
+def index_size_to_scan_size(dep_size):
+    """Convert an index.json dependency "size" section back to get_directory_size() form."""
+    return {
+        "bytes": dep_size.get("installed_bytes", 0),
+        "human_readable": dep_size.get("installed_human_readable", "0.00 B"),
+        "file_count": dep_size.get("file_count", 0)
+    }
+
+def rematch_habitat_ident(ident, sbom_path, dep_size, os_name, staging_dir):
+    """
+    Match one ident's stored SBOM against the current grype DB.
+
+    Args:
+        dep_size: The ident's "size" section from a previous index.json (carried over as-is)
+
+    Returns:
+        A scan_habitat_ident()-style result, or None if grype failed.
+    """
+    staged_json_path = staged_habitat_json_path(ident, staging_dir)
+    try:
+        matches_total, sev_counts = rematch_sbom(sbom_path, ident, staged_json_path)
+    except RuntimeError as e:
+        print(f"Rematch failed for {ident}: {str(e)[:200]}")
+        return None
+    print(f"Rematched dependency: {ident} ({matches_total} matches)")
+    return {
+        "json_path": staged_json_path,
+        "sbom_path": sbom_path,
+        "scan_path": habitat_pkg_path(ident, os_name),
+        "matches_total": matches_total,
+        "severity_counts": sev_counts,
+        "size": index_size_to_scan_size(dep_size),
+        "timestamp_utc": now_utc(),
+        "cache": "off"
+    }
+
+def reuse_previous_habitat_scans(prev_index_path, idents, os_name, staging_dir, workers, grype_version, db_identity, sbom=False):
+    """
+    Carry dependency results forward from a previously published index.json.
+
+    Fully qualified idents are immutable, so an ident that was already scanned for an
+    earlier release of the same package only needs its matches refreshed:
+
+    - same grype version and DB: the previous JSON is copied forward unchanged
+    - different DB, SBOM stored next to the previous JSON: the SBOM is re-matched
+    - otherwise the ident is left out and must be scanned
+
+    Args:
+        prev_index_path: Previous index.json in the data repo (see find_latest_habitat_index())
+        idents: Unique idents of the newly resolved closure
+        os_name: Target OS (recorded scan_path)
+        staging_dir: Directory for staged (re-matched) grype JSON
+        workers: Maximum concurrent grype runs
+        grype_version: Installed grype version
+        db_identity: Current grype DB identity (see grype_db_identity())
+        sbom: SBOM_MODE is enabled; results without a stored SBOM are not reused
+
+    Returns:
+        Dict of ident -> scan_habitat_ident()-style result with an extra "incremental"
+        key ("copied" or "rematched").
+    """
+    prev_dir = os.path.dirname(prev_index_path)
+    prev_index = read_json(prev_index_path)
+    prev_grype = prev_index.get("scan", {}).get("grype", {})
+    same_db = bool(db_identity) and grype_version == prev_grype.get("version") and db_identity == grype_db_identity(prev_grype.get("db") or {})
+
+    wanted = set(idents)
+    copied, to_rematch = {}, {}
+    for dep in prev_index.get("dependencies", []) or []:
+        ident = dep["ident"]
+        if ident not in wanted or ident in copied or ident in to_rematch:
+            continue
+        json_path = os.path.join(prev_dir, dep["json_path"])
+        sbom_path = json_path[:-len(".json")] + ".sbom.json"
+        has_sbom = os.path.isfile(sbom_path)
+        if same_db and os.path.isfile(json_path) and (has_sbom or not sbom):
+            try:
+                prev_metadata = read_json(json_path[:-len(".json")] + ".metadata.json")
+                timestamp = prev_metadata["scan"]["timestamp_utc"]
+            except (OSError, ValueError, KeyError):
+                timestamp = prev_index.get("snapshot", {}).get("timestamp_utc", "")
+            copied[ident] = {
+                "json_path": json_path,
+                "sbom_path": sbom_path if has_sbom and sbom else None,
+                "scan_path": habitat_pkg_path(ident, os_name),
+                "matches_total": dep["matches_total"],
+                "severity_counts": dict(dep["severity_counts"]),
+                "size": index_size_to_scan_size(dep.get("size", {})),
+                "timestamp_utc": timestamp,
+                "cache": "off",
+                "incremental": "copied"
+            }
+        elif has_sbom:
+            to_rematch[ident] = (sbom_path, dep.get("size", {}))
+
+    reused = dict(copied)
+    if to_rematch:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_rematch)))) as pool:
+            for ident, result in zip(to_rematch, pool.map(
+                    lambda i: rematch_habitat_ident(i, to_rematch[i][0], to_rematch[i][1], os_name, staging_dir), to_rematch)):
+                if result:
+                    result["incremental"] = "rematched"
+                    if not sbom:
+                        result["sbom_path"] = None
+                    reused[ident] = result
+    return reused
+
+def rematch_habitat_index(prev_index_path, out_dir, work_dir, os_name, workers):
+    """
+    Re-match a published habitat scan against the current grype DB using its stored SBOMs.
+
+    Every dependency in the previous index.json needs a <release>.sbom.json next to its
+    <release>.json (written by SBOM_MODE=write/rematch). Nothing is walked or cataloged:
+    sizes and dependency layout are carried over from the previous index.
+
+    Args:
+        prev_index_path: index.json in the data repo (see find_habitat_index())
+        out_dir: Output directory; the rewritten tree goes to {out_dir}/{origin}/{name}/{version}/
+        work_dir: Working directory for staged grype JSON
+        os_name: Target OS (recorded scan_path)
+        workers: Maximum concurrent grype runs
+
+    Returns:
+        Path of the rewritten index.json, or None when the DB is unchanged, an SBOM is
+        missing or a rematch failed (the caller then falls back to a normal skip).
+    """
+    prev_dir = os.path.dirname(prev_index_path)
+    prev_index = read_json(prev_index_path)
+    prev_deps = prev_index.get("dependencies", []) or []
+
+    db_info, prev_db_identity = rematch_db_info(prev_index.get("scan", {}).get("grype", {}).get("db"))
+    if db_info is None:
+        return None
+
+    # One stored SBOM per unique ident (direct deps appear twice in the tree)
+    stored = {}
+    for dep in prev_deps:
+        sbom_path = os.path.join(prev_dir, dep["json_path"][:-len(".json")] + ".sbom.json")
+        if not os.path.isfile(sbom_path):
+            print(f"Rematch: no stored SBOM for {dep['ident']} ({dep['json_path']}) - falling back to skip")
+            return None
+        stored.setdefault(dep["ident"], (sbom_path, dep.get("size", {})))
+
+    staging_dir = os.path.join(work_dir, "habitat-rematch")
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(stored)))) as pool:
+        results = dict(zip(stored, pool.map(
+            lambda i: rematch_habitat_ident(i, stored[i][0], stored[i][1], os_name, staging_dir), stored)))
+    if any(r is None for r in results.values()):
+        return None
+
+    package = prev_index["target"]["package"]
+    main_pkg_dir = os.path.join(out_dir, package["origin"], package["name"], package["version"])
+    ensure_dir(main_pkg_dir)
+    dep_results = [
+        write_habitat_dependency({"ident": d["ident"], "type": d.get("dependency_type", "main")}, results[d["ident"]], main_pkg_dir)
+        for d in prev_deps
+    ]
+    summary, size = summarize_habitat_dependencies(dep_results)
+
+    index = dict(prev_index)
+    index["snapshot"] = pipeline_snapshot()
+    index["target"] = dict(prev_index["target"], size=size)
+    index["scan"] = {
+        "mode": "habitat",
+        "grype": {"version": grype_toolchain()["version"], "db": db_info},
+        "sbom": {"format": "syft-json"},
+        "rematch": {
+            "previous_db": prev_db_identity,
+            "previous_timestamp_utc": prev_index.get("snapshot", {}).get("timestamp_utc", "")
+        }
+    }
+    index["summary"] = summary
+    index["dependencies"] = dep_results
+    index["timings"] = timing_section(idents={d["ident"] for d in prev_deps})
+
+    index_path = os.path.join(main_pkg_dir, "index.json")
+    write_json(index, index_path)
+    print(f"Rematched {len(dep_results)} dependencies with {summary['total_matches']} total matches")
+    return index_path
+
+def rematch_native_target(prev_dir, product, scanners_dir, out_dir, fmt=None):
+    """
+    Re-match a published native/modern scan against the current grype DB using its stored SBOM.
+
+    Args:
+        prev_dir: Data-repo directory with metadata.json and sbom.json (see native_data_dir())
+        product: Name recorded in the grype report
+        scanners_dir: {out_dir}/scanners
+        out_dir: Output directory (legacy latest.json/metadata.json/sbom.json copies)
+        fmt: One of JSON_OUTPUT_FORMATS for the rewritten reports (default: json_output_format)
+
+    Returns:
+        Path of the rewritten grype.metadata.json, or None when the DB is unchanged or no
+        SBOM was stored (the caller then falls back to a normal skip).
+    """
+    prev_sbom_path = os.path.join(prev_dir, "sbom.json")
+    if not os.path.isfile(prev_sbom_path):
+        print(f"Rematch: no stored SBOM at {prev_sbom_path} - falling back to skip")
+        return None
+    prev_metadata = read_json(os.path.join(prev_dir, "metadata.json"))
+
+    db_info, prev_db_identity = rematch_db_info(prev_metadata.get("scan", {}).get("grype", {}).get("db"))
+    if db_info is None:
+        return None
+
+    grype_latest_json = os.path.join(scanners_dir, "grype.latest.json")
+    sbom_path = os.path.join(scanners_dir, "syft.sbom.json")
+    shutil.copyfile(prev_sbom_path, sbom_path)
+    matches_total, sev_counts = rematch_sbom(sbom_path, product, grype_latest_json, fmt)
+
+    grype_metadata = dict(prev_metadata)
+    grype_metadata["snapshot"] = pipeline_snapshot()
+    grype_metadata["scan"] = dict(prev_metadata.get("scan", {}))
+    grype_metadata["scan"]["grype"] = {"version": grype_toolchain()["version"], "db": db_info}
+    grype_metadata["scan"]["rematch"] = {
+        "previous_db": prev_db_identity,
+        "previous_timestamp_utc": prev_metadata.get("snapshot", {}).get("timestamp_utc", "")
+    }
+    grype_metadata["summary"] = {
+        "matches_total": matches_total,
+        "severity_counts": sev_counts
+    }
+    grype_metadata["timings"] = timing_section(getattr(timing_context, "target", None))
+
+    grype_metadata_path = os.path.join(scanners_dir, "grype.metadata.json")
+    write_json(grype_metadata, grype_metadata_path, fmt)
+
+    shutil.copy2(grype_latest_json, os.path.join(out_dir, "latest.json"))
+    shutil.copy2(grype_metadata_path, os.path.join(out_dir, "metadata.json"))
+    shutil.copy2(sbom_path, os.path.join(out_dir, "sbom.json"))
+    print(f"Rematched {product}: {matches_total} matches")
+    return grype_metadata_path
+
+def install_habitat_package(pkg_ident, channel, auth_token=""):
+    """
+    Install a Habitat package with `sudo hab pkg install` and return its installed ident.
+
+    Args:
+        pkg_ident: origin/name (latest in channel) or a more qualified ident
+        channel: Habitat channel ("stable" needs no --channel)
+        auth_token: HAB_AUTH_TOKEN for protected packages (including chef/* in stable)
+
+    Returns:
+        Fully qualified ident (origin/name/version/release) of the installed package
+
+    Raises:
+        RuntimeError: If the install fails or the package path cannot be parsed
+    """
+    # Install the package (with channel if specified) - requires sudo for /hab/pkgs/ access
+    # Note: Chef packages now require HAB_AUTH_TOKEN even for stable channel
+    install_cmd = f"sudo hab pkg install {pkg_ident}"
+    if channel and channel != "stable":
+        install_cmd += f" --channel {channel}"
     
-    # Calculate aggregate counts
-    total_matches = sum(d["matches_total"] for d in dep_results)
-    aggregate_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
-    main_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
-    direct_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
-    transitive_counts = {k: 0 for k in ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]}
-    for d in dep_results:
-        for sev, count in d["severity_counts"].items():
-            aggregate_counts[sev] += count
-        dtype = d.get("dependency_type", "main")
-        type_bucket = main_counts if dtype == "main" else direct_counts if dtype == "direct" else transitive_counts
-        for sev, count in d["severity_counts"].items():
-            type_bucket[sev] += count
-    
-    # Calculate aggregate size (total disk footprint of all dependencies)
-    total_size_bytes = sum(d.get("size", {}).get("installed_bytes", 0) for d in dep_results)
-    total_file_count = sum(d.get("size", {}).get("file_count", 0) for d in dep_results)
+    # Set HAB_AUTH_TOKEN if provided (required for protected packages including chef/* in stable)
+    if auth_token:
+        if channel and channel != "stable":
+            install_cmd = f"sudo HAB_AUTH_TOKEN={auth_token} hab pkg install {pkg_ident} --channel {channel}"
+        else:
+            install_cmd = f"sudo HAB_AUTH_TOKEN={auth_token} hab pkg install {pkg_ident}"
     
-    # Format aggregate size
-    size_bytes = total_size_bytes
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size_bytes < 1024.0 or unit == 'TB':
-            total_size_human = f"{size_bytes:.2f} {unit}"
-            break
-        size_bytes = size_bytes / 1024.0
+    run(["bash", "-lc", install_cmd], check=True)
     
-    # GitHub Actions context
-    gha_run_id = env("GITHUB_RUN_ID", "")
-    repo = env("GITHUB_REPOSITORY", "")
-    workflow = env("GITHUB_WORKFLOW", "")
-    sha = env("GITHUB_SHA", "")
+    # Get installed package details
+    rc, out, err = run(["bash", "-lc", f"sudo hab pkg path {pkg_ident}"], check=True)
+    installed_path = out.strip()
     
+    # Parse origin/name/version/release from path
+    # Expected: /hab/pkgs/<origin>/<name>/<version>/<release> or C:\hab\pkgs\<origin>\<name>\<version>\<release>
+    path_parts = installed_path.replace("\\", "/").split("/")
+    if len(path_parts) < 4:
+        raise RuntimeError(f"Unable to parse habitat package path: {installed_path}")
+    return "/".join(path_parts[-4:])
+
+def list_habitat_origin_packages(origin, channel):
+    """
+    Enumerate the packages of an origin in a Habitat Builder channel.
+
+    Pages through /v1/depot/channels/{origin}/{channel}/pkgs on HAB_BLDR_URL
+    (default https://bldr.habitat.sh), authenticating with HAB_AUTH_TOKEN from the
+    environment when set.
+
+    Returns:
+        Sorted list of unique "origin/name" idents
+    """
+    bldr_url = env("HAB_BLDR_URL", "https://bldr.habitat.sh").rstrip("/")
+    headers = {"Authorization": f"Bearer {env('HAB_AUTH_TOKEN')}"} if env("HAB_AUTH_TOKEN", "") else {}
+    names = set()
+    range_start = 0
+    while True:
+        url = f"{bldr_url}/v1/depot/channels/{origin}/{channel}/pkgs?range={range_start}"
+        page = http_json(url, headers=headers, retry_config={"max_retries": 5, "base_delay": 2, "max_delay": 30})
+        for pkg in page.get("data", []) or []:
+            names.add(f"{pkg['origin']}/{pkg['name']}")
+        range_end = int(page.get("range_end", range_start))
+        if not page.get("data") or range_end + 1 >= int(page.get("total_count", 0)):
+            break
+        range_start = range_end + 1
+    return sorted(names)
+
+def habitat_deps_to_scan(main_ident, closure):
+    """
+    Build the dependency entries for a package: main + direct deps + all transitive deps.
+
+    Direct deps appear twice (once in direct-deps/, once in transitive-deps/);
+    each unique ident is scanned once and its result written to both places.
+    Each entry is tagged with its type for proper directory placement.
+    """
+    deps_to_scan = [
+        {"ident": main_ident, "type": "main"},
+    ]
+    for ident in closure["direct"]:
+        deps_to_scan.append({"ident": ident, "type": "direct"})
+    for ident in closure["transitive"]:
+        deps_to_scan.append({"ident": ident, "type": "transitive"})
+    return deps_to_scan
+
+def write_habitat_index(out_dir, product, channel, main_ident, deps_to_scan, scan_results, environment, scan):
+    """
+    Write one package's output tree ({out_dir}/{origin}/{name}/{version}/) and its index.json.
+
+    Args:
+        product: Product recorded in target.product
+        channel: Habitat channel
+        main_ident: Fully qualified ident of the package
+        deps_to_scan: Entries from habitat_deps_to_scan()
+        scan_results: ident -> scan_habitat_ident()-style result (None entries are skipped)
+        environment: index.json "environment" section
+        scan: index.json "scan" section
+
+    Returns:
+        (index_path, summary, target_size) tuple
+    """
+    origin, name, version, release = main_ident.split("/")
+
+    # Create main package directory structure: {origin}/{name}/{version}/
+    main_pkg_dir = os.path.join(out_dir, origin, name, version)
+    ensure_dir(main_pkg_dir)
+
+    dep_results = []
+    for dep_info in deps_to_scan:
+        scan_result = scan_results.get(dep_info["ident"])
+        if scan_result is None:
+            continue
+        dep_results.append(write_habitat_dependency(dep_info, scan_result, main_pkg_dir))
+
+    # Create index.json rollup
+    summary, target_size = summarize_habitat_dependencies(dep_results)
     index = {
         "schema_version": "1.0",
-        "snapshot": {
-            "timestamp_utc": now_utc(),
-            "run_id": f"gha-{gha_run_id}" if gha_run_id else "",
-            "pipeline": {"repo": repo, "workflow": workflow, "git_sha": sha}
-        },
+        "snapshot": pipeline_snapshot(),
         "target": {
             "product": product,
-            "channel": hab_channel,
+            "channel": channel,
             "package": {
                 "ident": main_ident,
                 "origin": origin,
@@ -823,50 +3624,144 @@ if scan_mode == "habitat":
                 "version": version,
                 "release": release
             },
-            "size": {
-                "total_installed_bytes": total_size_bytes,
-                "total_installed_human_readable": total_size_human,
-                "total_file_count": total_file_count
-            }
-        },
-        "environment": {
-            "runner": env("RUNNER_OS", ""),
-            "os": os_name,
-            "os_version": os_ver,
-            "arch": arch
-        },
-        "scan": {
-            "mode": "habitat",
-            "grype": {"version": grype_version, "db": db_info}
-        },
-        "summary": {
-            "dependencies_scanned": len(dep_results),
-            "total_matches": total_matches,
-            "aggregate_severity_counts": aggregate_counts,
-            "main_severity_counts": main_counts,
-            "direct_severity_counts": direct_counts,
-            "transitive_severity_counts": transitive_counts
+            "size": target_size
         },
-        "dependencies": dep_results
+        "environment": environment,
+        "scan": scan,
+        "summary": summary,
+        "dependencies": dep_results,
+        "timings": timing_section(idents={main_ident} | {d["ident"] for d in deps_to_scan})
     }
-    
+
     # Write index.json in the main package directory
     index_path = os.path.join(main_pkg_dir, "index.json")
-    json.dump(index, open(index_path, "w", encoding="utf-8"), indent=2)
-    
-    # Write resolved_version for workflow outputs (keep in out_dir root for workflow to find)
-    write_text(os.path.join(out_dir, "_resolved_version.txt"), resolved_version)
-    write_text(os.path.join(out_dir, "_download_url_redacted.txt"), f"habitat://{main_ident}@{hab_channel}")
-    
-    print(f"Wrote habitat index: {index_path}")
-    print(f"Scanned {len(dep_results)} dependencies with {total_matches} total matches")
-    print(f"Total installed size: {total_size_human} ({total_file_count:,} files)")
-    print(f"::notice::✓ Habitat scan completed for {product} {hab_channel}: {main_ident} with {len(dep_results)} dependencies ({total_matches} total vulnerabilities, {total_size_human} disk footprint)")
+    write_json(index, index_path)
+    return index_path, summary, target_size
+
+# Per-run settings of a native/modern target (action input names). A batch target or worker
+# job file may set any of them; the rest come from the process environment.
+NATIVE_JOB_SETTINGS = ("scan_root", "base_url_override", "data_repo_path", "full_product_scan", "sbom_mode",
+                       "output_format", "download_segments", "package_cache_dir", "package_cache_max_mb",
+                       "stream_extract", "extract_filter", "extract_verify", "size_walk_workers")
+
+def native_job_settings(target):
+    """
+    Resolve the per-run settings of a native/modern target (see NATIVE_JOB_SETTINGS).
+
+    Args:
+        target: Target dict; a setting it leaves unset (or empty) takes the process's value
+
+    Returns:
+        Dict of the settings, parsed and validated like the action inputs
+
+    Raises:
+        RuntimeError: If a setting is invalid
+    """
+    defaults = {
+        "scan_root": scan_root,
+        "base_url_override": base_url_override,
+        "data_repo_path": data_repo_path,
+        "full_product_scan": full_product_scan,
+        "sbom_mode": sbom_mode,
+        "output_format": json_output_format,
+        "download_segments": download_segments,
+        "package_cache_dir": package_cache_dir,
+        "package_cache_max_mb": package_cache_max_mb,
+        "stream_extract": stream_extract,
+        "extract_filter": extract_filter,
+        "extract_verify": extract_verify,
+        "size_walk_workers": size_walk_workers
+    }
+    settings = {}
+    for name, default in defaults.items():
+        value = target.get(name)
+        if value is None or value == "":
+            settings[name] = default
+        elif isinstance(default, bool):
+            settings[name] = str(value).lower() in ("true", "1", "yes")
+        elif isinstance(default, int):
+            try:
+                settings[name] = int(value)
+            except (TypeError, ValueError):
+                raise RuntimeError(f"Invalid {name.upper()} '{value}' (expected a number)")
+        elif name.endswith("_dir"):
+            settings[name] = os.path.expanduser(str(value))
+        elif name in ("sbom_mode", "output_format", "extract_filter"):
+            settings[name] = str(value).strip().lower()
+        else:
+            settings[name] = str(value)
+
+    if settings["sbom_mode"] not in ("off", "write", "rematch"):
+        raise RuntimeError(f"Invalid SBOM_MODE '{settings['sbom_mode']}' (expected 'off', 'write' or 'rematch')")
+    if settings["output_format"] not in JSON_OUTPUT_FORMATS:
+        raise RuntimeError(f"Invalid OUTPUT_FORMAT '{settings['output_format']}' (expected one of {', '.join(JSON_OUTPUT_FORMATS)})")
+    if settings["output_format"] == "zstd":
+        zstd_module()  # Fail before scanning if the optional dependency is missing
+    if settings["extract_filter"] not in ("off", "scannable"):
+        raise RuntimeError(f"Invalid EXTRACT_FILTER '{settings['extract_filter']}' (expected 'off' or 'scannable')")
+    if settings["download_segments"] < 1:
+        raise RuntimeError(f"Invalid DOWNLOAD_SEGMENTS '{settings['download_segments']}' (expected 1 or more)")
+    if settings["size_walk_workers"] < 1:
+        raise RuntimeError(f"Invalid SIZE_WALK_WORKERS '{settings['size_walk_workers']}' (expected 1 or more)")
+    return settings
+
+def native_target_job(target, out_dir, work_dir, license_id):
+    """
+    Build the job dict the native/modern stages below pass along.
+
+    Args:
+        target: Dict of action inputs (product, channel, download_site, os, os_version, arch,
+                package_manager, scan_mode, resolve_version, pinned_version), as for plan-targets,
+                plus any of the per-run settings in NATIVE_JOB_SETTINGS
+        out_dir: Output directory of this target (scanners/ is created in it)
+        work_dir: Scratch directory of this target (package + extracted tree)
+        license_id: License id for the target's download site
+
+    Returns:
+        Job dict (with the settings of native_job_settings()); the stages add their results to it
+
+    Raises:
+        RuntimeError: If a per-run setting is invalid
+    """
+    settings = native_job_settings(target)
+    job = {
+        "product": target["product"],
+        "channel": target["channel"],
+        "download_site": target.get("download_site") or "commercial",
+        "os_name": target.get("os") or "ubuntu",
+        "os_ver": target.get("os_version") or "",
+        "arch": target.get("arch") or "x86_64",
+        "package_manager": target.get("package_manager") or "",
+        "scan_mode": target.get("scan_mode") or "native",
+        "resolve_ver": target.get("resolve_version") or "latest",
+        "pinned_ver": target.get("pinned_version") or "",
+        "license_id": license_id,
+        "out_dir": out_dir,
+        "work_dir": work_dir,
+        "scanners_dir": os.path.join(out_dir, "scanners"),
+        **settings
+    }
+    ensure_dir(out_dir)
+    ensure_dir(work_dir)
+    ensure_dir(job["scanners_dir"])
+    return job
+
+def prepare_native_job(job):
+    """
+    Resolve the target's version and download URL, or settle it without a scan.
+
+    Writes the resolved version outputs and _download_url_redacted.txt. An already scanned
+    version writes _skipped.txt instead (or is rematched under SBOM_MODE=rematch).
+
+    Returns:
+        True if the target needs a download and scan; job["status"] is "skipped" or
+        "rematched" otherwise
+    """
+    product, channel, download_site = job["product"], job["channel"], job["download_site"]
+    os_name, os_ver, arch, package_manager = job["os_name"], job["os_ver"], job["arch"], job["package_manager"]
+    scan_mode, license_id, out_dir = job["scan_mode"], job["license_id"], job["out_dir"]
+    base_url_override, data_repo_path, sbom_mode = job["base_url_override"], job["data_repo_path"], job["sbom_mode"]
 
-else:
-    # NATIVE/MODERN MODE: Download + extract + scan logic
-    # (modern mode is identical to native but uses /modern/ path for next-gen products)
-    
     # Guard: commercial downloads require a license_id (fail fast with a clear error)
     # CINC downloads don't require license_id
     if download_site == "commercial" and not license_id.strip():
@@ -875,156 +3770,25 @@ else:
             "Fix by scoping GA_DOWNLOAD_GRYPE_LICENSE_ID to the orchestrator repo and passing it into the composite action, "
             "or switch DOWNLOAD_SITE to 'community' for targets that do not require licensing."
         )
-    
+
     # Map product name for CINC downloads (chef -> cinc, inspec -> cinc-auditor, etc.)
     api_product = map_cinc_product_name(product) if download_site == "cinc" else product
-    
+
     # Choose base URL (support override for alternative download sites)
+    base = native_download_base(download_site, base_url_override)
     if base_url_override:
-        base = base_url_override.rstrip("/")
         print(f"Using base URL override: {base}")
-    elif download_site == "cinc":
-        base = "https://omnitruck.cinc.sh"
-    else:
-        base = "https://chefdownload-commercial.chef.io" if download_site == "commercial" else "https://chefdownload-community.chef.io"
 
     # Resolve version
-    resolved_version = pinned_ver
-    if resolve_ver == "latest" or not resolved_version:
-        # For stable channel, implement major version matching logic
-        # to ensure we compare stable against the same major version as current
-        if channel == "stable":
-            try:
-                print("🔍 Major version matching enabled for stable channel")
-                
-                # Step 1: Get the latest version from current channel
-                current_ver_url = f"{base}/current/{api_product}/versions/latest"
-                if license_id and download_site != "cinc":
-                    current_ver_url += f"?license_id={license_id}"
-                
-                print(f"Fetching current channel latest: {current_ver_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
-                current_ver_doc = http_json(current_ver_url)
-                
-                current_version = None
-                if isinstance(current_ver_doc, dict):
-                    current_version = (
-                        current_ver_doc.get("version")
-                        or current_ver_doc.get("latest")
-                        or current_ver_doc.get("artifact_version")
-                        or current_ver_doc.get("value")
-                    )
-                    if not current_version:
-                        current_version = str(current_ver_doc)
-                else:
-                    current_version = str(current_ver_doc).strip().strip('"')
-                
-                print(f"Current channel latest version: {current_version}")
-                
-                # Step 2: Extract major version from current
-                current_major = get_major_version(current_version)
-                
-                if current_major is not None:
-                    print(f"Current channel major version: {current_major}")
-                    
-                    # Step 3: Get all stable versions
-                    stable_all_url = f"{base}/stable/{api_product}/versions/all"
-                    if license_id and download_site != "cinc":
-                        stable_all_url += f"?license_id={license_id}"
-                    
-                    print(f"Fetching all stable versions: {stable_all_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
-                    stable_all_versions = http_json(stable_all_url)
-                    
-                    if isinstance(stable_all_versions, list) and stable_all_versions:
-                        print(f"Found {len(stable_all_versions)} stable versions")
-                        
-                        # Step 4: Find the best matching version in stable
-                        best_stable = find_best_stable_version_for_major(stable_all_versions, current_major)
-                        
-                        if best_stable:
-                            print(f"✅ Best stable version matching major {current_major}: {best_stable}")
-                            resolved_version = best_stable
-                        else:
-                            print(f"⚠️  No stable version found matching major {current_major}, falling back to /latest")
-                            # Fall back to regular latest logic below
-                            resolved_version = None
-                    else:
-                        print(f"⚠️  Could not fetch stable versions list, falling back to /latest")
-                        resolved_version = None
-                else:
-                    print(f"⚠️  Could not parse major version from current ({current_version}), falling back to /latest")
-                    resolved_version = None
-                    
-            except Exception as e:
-                print(f"⚠️  Major version matching failed: {e}")
-                print(f"   Falling back to standard /latest endpoint")
-                resolved_version = None
-        
-        # Fall back to standard /latest logic if major version matching was skipped or failed
-        if not resolved_version:
-            ver_url = f"{base}/{channel}/{api_product}/versions/latest"
-            # Commercial and community require license_id, but CINC does not
-            if license_id and download_site != "cinc":
-                ver_url += f"?license_id={license_id}"
-            
-            print(f"Fetching latest version from: {ver_url.split('?')[0]}{'?license_id=***' if license_id and download_site != 'cinc' else ''}")
-            try:
-                ver_doc = http_json(ver_url)
-                print(f"API response type: {type(ver_doc).__name__}")
-                print(f"API response value: {ver_doc}")
-                if isinstance(ver_doc, dict):
-                    resolved_version = (
-                        ver_doc.get("version")
-                        or ver_doc.get("latest")
-                        or ver_doc.get("artifact_version")
-                        or ver_doc.get("value")
-                    )
-                    if not resolved_version:
-                        resolved_version = str(ver_doc)
-                else:
-                    resolved_version = str(ver_doc).strip().strip('"')
-            except RuntimeError as e:
-                error_msg = str(e)
-                # CINC doesn't require licenses, so skip license-specific error handling
-                if download_site != "cinc" and ("403" in error_msg or "401" in error_msg or "Missing license_id" in error_msg or "License Id is not valid" in error_msg or "Only Free license" in error_msg):
-                    site_type = "commercial" if download_site == "commercial" else "community"
-                    license_secret = "GA_DOWNLOAD_GRYPE_LICENSE_ID" if download_site == "commercial" else "GA_DOWNLOAD_GRYPE_LICENSE_ID_FREE"
-                    
-                    if "Missing license_id" in error_msg:
-                        raise RuntimeError(
-                            f"LICENSE ERROR ({site_type}): Missing license_id parameter.\n"
-                            f"  Download site: {download_site}\n"
-                            f"  Required secret: {license_secret}\n"
-                            f"  Solution: Ensure the {license_secret} secret is set in the orchestrator repository"
-                        ) from e
-                    elif "License Id is not valid" in error_msg or "403" in error_msg:
-                        raise RuntimeError(
-                            f"LICENSE ERROR ({site_type}): Invalid or expired license_id.\n"
-                            f"  Download site: {download_site}\n"
-                            f"  Product: {product}, Channel: {channel}\n"
-                            f"  Secret used: {license_secret}\n"
-                            f"  Solution: Update the {license_secret} secret with a valid {'commercial' if download_site == 'commercial' else 'Free'} license"
-                        ) from e
-                    elif "Only Free license" in error_msg:
-                        raise RuntimeError(
-                            f"LICENSE ERROR (community): Wrong license type provided.\n"
-                            f"  Download site: community\n"
-                            f"  Error: Community downloads require a 'Free' license, but a commercial license was provided\n"
-                            f"  Solution: Update GA_DOWNLOAD_GRYPE_LICENSE_ID_FREE secret with a valid Free license (not commercial)"
-                        ) from e
-                    else:
-                        raise RuntimeError(
-                            f"LICENSE ERROR ({site_type}): Authentication failed.\n"
-                            f"  Download site: {download_site}\n"
-                            f"  Product: {product}, Channel: {channel}\n"
-                            f"  Secret used: {license_secret}\n"
-                            f"  Solution: Verify the {license_secret} secret contains a valid license for {download_site} downloads"
-                        ) from e
-                raise
+    with timed_span("resolve_version", product=product, channel=channel):
+        resolved_version = resolve_native_version(base, api_product, product, channel, download_site, license_id, job["resolve_ver"], job["pinned_ver"])
+    job["resolved_version"] = resolved_version
 
     print(f"Resolved version: '{resolved_version}' (type: {type(resolved_version).__name__})")
-    
+    print(f"Version API: {version_cache_summary()}")
+
     # Check if this version is already scanned (unless full_product_scan is enabled)
-    if not full_product_scan:
+    if not job["full_product_scan"]:
         should_skip, skip_reason = check_existing_version(
             scan_mode=scan_mode,
             data_repo_path=data_repo_path,
@@ -1037,12 +3801,12 @@ else:
             resolved_version=resolved_version,
             hab_ident=None
         )
-        
+
         if should_skip:
             print(f"SKIP: {skip_reason}")
             print(f"::debug::Skipping {scan_mode} scan for {product} {channel} ({download_site}): {skip_reason}")
             # Write minimal outputs for workflow to continue
-            write_text(os.path.join(out_dir, "_resolved_version.txt"), resolved_version)
+            write_resolved_versions(out_dir, [resolved_version])
             # Construct redacted URL for output
             if download_site == "cinc":
                 # For CINC, construct a descriptive URL (actual URL would require fetching packages endpoint)
@@ -1056,8 +3820,19 @@ else:
                 parts = urlsplit(f"{base}/{channel}/{api_product}/download")
                 download_url_redacted = urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(q_params, doseq=True), parts.fragment))
             write_text(os.path.join(out_dir, "_download_url_redacted.txt"), download_url_redacted)
+
+            # Rematch mode: refresh the published results from the stored SBOM if the grype DB moved on
+            if sbom_mode == "rematch":
+                ensure_grype()
+                prev_dir = native_data_dir(data_repo_path, scan_mode, product, channel, download_site, os_name, os_ver, arch)
+                if rematch_native_target(prev_dir, product, job["scanners_dir"], out_dir, job["output_format"]):
+                    print(f"::notice::✓ Rematch completed for {product} {channel} ({download_site}): {resolved_version}")
+                    job["status"] = "rematched"
+                    return False
+
             write_text(os.path.join(out_dir, "_skipped.txt"), "true")
-            exit(0)
+            job["status"] = "skipped"
+            return False
     else:
         print(f"INFO: Full product scan enabled - bypassing version check")
 
@@ -1067,12 +3842,12 @@ else:
     # 1. Standard Chef: ?p=ubuntu&pv=24.04&m=x86_64&v=latest (commercial/community)
     # 2. Universal binaries: ?p=linux&pm=deb&m=x86_64&v=latest (chef-ice - no pv parameter)
     # 3. CINC: Fetch from /packages endpoint and extract direct .deb URL
-    
+
     if download_site == "cinc":
         # CINC provides direct package URLs via /packages endpoint
         packages_url = f"{base}/{channel}/{api_product}/packages"
         print(f"Fetching CINC package info from: {packages_url}")
-        
+
         try:
             packages_doc = http_json(packages_url)
             # Navigate: packages_doc[os][os_version][arch]["url"]
@@ -1081,7 +3856,7 @@ else:
                 download_url = pkg_info.get("url", "")
                 if not download_url:
                     raise RuntimeError(f"No URL found in CINC package info for {os_name}/{os_ver}/{arch}")
-                
+
                 # Verify version matches
                 pkg_version = pkg_info.get("version", "")
                 if pkg_version and pkg_version != resolved_version:
@@ -1102,7 +3877,7 @@ else:
                 f"  URL: {packages_url}\n"
                 f"  Error: {str(e)}"
             ) from e
-        
+
         download_url_redacted = download_url  # CINC URLs don't contain secrets
     else:
         # Chef commercial/community pattern
@@ -1122,20 +3897,74 @@ else:
         download_url_redacted = urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(q, doseq=True), parts.fragment))
 
     # Persist small values for action outputs
-    write_text(os.path.join(out_dir, "_resolved_version.txt"), resolved_version)
+    write_resolved_versions(out_dir, [resolved_version])
     write_text(os.path.join(out_dir, "_download_url_redacted.txt"), download_url_redacted)
+    job.update(api_product=api_product, download_url=download_url, download_url_redacted=download_url_redacted)
+    return True
+
+def download_native_job(job):
+    """
+    Download and validate the target's .deb (package cache, segmented or streamed download).
+
+    With STREAM_EXTRACT the package is extracted while it downloads; job["streamed"] tells
+    extract_native_job() there is nothing left to unpack.
+    """
+    product, channel, download_site = job["product"], job["channel"], job["download_site"]
+    os_name, os_ver, arch, package_manager = job["os_name"], job["os_ver"], job["arch"], job["package_manager"]
+    resolved_version, api_product, work_dir = job["resolved_version"], job["api_product"], job["work_dir"]
+    download_url, download_url_redacted = job["download_url"], job["download_url_redacted"]
+    package_cache_dir, download_segments = job["package_cache_dir"], job["download_segments"]
 
     # Log what we're downloading
     print(f"Downloading {product} {channel} version {resolved_version}")
     print(f"Download URL: {download_url_redacted}")
     print(f"Target: {os_name}{'/' + os_ver if os_ver else ''}/{arch}{'/' + package_manager if package_manager else ''}")
 
-    # Download package with resilient retry logic
+    # Download package with resilient retry logic (unless the package cache already has it)
     pkg_path = os.path.join(work_dir, "package_downloaded.deb")
+    download_stats = None
+    published_sha256 = None
+    package_cache = None
+    cached_package = None
+    if package_cache_dir:
+        package_cache_key = native_package_cache_key(download_site, product, resolved_version, os_name, os_ver, arch, package_manager)
+        with timed_span("package_cache.load") as span:
+            cached_package = load_cached_package(package_cache_dir, package_cache_key, pkg_path)
+            span.update(hit=bool(cached_package), bytes=cached_package["bytes"] if cached_package else 0)
+        package_cache = {"status": "hit" if cached_package else "miss", "key": package_cache_key}
+        if cached_package:
+            package_cache["sha256"] = cached_package["sha256"]
+            print(f"Package cache hit: {package_cache_key[:12]} ({cached_package['bytes']} bytes, sha256 verified) - skipping download")
+
+    # Streaming mode: extract while downloading (the .deb is only kept for the package cache)
+    extract_dir = os.path.join(work_dir, "extracted")
+    extract_profile = compile_extract_profile(product) if job["extract_filter"] == "scannable" else None
+    skipped = new_skip_stats()
+    streamed = False
+    if job["stream_extract"] and not cached_package:
+        run(["bash","-lc", f"rm -rf '{extract_dir}' && mkdir -p '{extract_dir}'"], check=True)
+        try:
+            keep_path = pkg_path if package_cache_dir or (extract_profile and job["extract_verify"]) else None
+            with timed_span("download.stream", protocol="HTTP/2") as span:
+                download_stats = stream_download_extract(download_url, extract_dir, keep_path, profile=extract_profile, skipped=skipped)
+                span["bytes"] = download_stats["bytes"]
+            streamed = True
+        except RuntimeError as e:
+            print(f"⚠️  {str(e).splitlines()[0]} - falling back to download + dpkg-deb")
+            skipped = new_skip_stats()
     try:
-        # Use new download_with_fallback function with HTTP/2 → HTTP/1.1 fallback
-        download_with_fallback(download_url, pkg_path, timeout=300)
-        print(f"Downloaded package: {os.path.getsize(pkg_path)} bytes")
+        if download_segments > 1 and not download_stats and not cached_package:
+            published_sha256 = published_package_checksum(download_url) if download_site != "cinc" else None
+            with timed_span("download.segmented", segments=download_segments) as span:
+                download_stats = download_segmented(download_url, pkg_path, download_segments)
+                span["bytes"] = download_stats["bytes"] if download_stats else 0
+        if not download_stats and not cached_package:
+            # Use new download_with_fallback function with HTTP/2 → HTTP/1.1 fallback
+            with timed_span("download") as span:
+                download_stats = download_with_fallback(download_url, pkg_path, timeout=300)
+                span["bytes"] = download_stats["bytes"]
+        if not cached_package and not streamed:
+            print(f"Downloaded package: {os.path.getsize(pkg_path)} bytes")
     except RuntimeError as e:
         if "500" in str(e):
             raise RuntimeError(
@@ -1176,50 +4005,103 @@ else:
                 ) from e
         raise
 
-    # Validate downloaded file
-    if not os.path.exists(pkg_path):
-        raise RuntimeError(f"Download failed: package file not found at {pkg_path}")
-    
-    file_size = os.path.getsize(pkg_path)
-    if file_size < 1024:  # Less than 1KB is likely an error page or empty file
-        raise RuntimeError(
-            f"DOWNLOAD ERROR: Downloaded file is suspiciously small ({file_size} bytes).\n"
-            f"  Product: {product} v{resolved_version}\n"
-            f"  Channel: {channel}, Download site: {download_site}\n"
-            f"  This indicates an incomplete or corrupted download.\n"
-            f"  Solution: Check network connectivity and retry. If issue persists, the package may not exist for this platform."
-        )
-    
-    # Verify it's a valid debian package by checking for debian-binary member
-    rc, out, err = run(["bash","-lc", f"ar t '{pkg_path}' 2>/dev/null | grep -q 'debian-binary' && echo 'valid' || echo 'invalid'"], check=False)
-    if out.strip() != "valid":
-        raise RuntimeError(
-            f"DOWNLOAD ERROR: Downloaded file is not a valid Debian package.\n"
-            f"  Product: {product} v{resolved_version}\n"
-            f"  Channel: {channel}, Download site: {download_site}\n"
-            f"  File size: {file_size} bytes\n"
-            f"  This indicates a corrupted download or an error page was returned instead of the package.\n"
-            f"  Solution: Retry the download. If issue persists, check if the package exists for this platform."
-        )
-    
+    with timed_span("validate", streamed=streamed) as span:
+        # Verify against the checksum published by the download API (looked up for segmented downloads)
+        if published_sha256:
+            actual_sha256 = file_sha256(pkg_path)
+            if actual_sha256 != published_sha256:
+                raise RuntimeError(f"Checksum mismatch for {download_url_redacted}: expected sha256 {published_sha256}, got {actual_sha256}")
+            download_stats["sha256_verified"] = True
+            print("✓ SHA-256 matches the published checksum")
+
+        if streamed:
+            file_size = download_stats["bytes"]  # Validated while streaming (ar container + debian-binary)
+        else:
+            # Validate downloaded file
+            if not os.path.exists(pkg_path):
+                raise RuntimeError(f"Download failed: package file not found at {pkg_path}")
+
+            file_size = os.path.getsize(pkg_path)
+            if file_size < 1024:  # Less than 1KB is likely an error page or empty file
+                raise RuntimeError(
+                    f"DOWNLOAD ERROR: Downloaded file is suspiciously small ({file_size} bytes).\n"
+                    f"  Product: {product} v{resolved_version}\n"
+                    f"  Channel: {channel}, Download site: {download_site}\n"
+                    f"  This indicates an incomplete or corrupted download.\n"
+                    f"  Solution: Check network connectivity and retry. If issue persists, the package may not exist for this platform."
+                )
+
+            # Verify it's a valid debian package by checking for debian-binary member
+            rc, out, err = run(["bash","-lc", f"ar t '{pkg_path}' 2>/dev/null | grep -q 'debian-binary' && echo 'valid' || echo 'invalid'"], check=False)
+            if out.strip() != "valid":
+                raise RuntimeError(
+                    f"DOWNLOAD ERROR: Downloaded file is not a valid Debian package.\n"
+                    f"  Product: {product} v{resolved_version}\n"
+                    f"  Channel: {channel}, Download site: {download_site}\n"
+                    f"  File size: {file_size} bytes\n"
+                    f"  This indicates a corrupted download or an error page was returned instead of the package.\n"
+                    f"  Solution: Retry the download. If issue persists, check if the package exists for this platform."
+                )
+        span["bytes"] = file_size
+
     print(f"Downloaded package: {file_size} bytes")
 
+    # Keep the validated package for later runs, then trim the cache to its size cap
+    if package_cache is not None:
+        if not cached_package:
+            ensure_dir(package_cache_dir)
+            package_cache["sha256"] = store_cached_package(package_cache_dir, package_cache["key"], pkg_path, {
+                "download_site": download_site,
+                "product": product,
+                "version": resolved_version,
+                "os": os_name,
+                "os_version": os_ver,
+                "arch": arch,
+                "package_manager": package_manager,
+                "url_redacted": download_url_redacted
+            })["sha256"]
+        package_cache["evicted"] = prune_lru_cache(package_cache_dir, job["package_cache_max_mb"] * 1024 * 1024)
+        print(f"Package cache: {package_cache['status']}, {package_cache['evicted']} entries evicted")
+
+    job.update(pkg_path=pkg_path, extract_dir=extract_dir, extract_profile=extract_profile, skipped=skipped, streamed=streamed,
+               download_stats=download_stats, package_cache=package_cache, file_size=file_size)
+
+def extract_native_job(job):
+    """Unpack the downloaded .deb (and a nested migration bundle) and measure the installed size."""
+    product, channel, download_site = job["product"], job["channel"], job["download_site"]
+    resolved_version, pkg_path, extract_dir = job["resolved_version"], job["pkg_path"], job["extract_dir"]
+    extract_profile, skipped, file_size = job["extract_profile"], job["skipped"], job["file_size"]
+
     # Extract deterministically (pilot assumes Ubuntu .deb)
-    extract_dir = os.path.join(work_dir, "extracted")
-    run(["bash","-lc", f"rm -rf '{extract_dir}' && mkdir -p '{extract_dir}'"], check=True)
-    
-    try:
-        run(["bash","-lc", f"dpkg-deb -x '{pkg_path}' '{extract_dir}'"], check=True)
-    except RuntimeError as e:
-        raise RuntimeError(
-            f"EXTRACTION ERROR: Failed to extract Debian package.\n"
-            f"  Product: {product} v{resolved_version}\n"
-            f"  Channel: {channel}, Download site: {download_site}\n"
-            f"  File size: {file_size} bytes\n"
-            f"  Error: {str(e)}\n"
-            f"  This indicates a corrupted download or malformed package.\n"
-            f"  Solution: The download will be retried on the next run. If issue persists, report to Chef support."
-        ) from e
+    if not job["streamed"]:
+        run(["bash","-lc", f"rm -rf '{extract_dir}' && mkdir -p '{extract_dir}'"], check=True)
+
+        try:
+            with timed_span("extract", filtered=bool(extract_profile), bytes=file_size) as span:
+                if extract_profile:
+                    try:
+                        with open(pkg_path, "rb") as f:
+                            extract_deb_stream(TeeReader(f), extract_dir, extract_profile, skipped)
+                    except RuntimeError:
+                        if zstd_available():
+                            raise
+                        # data.tar.zst needs the optional zstandard package: extract everything instead
+                        print("⚠️  Filtered extraction of a zstd data member needs the 'zstandard' Python package; extracting everything with dpkg-deb")
+                        extract_profile = job["extract_profile"] = None
+                        span["filtered"] = False
+                        run(["bash","-lc", f"rm -rf '{extract_dir}' && mkdir -p '{extract_dir}'"], check=True)
+                if not extract_profile:
+                    run(["bash","-lc", f"dpkg-deb -x '{pkg_path}' '{extract_dir}'"], check=True)
+        except (RuntimeError, ValueError, OSError, tarfile.TarError) as e:
+            raise RuntimeError(
+                f"EXTRACTION ERROR: Failed to extract Debian package.\n"
+                f"  Product: {product} v{resolved_version}\n"
+                f"  Channel: {channel}, Download site: {download_site}\n"
+                f"  File size: {file_size} bytes\n"
+                f"  Error: {str(e)}\n"
+                f"  This indicates a corrupted download or malformed package.\n"
+                f"  Solution: The download will be retried on the next run. If issue persists, report to Chef support."
+            ) from e
 
     # Handle nested bundle extraction for migration packages (e.g., chef-ice)
     # These packages contain a hab/migration/bundle/*.tar.gz with the actual software
@@ -1229,12 +4111,17 @@ else:
         bundle_tarball = bundle_files.strip().split('\n')[0]  # Take first match
         print(f"Detected migration bundle package: {os.path.basename(bundle_tarball)}")
         print(f"Extracting nested Habitat package for scanning...")
-        
+
         # Extract the bundle tarball into the extract_dir (will create hab/ structure)
         try:
-            run(["bash", "-lc", f"tar -xzf '{bundle_tarball}' -C '{extract_dir}'"], check=True)
+            with timed_span("extract.bundle", filtered=bool(extract_profile), bytes=os.path.getsize(bundle_tarball)):
+                if extract_profile:
+                    with open(bundle_tarball, "rb") as f:
+                        extract_tar_stream(decompressed_stream(f, bundle_tarball), extract_dir, extract_profile, skipped)
+                else:
+                    run(["bash", "-lc", f"tar -xzf '{bundle_tarball}' -C '{extract_dir}'"], check=True)
             print(f"✓ Successfully extracted nested bundle")
-        except RuntimeError as e:
+        except (RuntimeError, OSError, tarfile.TarError) as e:
             raise RuntimeError(
                 f"EXTRACTION ERROR: Failed to extract nested migration bundle.\n"
                 f"  Product: {product} v{resolved_version}\n"
@@ -1245,103 +4132,60 @@ else:
 
     # Calculate installed size (disk footprint after extraction)
     print(f"Calculating installed size...")
-    installed_size = get_directory_size(extract_dir)
+    with timed_span("installed_size", path=extract_dir) as span:
+        installed_size = get_directory_size(extract_dir, workers=job["size_walk_workers"])
+        span["bytes"] = installed_size["bytes"]
+    if extract_profile and "error" not in installed_size:
+        # Report the full footprint: add back what the profile left out
+        print(f"Extraction profile '{extract_profile['name']}' skipped {skipped['files']} files ({skipped['bytes']} bytes)")
+        installed_size["bytes"] += skipped["bytes"]
+        installed_size["file_count"] += skipped["files"]
+        size_bytes = installed_size["bytes"]
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+            if size_bytes < 1024.0 or unit == 'TB':
+                installed_size["human_readable"] = f"{size_bytes:.2f} {unit}"
+                break
+            size_bytes = size_bytes / 1024.0
     print(f"Installed size: {installed_size['human_readable']} ({installed_size['file_count']} files)")
+    job["installed_size"] = installed_size
+
+def scan_native_job(job):
+    """Scan the extracted tree with grype and write scanners/grype.*.json plus the legacy out/ copies."""
+    product, channel, download_site = job["product"], job["channel"], job["download_site"]
+    os_name, os_ver, arch, package_manager = job["os_name"], job["os_ver"], job["arch"], job["package_manager"]
+    scan_mode, resolved_version, out_dir, scanners_dir = job["scan_mode"], job["resolved_version"], job["out_dir"], job["scanners_dir"]
+    extract_profile, skipped, installed_size = job["extract_profile"], job["skipped"], job["installed_size"]
+    sbom_mode, output_format = job["sbom_mode"], job["output_format"]
 
     # Ensure grype (may be restored from cache)
-    grype_version = os.getenv("GRYPE_VERSION", "0.109.0")
-    if os.path.isfile("/usr/local/bin/grype"):
-        # Ensure executable permissions (cache may not preserve them)
-        run(["chmod", "+x", "/usr/local/bin/grype"], check=False)
-        print("✓ Grype found in cache")
-    else:
-        rc, _, _ = run(["bash","-lc", "command -v grype >/dev/null 2>&1"], check=False)
-        if rc == 0:
-            print("✓ Grype already installed")
-        else:
-            # Install with retry logic for GitHub releases API
-            print(f"Installing Grype {grype_version}...")
-            install_cmd = f"curl -sSfL https://raw.githubusercontent.com/anchore/grype/main/install.sh | sh -s -- -b /usr/local/bin v{grype_version}"
-            run(["bash","-lc", install_cmd], check=True, retry_config={"max_retries": 5, "base_delay": 2, "max_delay": 30})
+    ensure_grype()
+    if sbom_mode != "off":
+        ensure_syft()
+
+    # Prepare the grype DB once (pinned archive or a single update)
+    toolchain = grype_toolchain()
 
     # Run grype scan to JSON (do not print findings to stdout)
     grype_latest_json = os.path.join(scanners_dir, "grype.latest.json")
-    run(["bash","-lc", f"grype dir:'{extract_dir}' --name '{product}' --output json > '{grype_latest_json}'"], check=True)
-
-    # Parse counts and rewrite with pretty formatting
-    doc = json.load(open(grype_latest_json, "r", encoding="utf-8"))
-    json.dump(doc, open(grype_latest_json, "w", encoding="utf-8"), indent=2)
-    doc = json.load(open(grype_latest_json, "r", encoding="utf-8"))
-    matches = doc.get("matches", []) or []
-
-    buckets = ["Critical","High","Medium","Low","Negligible","Unknown"]
-    sev_counts = {k: 0 for k in buckets}
-
-    for m in matches:
-        sev = (m.get("vulnerability", {}) or {}).get("severity", "Unknown") or "Unknown"
-        sev_norm = sev.strip().title()
-        if sev_norm in ("Negligible","Minimal"):
-            sev_norm = "Negligible"
-        if sev_norm not in sev_counts:
-            sev_norm = "Unknown"
-        sev_counts[sev_norm] += 1
-
-    # Grype version + DB status (best effort)
-    grype_version = ""
-    rc, out, err = run(["bash","-lc", "grype version"], check=False)
-    if rc == 0:
-        m = re.search(r"Version:\s*([0-9]+\.[0-9]+\.[0-9]+(?:[-+.\w]+)?)", out)
-        if m:
-            grype_version = m.group(1)
+    sbom_path = os.path.join(scanners_dir, "syft.sbom.json") if sbom_mode != "off" else None
+    # Streamed straight to its pretty-printed form, counting severities on the way
+    matches_total, sev_counts = grype_scan_to_file(f"dir:{job['extract_dir']}", product, grype_latest_json, sbom_path, fmt=output_format)
 
-    db_info = {}
-    rc, out, err = run(["bash","-lc", "grype db status -o json"], check=False)
-    if rc == 0 and out.startswith("{"):
-        try:
-            dbj = json.loads(out)
-            db_info["status_raw"] = dbj
-            for k in ("built","builtAt","lastBuilt","updated","updatedAt","lastUpdated"):
-                if k in dbj:
-                    db_info["built_utc"] = dbj.get(k)
-                    break
-            for k in ("schemaVersion","schema","dbSchemaVersion"):
-                if k in dbj:
-                    db_info["schema"] = dbj.get(k)
-                    break
-            for k in ("checksum","hash","etag"):
-                if k in dbj:
-                    db_info["checksum"] = dbj.get(k)
-                    break
-        except Exception:
-            db_info["status_raw_text"] = out
-    else:
-        rc2, out2, err2 = run(["bash","-lc","grype db status"], check=False)
-        if rc2 == 0:
-            db_info["status_raw_text"] = out2
-            m = re.search(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)", out2)
-            if m:
-                db_info["built_utc"] = m.group(1)
+    # Grype version + DB status (collected once, before the scan)
+    grype_version = toolchain["version"]
+    db_info = toolchain["db"]
 
     # Metadata
-    gha_run_id = env("GITHUB_RUN_ID", "")
-    repo = env("GITHUB_REPOSITORY", "")
-    workflow = env("GITHUB_WORKFLOW", "")
-    sha = env("GITHUB_SHA", "")
-
     grype_metadata = {
         "schema_version": "1.0",
-        "snapshot": {
-            "timestamp_utc": now_utc(),
-            "run_id": f"gha-{gha_run_id}" if gha_run_id else "",
-            "pipeline": {"repo": repo, "workflow": workflow, "git_sha": sha}
-        },
+        "snapshot": pipeline_snapshot(),
         "target": {
             "product": product,
             "channel": channel,
             "resolved_version": resolved_version,
-            "download": {"site": download_site, "url_redacted": download_url_redacted},
+            "download": {"site": download_site, "url_redacted": job["download_url_redacted"], "transfer": job["download_stats"]},
             "size": {
-                "package_bytes": file_size,
+                "package_bytes": job["file_size"],
                 "installed_bytes": installed_size["bytes"],
                 "installed_human_readable": installed_size["human_readable"],
                 "file_count": installed_size["file_count"]
@@ -1356,23 +4200,796 @@ else:
         },
         "scan": {
             "mode": scan_mode,
-            "scan_root": scan_root,
+            "scan_root": job["scan_root"],
             "grype": {"version": grype_version, "db": db_info},
             "options": {"output": "json"}
         },
         "summary": {
-            "matches_total": len(matches),
+            "matches_total": matches_total,
             "severity_counts": sev_counts
         }
     }
 
-    grype_metadata_path = os.path.join(scanners_dir, "grype.metadata.json")
-    json.dump(grype_metadata, open(grype_metadata_path, "w", encoding="utf-8"), indent=2)
+    if sbom_path:
+        grype_metadata["scan"]["sbom"] = {"format": "syft-json"}
+    if job["package_cache"] is not None:
+        grype_metadata["target"]["download"]["cache"] = job["package_cache"]
+    if extract_profile:
+        grype_metadata["scan"]["extract"] = {"filter": job["extract_filter"], "profile": extract_profile["name"], "skipped": skip_summary(skipped)}
+        if job["extract_verify"]:
+            parity = verify_extraction_parity(job["pkg_path"], os.path.join(job["work_dir"], "extracted-full"), product, grype_latest_json)
+            grype_metadata["scan"]["extract"]["verify"] = parity
+    # Spans finished so far (this target's only, in a batch); output writing is in the trace file
+    grype_metadata["timings"] = timing_section(job.get("key"))
 
-    # Legacy compatibility: copy Grype files to out/ root
-    import shutil
-    shutil.copy2(grype_latest_json, os.path.join(out_dir, "latest.json"))
-    shutil.copy2(grype_metadata_path, os.path.join(out_dir, "metadata.json"))
+    with timed_span("write_outputs"):
+        grype_metadata_path = os.path.join(scanners_dir, "grype.metadata.json")
+        write_json(grype_metadata, grype_metadata_path, output_format)
+
+        # Legacy compatibility: copy Grype files to out/ root
+        shutil.copy2(grype_latest_json, os.path.join(out_dir, "latest.json"))
+        shutil.copy2(grype_metadata_path, os.path.join(out_dir, "metadata.json"))
+        if sbom_path:
+            shutil.copy2(sbom_path, os.path.join(out_dir, "sbom.json"))
 
     print("Wrote Grype outputs:", grype_latest_json, grype_metadata_path)
-    print(f"::notice::✓ {scan_mode.title()} scan completed for {product} {channel} v{resolved_version}: {len(matches)} vulnerabilities found (Critical: {sev_counts['Critical']}, High: {sev_counts['High']}, Medium: {sev_counts['Medium']})")
\ No newline at end of file
+    print(f"::notice::✓ {scan_mode.title()} scan completed for {product} {channel} v{resolved_version}: {matches_total} vulnerabilities found (Critical: {sev_counts['Critical']}, High: {sev_counts['High']}, Medium: {sev_counts['Medium']})")
+    job.update(status="scanned", matches_total=matches_total)
+
+# Batch mode: one stage thread each, joined by queues of BATCH_QUEUE_DEPTH jobs, so target
+# N+1 downloads while target N is extracted and target N-1 is scanned
+BATCH_STAGES = (("download", download_native_job), ("extract", extract_native_job), ("scan", scan_native_job))
+BATCH_QUEUE_DEPTH = 1
+
+def settle_native_job(job, stage, e):
+    """Mark a job failed in stage with the first line of exception e (license id redacted)."""
+    job["status"] = "failed"
+    job["error"] = f"{stage}: {str(e).splitlines()[0] if str(e) else type(e).__name__}"
+    if job["license_id"]:
+        job["error"] = job["error"].replace(job["license_id"], "***")
+    print(f"::error::{job['key']}: {job['error']}")
+
+def run_native_pipeline(jobs, stages=BATCH_STAGES, on_done=None, thread_prefix="batch"):
+    """
+    Run prepared jobs through pipelined stages, one thread per stage.
+
+    The stages are linked by queues BATCH_QUEUE_DEPTH deep, so job N+1 downloads while
+    job N is extracted and job N-1 is scanned. A job that fails in a stage is settled
+    (see settle_native_job()) and passed through the later stages untouched. Each job's
+    work directory is removed after the last stage.
+
+    Args:
+        jobs: Iterable of jobs prepared by prepare_native_job(); may be a generator that
+              waits for new work (it is consumed on the calling thread)
+        stages: (name, fn(job)) pairs
+        on_done: Optional callable on_done(job), called on the last stage's thread
+        thread_prefix: Stage thread name prefix (shows in timing spans)
+    """
+    # feed -> download -> extract -> scan, None marks the end of the input
+    queues = [queue.Queue(maxsize=BATCH_QUEUE_DEPTH) for _ in stages]
+    def stage_worker(name, fn, inbox, outbox):
+        while True:
+            job = inbox.get()
+            if job is None:
+                if outbox is not None:
+                    outbox.put(None)
+                return
+            if job["status"] != "failed":
+                timing_context.target = job["key"]
+                started = time.monotonic()
+                print(f"[{job['label']}] {name}: {job['key']}")
+                try:
+                    fn(job)
+                except Exception as e:
+                    settle_native_job(job, name, e)
+                job.setdefault("stage_seconds", {})[name] = round(time.monotonic() - started, 3)
+            if outbox is not None:
+                outbox.put(job)
+            else:
+                shutil.rmtree(job["work_dir"], ignore_errors=True)
+                if on_done:
+                    try:
+                        on_done(job)
+                    except Exception as e:
+                        print(f"Warning: {job['key']}: {type(e).__name__}: {e}")
+
+    workers = []
+    for n, (name, fn) in enumerate(stages):
+        outbox = queues[n + 1] if n + 1 < len(queues) else None
+        worker = threading.Thread(target=stage_worker, args=(name, fn, queues[n], outbox), name=f"{thread_prefix}-{name}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    try:
+        for job in jobs:
+            queues[0].put(job)
+    finally:
+        queues[0].put(None)
+        for worker in workers:
+            worker.join()
+
+def run_native_batch(targets, out_root, work_root):
+    """
+    Scan a list of native/modern targets through pipelined download/extract/scan stages.
+
+    Each target gets the outputs of a single-target run in {out_root}/{data-repo path} (see
+    scan_manifest_key()). Versions are resolved up front (concurrently); a target that fails
+    is recorded and does not stop the others. A target's work directory is removed once it
+    has been scanned, so at most a few extracted trees are on disk at a time.
+
+    Args:
+        targets: List of target dicts (action input names, as for plan-targets, plus any
+                 per-run settings, see native_job_settings()); license ids come from
+                 LICENSE_ID_COMMERCIAL / LICENSE_ID_COMMUNITY (or LICENSE_ID)
+        out_root: Batch output directory
+        work_root: Batch scratch directory
+
+    Returns:
+        List of {"target", "out_dir", "status", "resolved_version", ...} results, in input order
+    """
+    jobs = []
+    for i, target in enumerate(targets):
+        scan_mode_t = target.get("scan_mode") or "native"
+        if scan_mode_t not in ("native", "modern"):
+            raise RuntimeError(f"batch: target {i} has scan_mode '{scan_mode_t}' (expected 'native' or 'modern')")
+        site = target.get("download_site") or "commercial"
+        key = scan_manifest_key(scan_mode_t, target["product"], target["channel"], site,
+                                target.get("os") or "ubuntu", target.get("os_version") or "", target.get("arch") or "x86_64")
+        site_license_id = env(f"LICENSE_ID_{site.upper()}", "") or env("LICENSE_ID", "")
+        try:
+            job = native_target_job(target, os.path.join(out_root, key), os.path.join(work_root, f"target-{i}"), site_license_id)
+        except RuntimeError as e:
+            raise RuntimeError(f"batch: target {i}: {e}") from e
+        job.update(index=i, key=key, status="pending")
+        jobs.append(job)
+
+    def prepare(job):
+        timing_context.target = job["key"]
+        try:
+            if prepare_native_job(job):
+                job["status"] = "queued"
+        except Exception as e:
+            settle_native_job(job, "prepare", e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(jobs)))) as pool:
+        list(pool.map(prepare, jobs))
+    queued = [job for job in jobs if job["status"] == "queued"]
+    for job in jobs:
+        if job["status"] != "queued":
+            shutil.rmtree(job["work_dir"], ignore_errors=True)
+    print(f"Batch: {len(queued)} of {len(jobs)} targets need a scan")
+
+    for job in queued:
+        job["label"] = f"{job['index'] + 1}/{len(jobs)}"
+    run_native_pipeline(queued)
+
+    results = []
+    for job in jobs:
+        result = {"target": targets[job["index"]], "out_dir": job["out_dir"], "status": job["status"],
+                  "resolved_version": job.get("resolved_version", "")}
+        for field in ("matches_total", "stage_seconds", "error"):
+            if field in job:
+                result[field] = job[field]
+        results.append(result)
+    return results
+
+WORKER_POLL_SECONDS = 2
+WORKER_DB_REFRESH_SECONDS = 6 * 3600
+
+def worker_job_target(doc):
+    """
+    Turn a worker job file into a target dict (see native_target_job()).
+
+    Job files use the action's env-var names (PRODUCT, CHANNEL, DOWNLOAD_SITE, OS, OS_VERSION,
+    ARCH, PACKAGE_MANAGER, SCAN_MODE, RESOLVE_VERSION, PINNED_VERSION) or the matching input
+    names; keys are case-insensitive. LICENSE_ID, OUT_DIR and the per-run settings of
+    native_job_settings() may be set per job.
+
+    Raises:
+        RuntimeError: If the job is not a native/modern target
+    """
+    if not isinstance(doc, dict):
+        raise RuntimeError("job file is not a JSON object")
+    target = {str(k).lower(): v for k, v in doc.items() if v not in (None, "")}
+    for field in ("product", "channel"):
+        if not target.get(field):
+            raise RuntimeError(f"job has no {field.upper()}")
+    if (target.get("scan_mode") or "native") not in ("native", "modern"):
+        raise RuntimeError(f"job has SCAN_MODE '{target['scan_mode']}' (the worker scans native and modern targets)")
+    return target
+
+def write_queue_file(obj, path):
+    """Write a worker queue/status file atomically (plain JSON, whatever OUTPUT_FORMAT is)."""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+def run_native_worker(queue_dir, out_root, work_root, drain=False):
+    """
+    Serve native/modern scan jobs from a job-directory queue until stopped.
+
+    The process stays resident: grype is checked and its DB prepared once (and updated
+    again every WORKER_DB_REFRESH_SECONDS, unless GRYPE_DB_ARCHIVE pins it), version-API
+    connections stay open, and jobs flow through the batch pipeline (run_native_pipeline()),
+    so one job downloads while the previous one is scanned.
+
+    Queue layout (one worker per queue_dir, enforced with a lock on worker.lock):
+        incoming/<id>.json  Job files (see worker_job_target()), taken in name order; write them
+                            under another name and rename, so a half-written job is never read
+        running/<id>.json   Claimed jobs; moved back to incoming/ when a worker starts
+        done/<id>.json      Job record: status, resolved_version, out_dir, stage_seconds,
+                            matches_total, error, timestamps and the job's timing spans
+        worker.json         Worker status: pid, grype, counts, running jobs
+
+    A job writes the files of a single-target run to its OUT_DIR, or to {out_root}/{data-repo
+    path} (see scan_manifest_key()). Jobs for the same target run one at a time. Per-run
+    settings a job does not set (DATA_REPO_PATH, OUTPUT_FORMAT, SBOM_MODE, ...) come from the
+    worker's environment, as do the process-wide ones (grype DB, version cache, TRACE_FILE).
+
+    Args:
+        queue_dir: Queue directory (created if needed)
+        out_root: Default output directory root
+        work_root: Scratch directory root (one job-<id>/ per job in flight)
+        drain: Stop once incoming/ is empty instead of waiting for jobs
+
+    Returns:
+        Dict of job counts by status
+    """
+    dirs = {name: os.path.join(queue_dir, name) for name in ("incoming", "running", "done")}
+    for path in dirs.values():
+        ensure_dir(path)
+    lock_file = open(os.path.join(queue_dir, "worker.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        raise RuntimeError(f"worker: another worker is serving {queue_dir}")
+    for name in sorted(os.listdir(dirs["running"])):
+        print(f"Requeueing interrupted job {name}")
+        os.replace(os.path.join(dirs["running"], name), os.path.join(dirs["incoming"], name))
+
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        print(f"Received signal {signum} - finishing the jobs in flight")
+        stop.set()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_stop)
+
+    # Warm up once: tools, grype DB
+    ensure_grype()
+    if sbom_mode != "off":
+        ensure_syft()
+    grype_toolchain()
+
+    status_lock = threading.Lock()
+    in_flight = {}  # target key -> job id
+    status = {"pid": os.getpid(), "started": now_utc(), "queue_dir": queue_dir, "counts": {}, "running": []}
+
+    def write_status(state="running"):
+        toolchain = grype_toolchain_info or {}
+        status.update(state=state, updated=now_utc(), running=sorted(in_flight.values()),
+                      grype={"version": toolchain.get("version"), "db_identity": toolchain.get("db_identity")})
+        write_queue_file(status, os.path.join(queue_dir, "worker.json"))
+
+    def finish(job):
+        record = {"id": job["id"], "target": job["target"], "out_dir": job.get("out_dir", ""), "status": job["status"],
+                  "resolved_version": job.get("resolved_version", ""), "submitted": job["submitted"],
+                  "started": job["started"], "finished": now_utc(), "seconds": round(time.monotonic() - job["claimed"], 3)}
+        for field in ("matches_total", "stage_seconds", "error"):
+            if field in job:
+                record[field] = job[field]
+        if job.get("key"):
+            record["timings"] = timing_section(job["key"])
+            if not trace_file:
+                drop_timing_spans(job["key"])
+        write_queue_file(record, os.path.join(dirs["done"], f"{job['id']}.json"))
+        running_path = os.path.join(dirs["running"], f"{job['id']}.json")
+        if os.path.exists(running_path):
+            os.remove(running_path)
+        with status_lock:
+            in_flight.pop(job.get("key"), None)
+            status["counts"][job["status"]] = status["counts"].get(job["status"], 0) + 1
+            write_status()
+        print(f"Job {job['id']}: {job['status']} in {record['seconds']}s"
+              f"{' - ' + job['error'] if job.get('error') else ''}")
+
+    def claim():
+        """Claim the next job whose target is not in flight: (job or None, jobs waiting)."""
+        names = sorted(n for n in os.listdir(dirs["incoming"]) if n.endswith(".json"))
+        for name in names:
+            incoming_path = os.path.join(dirs["incoming"], name)
+            job = {"id": name[:-len(".json")], "status": "failed", "target": {}, "license_id": ""}
+            try:
+                job["submitted"] = datetime.fromtimestamp(os.path.getmtime(incoming_path), timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                doc = read_json(incoming_path)
+            except FileNotFoundError:
+                continue  # Withdrawn by the submitter
+            except (OSError, ValueError) as e:
+                doc, job["error"] = None, f"job file: {str(e).splitlines()[0]}"
+            target = None
+            if doc is not None:
+                try:
+                    target = worker_job_target(doc)
+                except RuntimeError as e:
+                    job["error"] = f"job file: {e}"
+            if target is not None:
+                site = target.get("download_site") or "commercial"
+                job["key"] = scan_manifest_key(target.get("scan_mode") or "native", target["product"], target["channel"], site,
+                                               target.get("os") or "ubuntu", target.get("os_version") or "", target.get("arch") or "x86_64")
+                with status_lock:
+                    if job["key"] in in_flight:
+                        continue  # Same target still running: keep the job for later
+                    in_flight[job["key"]] = job["id"]
+            try:
+                os.replace(incoming_path, os.path.join(dirs["running"], name))
+            except FileNotFoundError:
+                with status_lock:
+                    in_flight.pop(job.get("key"), None)
+                continue
+            job.update(claimed=time.monotonic(), started=now_utc())
+            if target is not None:
+                license_id = target.get("license_id") or env(f"LICENSE_ID_{site.upper()}", "") or env("LICENSE_ID", "")
+                job["target"] = {k: ("***" if k == "license_id" else v) for k, v in target.items()}
+                work = os.path.join(work_root, f"job-{job['id']}")
+                try:
+                    job.update(native_target_job(target, target.get("out_dir") or os.path.join(out_root, job["key"]), work, license_id))
+                    job.update(status="pending", label=job["id"])
+                except RuntimeError as e:
+                    job["error"] = f"job file: {e}"
+            return job, len(names)
+        return None, len(names)
+
+    def feed():
+        while not stop.is_set():
+            job, waiting = claim()
+            if job is None:
+                if drain and not waiting:
+                    return
+                stop.wait(WORKER_POLL_SECONDS)
+                continue
+            print(f"Job {job['id']}: {job['key'] if job.get('key') else 'invalid'}")
+            if job["status"] == "pending":
+                timing_context.target = job["key"]
+                reset_version_memo()  # Resolve against the API as it is now
+                try:
+                    if prepare_native_job(job):
+                        job["status"] = "queued"
+                        yield job
+                        continue
+                except Exception as e:
+                    settle_native_job(job, "prepare", e)
+                shutil.rmtree(job["work_dir"], ignore_errors=True)
+            finish(job)
+
+    def scan_with_fresh_db(job):
+        refresh_grype_toolchain(WORKER_DB_REFRESH_SECONDS)  # On the scan thread: no grype run in flight
+        scan_native_job(job)
+
+    with status_lock:
+        write_status()
+    print(f"Worker {os.getpid()} serving {queue_dir}{' (drain)' if drain else ''}")
+    stages = tuple(stage for stage in BATCH_STAGES if stage[0] != "scan") + (("scan", scan_with_fresh_db),)
+    try:
+        run_native_pipeline(feed(), stages=stages, on_done=finish, thread_prefix="worker")
+    finally:
+        with status_lock:
+            write_status("stopped")
+        lock_file.close()
+    return dict(status["counts"])
+
+
+# Inputs
+product       = env("PRODUCT")
+channel       = env("CHANNEL")
+download_site = env("DOWNLOAD_SITE", "commercial")
+os_name       = env("OS", "ubuntu")
+os_ver        = env("OS_VERSION", "")
+arch          = env("ARCH", "x86_64")
+package_manager = env("PACKAGE_MANAGER", "")
+scan_mode     = env("SCAN_MODE", "native")
+scan_root     = env("SCAN_ROOT", "")
+resolve_ver   = env("RESOLVE_VERSION", "latest")
+pinned_ver    = env("PINNED_VERSION", "")
+license_id    = env("LICENSE_ID", "")
+base_url_override = env("BASE_URL_OVERRIDE", "")
+out_dir       = env("OUT_DIR", "out")
+work_dir      = env("WORK_DIR", "work")
+data_repo_path = env("DATA_REPO_PATH", "")
+full_product_scan = env("FULL_PRODUCT_SCAN", "false").lower() in ("true", "1", "yes")
+hab_ident     = env("HAB_IDENT", "")
+hab_idents    = [i for i in re.split(r"[\s,]+", env("HAB_IDENTS", "")) if i]
+hab_channel   = env("HAB_CHANNEL", "stable")
+hab_origin    = env("HAB_ORIGIN", "")
+hab_auth_token = env("HAB_AUTH_TOKEN", "")
+scan_concurrency = env("SCAN_CONCURRENCY", "")
+scan_cache_dir = os.path.expanduser(env("SCAN_CACHE_DIR", ""))
+hab_scan_strategy = (env("HAB_SCAN_STRATEGY", "") or "per-dep").strip().lower()
+hab_incremental = env("HAB_INCREMENTAL", "false").lower() in ("true", "1", "yes")
+sbom_mode     = (env("SBOM_MODE", "") or "off").strip().lower()
+scan_cache_max_mb = int(env("SCAN_CACHE_MAX_MB", "") or "2048")
+json_output_format = (env("OUTPUT_FORMAT", "") or "pretty").strip().lower()
+version_cache_dir = os.path.expanduser(env("VERSION_CACHE_DIR", ""))
+version_cache_ttl = int(env("VERSION_CACHE_TTL", "") or "300")
+grype_db_archive = os.path.expanduser(env("GRYPE_DB_ARCHIVE", ""))
+if not env("GRYPE_DB_CACHE_DIR", ""):
+    os.environ.pop("GRYPE_DB_CACHE_DIR", None)  # Empty action input: keep grype's default location
+download_segments = int(env("DOWNLOAD_SEGMENTS", "") or "1")
+package_cache_dir = os.path.expanduser(env("PACKAGE_CACHE_DIR", ""))
+package_cache_max_mb = int(env("PACKAGE_CACHE_MAX_MB", "") or "4096")
+stream_extract = env("STREAM_EXTRACT", "false").lower() in ("true", "1", "yes")
+extract_filter = (env("EXTRACT_FILTER", "") or "off").strip().lower()
+extract_verify = env("EXTRACT_VERIFY", "false").lower() in ("true", "1", "yes")
+trace_file    = os.path.expanduser(env("TRACE_FILE", ""))
+size_walk_workers = int(env("SIZE_WALK_WORKERS", "") or "1")
+
+if sbom_mode not in ("off", "write", "rematch"):
+    raise RuntimeError(f"Invalid SBOM_MODE '{sbom_mode}' (expected 'off', 'write' or 'rematch')")
+if json_output_format not in JSON_OUTPUT_FORMATS:
+    raise RuntimeError(f"Invalid OUTPUT_FORMAT '{json_output_format}' (expected one of {', '.join(JSON_OUTPUT_FORMATS)})")
+if json_output_format == "zstd":
+    zstd_module()  # Fail before scanning if the optional dependency is missing
+if extract_filter not in ("off", "scannable"):
+    raise RuntimeError(f"Invalid EXTRACT_FILTER '{extract_filter}' (expected 'off' or 'scannable')")
+if download_segments < 1:
+    raise RuntimeError(f"Invalid DOWNLOAD_SEGMENTS '{download_segments}' (expected 1 or more)")
+if size_walk_workers < 1:
+    raise RuntimeError(f"Invalid SIZE_WALK_WORKERS '{size_walk_workers}' (expected 1 or more)")
+if version_cache_dir:
+    os.makedirs(version_cache_dir, exist_ok=True)
+if grype_db_archive and not os.path.isfile(grype_db_archive):
+    raise RuntimeError(f"GRYPE_DB_ARCHIVE '{grype_db_archive}' not found")
+if trace_file:
+    atexit.register(write_trace_file, trace_file)  # Also on skips and failures
+
+# Maintenance commands (python run.py <command> ...) - run instead of a scan
+if len(sys.argv) > 1 and sys.argv[1] == "rebuild-ident-index":
+    # python run.py rebuild-ident-index [data_repo_path]  (default: $DATA_REPO_PATH)
+    rebuild_path = sys.argv[2] if len(sys.argv) > 2 else env("DATA_REPO_PATH", "")
+    if not rebuild_path or not os.path.isdir(rebuild_path):
+        raise RuntimeError(f"rebuild-ident-index: data repo '{rebuild_path}' not found")
+    print(f"Rebuilt {rebuild_habitat_ident_indexes(rebuild_path)} habitat ident indexes in {rebuild_path}")
+    exit(0)
+elif len(sys.argv) > 1 and sys.argv[1] == "update-manifest":
+    # python run.py update-manifest [data_repo_path]  (default: $DATA_REPO_PATH)
+    manifest_repo = sys.argv[2] if len(sys.argv) > 2 else data_repo_path
+    if not manifest_repo or not os.path.isdir(manifest_repo):
+        raise RuntimeError(f"update-manifest: data repo '{manifest_repo}' not found")
+    manifest = build_scan_manifest(manifest_repo)
+    write_json(manifest, os.path.join(manifest_repo, SCAN_MANIFEST))
+    print(f"Wrote {SCAN_MANIFEST} with {len(manifest['targets'])} targets")
+    exit(0)
+elif len(sys.argv) > 1 and sys.argv[1] == "plan-targets":
+    # python run.py plan-targets <targets.json> [plan.json]
+    # targets.json: list of native/modern target dicts (action input names); writes the full
+    # plan to plan.json (default: {OUT_DIR}/plan.json) and, under GitHub Actions, the targets
+    # that need a scan job as the `targets` output (for a matrix)
+    if len(sys.argv) < 3:
+        raise RuntimeError("plan-targets: usage: run.py plan-targets <targets.json> [plan.json]")
+    targets = read_json(sys.argv[2])
+    if isinstance(targets, dict):
+        targets = targets.get("targets") or targets.get("include") or []
+    db_identity = None
+    if sbom_mode == "rematch":
+        ensure_grype()
+        db_identity = grype_toolchain()["db_identity"]
+    if base_url_override:
+        print(f"Using base URL override: {base_url_override.rstrip('/')}")
+    plan = plan_native_targets(targets, data_repo_path, db_identity=db_identity, full_scan=full_product_scan,
+                               base_url_override=base_url_override)
+    print(f"Version API: {version_cache_summary()}")
+    to_scan = [{k: v for k, v in t.items() if k not in ("scan", "reason")} for t in plan if t["scan"]]
+    for t in plan:
+        print(f"{'SCAN' if t['scan'] else 'SKIP'}: {t['product']} {t['channel']} {t.get('download_site') or 'commercial'} "
+              f"{t.get('os') or 'ubuntu'} {t.get('os_version') or ''} {t.get('arch') or 'x86_64'} - {t['reason']}")
+    plan_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(out_dir, "plan.json")
+    ensure_dir(os.path.dirname(plan_path) or ".")
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump({"targets": plan}, f, indent=2)
+    if env("GITHUB_OUTPUT"):
+        with open(env("GITHUB_OUTPUT"), "a", encoding="utf-8") as f:
+            f.write(f"targets={json.dumps(to_scan, separators=(',', ':'))}\n")
+            f.write(f"count={len(to_scan)}\n")
+    print(f"::notice::{len(to_scan)} of {len(plan)} targets need a scan")
+    exit(0)
+elif len(sys.argv) > 1 and sys.argv[1] == "batch":
+    # python run.py batch <targets.json>
+    # Scans every native/modern target in one process with pipelined stages; outputs go to
+    # {OUT_DIR}/{mode}/{product}/{channel}/{site}/{os}/{os_ver}/{arch}/ and a summary to {OUT_DIR}/batch.json
+    if len(sys.argv) < 3:
+        raise RuntimeError("batch: usage: run.py batch <targets.json>")
+    targets = read_json(sys.argv[2])
+    if isinstance(targets, dict):
+        targets = targets.get("targets") or targets.get("include") or []
+    ensure_dir(out_dir)
+    batch_started = time.monotonic()
+    results = run_native_batch(targets, out_dir, work_dir)
+    failed = [r for r in results if r["status"] == "failed"]
+    counts = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    write_json({"targets": results, "counts": counts, "seconds": round(time.monotonic() - batch_started, 3)}, os.path.join(out_dir, "batch.json"))
+    print(f"Version API: {version_cache_summary()}")
+    print(f"::notice::Batch of {len(results)} targets: " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+    if env("GITHUB_OUTPUT"):
+        with open(env("GITHUB_OUTPUT"), "a", encoding="utf-8") as f:
+            f.write(f"count={len(results)}\n")
+            f.write(f"failed={len(failed)}\n")
+    exit(1 if failed else 0)
+elif len(sys.argv) > 1 and sys.argv[1] == "worker":
+    # python run.py worker <queue_dir> [--drain]
+    # Resident scan worker for native/modern targets: takes job files from <queue_dir>/incoming/
+    # (see run_native_worker()) until SIGTERM/SIGINT, or until the queue is empty with --drain
+    worker_args = [a for a in sys.argv[2:] if a != "--drain"]
+    if len(worker_args) != 1:
+        raise RuntimeError("worker: usage: run.py worker <queue_dir> [--drain]")
+    ensure_dir(out_dir)
+    counts = run_native_worker(worker_args[0], out_dir, work_dir, drain="--drain" in sys.argv[2:])
+    print(f"Version API: {version_cache_summary()}")
+    print(f"::notice::Worker stopped: " + (", ".join(f"{n} {status}" for status, n in sorted(counts.items())) or "no jobs"))
+    exit(0)
+elif len(sys.argv) > 1:
+    raise RuntimeError(f"Unknown command '{sys.argv[1]}' (expected 'rebuild-ident-index', 'update-manifest', 'plan-targets', 'batch' or 'worker')")
+
+ensure_dir(out_dir)
+ensure_dir(work_dir)
+
+# Create scanners output directory (for native/modern mode)
+if scan_mode in ["native", "modern"]:
+    scanners_dir = os.path.join(out_dir, "scanners")
+    ensure_dir(scanners_dir)
+
+# Branch based on scan_mode
+if scan_mode == "habitat":
+    # HABITAT MODE: Install hab package(s), enumerate deps, scan each unique ident once
+    
+    if hab_scan_strategy not in ("per-dep", "single-pass"):
+        raise RuntimeError(f"Invalid HAB_SCAN_STRATEGY '{hab_scan_strategy}' (expected 'per-dep' or 'single-pass')")
+    
+    # Guard: habitat mode requires hab_idents, hab_ident or hab_origin
+    if not hab_idents and not hab_ident.strip() and not hab_origin.strip():
+        raise RuntimeError(
+            "Habitat scan_mode requires HAB_IDENT (e.g., 'core/chef-infra-client'), HAB_ORIGIN (e.g., 'chef') "
+            "or HAB_IDENTS (e.g., 'chef/inspec chef/chef-infra-client' or 'chef/*'). "
+            "Set one in the target configuration."
+        )
+    
+    # Ensure hab CLI is available
+    # Note: chef/hab itself now requires HAB_AUTH_TOKEN even from stable channel.
+    # sudo strips environment variables by default, so pass the token inline when available.
+    if hab_auth_token:
+        install_hab_cmd = f"command -v hab >/dev/null 2>&1 || (curl -fsSL https://raw.githubusercontent.com/habitat-sh/habitat/master/components/hab/install.sh | sudo HAB_AUTH_TOKEN={hab_auth_token} bash)"
+    else:
+        install_hab_cmd = "command -v hab >/dev/null 2>&1 || (curl -fsSL https://raw.githubusercontent.com/habitat-sh/habitat/master/components/hab/install.sh | sudo bash)"
+    with timed_span("hab_cli"):
+        run(["bash", "-lc", install_hab_cmd], check=True)
+    
+    # Accept the Chef License for Habitat (CI environment - create marker file for root)
+    run(["bash", "-lc", "sudo mkdir -p /hab/accepted-licenses && sudo touch /hab/accepted-licenses/habitat"], check=True)
+    
+    # Determine package identifier(s). With HAB_IDENTS, every package is recorded
+    # (and looked up in the data repo) under its package name as product.
+    if hab_idents:
+        hab_targets = []
+        for entry in hab_idents:
+            if entry.endswith("/*"):
+                with timed_span("hab_list_origin", origin=entry[:-2]):
+                    origin_pkgs = list_habitat_origin_packages(entry[:-2], hab_channel)
+                print(f"Enumerated {len(origin_pkgs)} packages in {entry[:-2]} ({hab_channel})")
+                hab_targets.extend(origin_pkgs)
+            else:
+                hab_targets.append(entry)
+        hab_targets = [{"pkg": pkg, "product": pkg.split("/")[1], "lookup_ident": pkg} for pkg in dict.fromkeys(hab_targets)]
+    else:
+        hab_targets = [{"pkg": hab_ident if hab_ident else f"{hab_origin}/{product}", "product": product, "lookup_ident": hab_ident}]
+    
+    # Install each package and check whether this version is already scanned
+    # (unless full_product_scan is enabled)
+    targets_to_scan = []
+    rematched_count = 0
+    for target in hab_targets:
+        with timed_span("hab_install", ident=target["pkg"]) as span:
+            resolved_version = install_habitat_package(target["pkg"], hab_channel, hab_auth_token)
+            span["ident"] = resolved_version
+        target["ident"] = resolved_version
+        
+        if not full_product_scan:
+            should_skip, skip_reason = check_existing_version(
+                scan_mode="habitat",
+                data_repo_path=data_repo_path,
+                product=target["product"],
+                channel=hab_channel,
+                download_site="",  # Not used for habitat
+                os_name=os_name,
+                os_ver=os_ver,
+                arch=arch,
+                resolved_version=resolved_version,
+                hab_ident=target["lookup_ident"]
+            )
+            
+            if should_skip:
+                print(f"SKIP: {skip_reason}")
+                print(f"::debug::Skipping habitat scan for {target['product']} {hab_channel}: {skip_reason}")
+                
+                # Rematch mode: refresh the published results from stored SBOMs if the grype DB moved on
+                if sbom_mode == "rematch":
+                    ensure_grype()
+                    prev_index_path = find_habitat_index(data_repo_path, target["product"], hab_channel, os_name, arch, target["pkg"], resolved_version)
+                    index_path = prev_index_path and rematch_habitat_index(prev_index_path, out_dir, work_dir, os_name, resolve_scan_concurrency(scan_concurrency))
+                    if index_path:
+                        update_habitat_ident_index(out_dir, index_path, os.path.dirname(os.path.dirname(prev_index_path)))
+                        print(f"::notice::✓ Habitat rematch completed for {target['product']} {hab_channel}: {resolved_version}")
+                        rematched_count += 1
+                continue
+        else:
+            print(f"INFO: Full product scan enabled - bypassing version check")
+        targets_to_scan.append(target)
+    
+    # Write resolved version(s) for workflow outputs (keep in out_dir root for workflow to find)
+    write_resolved_versions(out_dir, [t["ident"] for t in hab_targets])
+    write_text(os.path.join(out_dir, "_download_url_redacted.txt"), " ".join(f"habitat://{t['ident']}@{hab_channel}" for t in hab_targets))
+    
+    if not targets_to_scan:
+        if not rematched_count:
+            write_text(os.path.join(out_dir, "_skipped.txt"), "true")
+        exit(0)
+    
+    # Enumerate direct (DEPS) and transitive (TDEPS - full tree, includes direct deps
+    # per Habitat definition) dependencies of every package, then scan the union once
+    for target in targets_to_scan:
+        with timed_span("hab_dependencies", ident=target["ident"]) as span:
+            closure = resolve_habitat_closure(target["ident"], os_name, scan_cache_dir)
+            span["transitive"] = len(closure["transitive"])
+        target["deps_to_scan"] = habitat_deps_to_scan(target["ident"], closure)
+        target["unique_idents"] = list(dict.fromkeys(d["ident"] for d in target["deps_to_scan"]))
+        print(f"Habitat scan: {target['ident']}")
+        print(f"Total dependencies to scan: {len(target['deps_to_scan'])} ({len(target['unique_idents'])} unique idents)")
+        print(f"  - Main package: 1")
+        print(f"  - Direct dependencies: {len(closure['direct'])}")
+        print(f"  - Transitive dependencies: {len(closure['transitive'])}")
+    unique_idents = list(dict.fromkeys(i for t in targets_to_scan for i in t["unique_idents"]))
+    print(f"Channel: {hab_channel}")
+    if len(targets_to_scan) > 1:
+        total_idents = sum(len(t["unique_idents"]) for t in targets_to_scan)
+        print(f"Packages: {len(targets_to_scan)} ({total_idents} idents, {len(unique_idents)} unique across packages)")
+    
+    # Ensure grype (may be restored from cache)
+    ensure_grype()
+    if sbom_mode != "off":
+        ensure_syft()
+    
+    # Grype version + DB status (needed up front: they key the scan-result cache)
+    cache_salt = None
+    toolchain = grype_toolchain()
+    grype_version = toolchain["version"]
+    db_info = toolchain["db"]
+    db_identity = toolchain["db_identity"]
+    if scan_cache_dir:
+        if grype_version and db_identity:
+            ensure_dir(scan_cache_dir)
+            cache_salt = (grype_version, db_identity)
+            print(f"Scan cache: {scan_cache_dir} (grype {grype_version}, DB {db_identity})")
+        else:
+            print("Warning: Unable to identify grype version/DB - scan cache disabled for this run")
+    
+    # Scan each unique ident once with a bounded pool, then fan the results
+    # out to every dependency entry in deps_to_scan order (index.json order
+    # and file contents match a serial run).
+    staging_dir = os.path.join(work_dir, "habitat-scans")
+    workers = min(resolve_scan_concurrency(scan_concurrency), len(unique_idents))
+    if workers > 1 and not db_identity:
+        # grype_toolchain() could not prepare the DB, so every grype run still checks for
+        # (and may download) it itself: scan serially rather than start that many downloads
+        print("⚠️  Grype DB could not be identified after `grype db update` - scanning with 1 worker")
+        workers = 1
+    print(f"Scan concurrency: {workers}")
+    
+    # Incremental: carry forward idents already published for an earlier release of each package
+    reused_results = {}
+    if hab_incremental:
+        for target in targets_to_scan:
+            t_origin, t_name = target["ident"].split("/")[:2]
+            prev_index_path = find_latest_habitat_index(data_repo_path, target["product"], hab_channel, os_name, arch, t_origin, t_name)
+            if not prev_index_path:
+                print(f"Incremental: no previous index.json found for {t_origin}/{t_name} - scanning every dependency")
+                continue
+            reused_results.update(reuse_previous_habitat_scans(
+                prev_index_path, [i for i in target["unique_idents"] if i not in reused_results], os_name,
+                os.path.join(work_dir, "habitat-rematch"), workers, grype_version, db_identity, sbom_mode != "off"))
+            reused = [reused_results[i]["incremental"] for i in target["unique_idents"] if i in reused_results]
+            target["incremental"] = {
+                "previous_index": os.path.relpath(prev_index_path, data_repo_path),
+                "copied": reused.count("copied"),
+                "rematched": reused.count("rematched"),
+                "scanned": len(target["unique_idents"]) - len(reused)
+            }
+            print(f"Incremental ({t_origin}/{t_name}): {target['incremental']['copied']} copied, {target['incremental']['rematched']} rematched, "
+                  f"{target['incremental']['scanned']} to scan (previous: {target['incremental']['previous_index']})")
+    idents_to_scan = [i for i in unique_idents if i not in reused_results]
+    
+    scan_results = None
+    scan_strategy_used = "per-dep"
+    if not idents_to_scan:
+        scan_results = {}
+    elif hab_scan_strategy == "single-pass" and sbom_mode != "off":
+        print("⚠️  Single-pass scanning does not produce per-ident SBOMs; using per-dep scanning because SBOM_MODE is enabled")
+    elif hab_scan_strategy == "single-pass":
+        try:
+            scan_results = scan_habitat_single_pass(idents_to_scan, os_name, staging_dir, workers, scan_cache_dir, cache_salt)
+            scan_strategy_used = "single-pass"
+        except RuntimeError as e:
+            print(f"⚠️  Single-pass scan failed, falling back to per-dep scanning: {str(e)[:200]}")
+    if scan_results is None:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scan_results = dict(zip(idents_to_scan, pool.map(
+                lambda i: scan_habitat_ident(i, os_name, staging_dir, scan_cache_dir, cache_salt, sbom_mode != "off"), idents_to_scan)))
+    scan_results.update(reused_results)
+    
+    # Scan cache statistics (per unique ident, across all packages of this run)
+    cache_stats = None
+    if cache_salt:
+        hits = sum(1 for r in scan_results.values() if r and r["cache"] == "hit")
+        misses = sum(1 for r in scan_results.values() if r and r["cache"] == "miss")
+        evicted = prune_lru_cache(scan_cache_dir, scan_cache_max_mb * 1024 * 1024)
+        cache_stats = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "evicted": evicted
+        }
+        print(f"Scan cache: {hits} hits, {misses} misses, {evicted} entries evicted")
+    
+    # Write each package's tree and index.json rollup
+    environment = {
+        "runner": env("RUNNER_OS", ""),
+        "os": os_name,
+        "os_version": os_ver,
+        "arch": arch
+    }
+    for target in targets_to_scan:
+        scan = {
+            "mode": "habitat",
+            "grype": {"version": grype_version, "db": db_info}
+        }
+        if hab_scan_strategy != "per-dep":
+            scan["strategy"] = scan_strategy_used
+        if sbom_mode != "off":
+            scan["sbom"] = {"format": "syft-json"}
+        if target.get("incremental"):
+            scan["incremental"] = target["incremental"]
+        if cache_stats:
+            scan["cache"] = cache_stats
+        
+        main_ident = target["ident"]
+        with timed_span("write_outputs", ident=main_ident):
+            index_path, summary, target_size = write_habitat_index(
+                out_dir, target["product"], hab_channel, main_ident, target["deps_to_scan"], scan_results, environment, scan)
+            t_origin, t_name = main_ident.split("/")[:2]
+            update_habitat_ident_index(out_dir, index_path,
+                habitat_data_dir(data_repo_path, target["product"], hab_channel, os_name, arch, t_origin, t_name) if data_repo_path else "")
+        total_matches = summary["total_matches"]
+        total_size_human = target_size["total_installed_human_readable"]
+        dependencies_scanned = summary["dependencies_scanned"]
+        
+        print(f"Wrote habitat index: {index_path}")
+        print(f"Scanned {dependencies_scanned} dependencies with {total_matches} total matches")
+        print(f"Total installed size: {total_size_human} ({target_size['total_file_count']:,} files)")
+        print(f"::notice::✓ Habitat scan completed for {target['product']} {hab_channel}: {main_ident} with {dependencies_scanned} dependencies ({total_matches} total vulnerabilities, {total_size_human} disk footprint)")
+
+else:
+    # NATIVE/MODERN MODE: Download + extract + scan logic
+    # (modern mode is identical to native but uses /modern/ path for next-gen products)
+    job = native_target_job({
+        "product": product,
+        "channel": channel,
+        "download_site": download_site,
+        "os": os_name,
+        "os_version": os_ver,
+        "arch": arch,
+        "package_manager": package_manager,
+        "scan_mode": scan_mode,
+        "resolve_version": resolve_ver,
+        "pinned_version": pinned_ver
+    }, out_dir, work_dir, license_id)
+    if prepare_native_job(job):
+        download_native_job(job)
+        extract_native_job(job)
+        scan_native_job(job)
@@ -18,6 +18,8 @@ exceptions, so a DB outage never blocks the main scan workflow.
 from __future__ import annotations
 
 import glob
+import gzip
+import io
 import json
 import os
 import sys
@@ -48,10 +50,27 @@ def gha_error(msg: str) -> None:
 # JSON helpers
 # ---------------------------------------------------------------------------
 
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
 def load_json(path: str | Path) -> dict[str, Any] | None:
+    """Load a scan JSON file written with any OUTPUT_FORMAT (plain, gzip or zstd)."""
     p = Path(path)
     if not p.exists():
         return None
+    with p.open("rb") as f:
+        head = f.read(4)
+    if head.startswith(GZIP_MAGIC):
+        with gzip.open(p, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    if head.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard  # type: ignore[import-untyped]
+        except ImportError:
+            raise RuntimeError(f"{p} is zstd-compressed but the zstandard package is not installed")
+        with p.open("rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as zr:
+            return json.load(io.TextIOWrapper(zr, encoding="utf-8"))
     with p.open(encoding="utf-8") as f:
         return json.load(f)
 
@@ -197,7 +216,8 @@ def insert_native_cve_details(
 
 
 def insert_habitat_cve_details(
-    cursor, scanned_at, env: dict[str, str], hab_ident: str, pkg_dir: Path
+    cursor, scanned_at, env: dict[str, str], hab_ident: str, pkg_dir: Path,
+    product: str | None = None,
 ) -> None:
     """
     Upsert per-CVE detail rows for a Habitat package scan.
@@ -205,11 +225,11 @@ def insert_habitat_cve_details(
     Globs all Grype scan JSON files under pkg_dir (main package, direct-deps,
     and transitive-deps sub-directories) and inserts one row per unique
     (hab_ident, channel, cve_id, package_name, package_version).
-    dep_layer is derived from the file path.
+    dep_layer is derived from the file path. product defaults to PRODUCT.
     """
     all_json = sorted(
         p for p in pkg_dir.rglob("*.json")
-        if not p.name.endswith(".metadata.json") and p.name != "index.json"
+        if not p.name.endswith((".metadata.json", ".sbom.json")) and p.name != "index.json"
     )
 
     count = 0
@@ -251,7 +271,7 @@ def insert_habitat_cve_details(
                     fix_version   = EXCLUDED.fix_version
                 """,
                 (
-                    env["PRODUCT"],
+                    product or env["PRODUCT"],
                     env["CHANNEL"],
                     hab_ident,
                     cve_id,
@@ -403,11 +423,14 @@ def insert_habitat(cursor, run_id: str, workflow: str, env: dict[str, str]) -> N
 
         # Derive hab_ident from the index.json path if not passed explicitly:
         # out/{origin}/{name}/{version}/index.json → {origin}/{name}
-        if not hab_ident:
+        # (per index: a multi-product run writes one tree per package)
+        index_hab_ident = hab_ident
+        if not index_hab_ident:
             parts = Path(index_path).parts
             # parts[-4] = origin, parts[-3] = name
             if len(parts) >= 4:
-                hab_ident = f"{parts[-4]}/{parts[-3]}"
+                index_hab_ident = f"{parts[-4]}/{parts[-3]}"
+        product = target.get("product") or env["PRODUCT"]
 
         dep_summary   = summary.get("aggregate_severity_counts") or {}
         main_sev      = summary.get("main_severity_counts", {})
@@ -446,7 +469,7 @@ def insert_habitat(cursor, run_id: str, workflow: str, env: dict[str, str]) -> N
                 """,
                 (
                     run_id, scanned_at,
-                    env["PRODUCT"], env["CHANNEL"], hab_ident, resolved_version, resolved_release,
+                    product, env["CHANNEL"], index_hab_ident, resolved_version, resolved_release,
                     deps_scanned, matches_total,
                     sev(main_sev, "Critical"), sev(main_sev, "High"), sev(main_sev, "Medium"),
                     sev(main_sev, "Low"), sev(main_sev, "Negligible"), sev(main_sev, "Unknown"),
@@ -460,14 +483,14 @@ def insert_habitat(cursor, run_id: str, workflow: str, env: dict[str, str]) -> N
             )
             gha_notice(
                 f"insert-scan-results [habitat]: inserted row for "
-                f"{hab_ident}/{env['CHANNEL']} "
+                f"{index_hab_ident}/{env['CHANNEL']} "
                 f"version={resolved_version}/{resolved_release} "
                 f"total={matches_total} deps={deps_scanned}"
             )
 
         # Upsert individual CVE detail rows for this package (snapshot, not append)
         pkg_dir = Path(index_path).parent
-        insert_habitat_cve_details(cursor, scanned_at, env, hab_ident, pkg_dir)
+        insert_habitat_cve_details(cursor, scanned_at, env, index_hab_ident, pkg_dir, product)
 
 
 def insert_container(cursor, run_id: str, workflow: str, env: dict[str, str]) -> None:
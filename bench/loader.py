@@ -0,0 +1,74 @@
+"""
+Import the action scripts for benchmarking without running a scan.
+
+run.py does its work at import time: it reads its inputs, runs a maintenance
+command or a scan, and exits. load_run_py() executes only the part before the
+first command dispatch (helpers, constants and the input/validation block), so
+the returned module has every function and its input globals at their defaults.
+insert.py has a __main__ guard and is imported normally.
+"""
+import ast
+import contextlib
+import importlib.util
+import os
+import re
+import sys
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN_PY = os.path.join(REPO_ROOT, ".github", "actions", "chef-download-grype-snapshot", "run.py")
+INSERT_PY = os.path.join(REPO_ROOT, ".github", "actions", "insert-scan-results", "insert.py")
+
+
+def is_command_dispatch(node):
+    """True for the top-level `if ... sys.argv ...` that starts run.py's commands."""
+    return isinstance(node, ast.If) and "sys.argv" in ast.unparse(node.test)
+
+def load_run_py(path=RUN_PY, env=None):
+    """
+    Load run.py's functions and input globals as a module, without running a scan.
+
+    Args:
+        path: run.py to load
+        env: Extra environment (action inputs, e.g. {"OUTPUT_FORMAT": "compact"}) applied while loading
+
+    Returns:
+        Module object
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source, path)
+    # Every env("NAME") input is cleared while loading, so the caller's environment can't select a mode
+    inputs = tuple(sorted(set(re.findall(r'env\("([A-Z0-9_]+)"', source))))
+    body = []
+    for node in tree.body:
+        if is_command_dispatch(node):
+            break
+        body.append(node)
+    else:
+        raise RuntimeError(f"{path}: command dispatch not found - cannot load it without running a scan")
+
+    module = types.ModuleType("run")
+    module.__file__ = path
+    saved = {k: os.environ.get(k) for k in inputs + tuple(env or ())}
+    try:
+        for k in inputs:
+            os.environ.pop(k, None)
+        os.environ.update(env or {})
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), module.__dict__)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    return module
+
+def load_insert_py(path=INSERT_PY):
+    """Import insert.py (it only runs main() as __main__)."""
+    spec = importlib.util.spec_from_file_location("insert", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["insert"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the scan action's hot paths.
+
+    python bench/run_bench.py [--quick] [--only NAME ...] [--repeat N]
+                              [--output results.json] [--compare bench/baseline.json]
+
+Every input is synthetic (see synth.py) and every network call goes to a local
+stand-in (see standin.py), so no credentials, grype, hab or network are needed;
+curl and bash are. Each case runs --repeat times and reports the fastest and
+median wall time. --compare prints each case against a saved run and exits 1 if
+a median got slower than --tolerance times the saved one.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synth
+from loader import load_insert_py, load_run_py
+from standin import StandIn
+
+CASES = []
+
+def case(name):
+    """Register a case: fn(ctx) returns a list of measurement() dicts."""
+    def register(fn):
+        CASES.append((name, fn))
+        return fn
+    return register
+
+def measurement(params, items, unit, fn, reset=None):
+    """
+    One measured configuration of a case.
+
+    Args:
+        params: Short description of the configuration (part of the result key)
+        items: Units of work per run (for the per-second rate)
+        unit: Name of the unit ("matches", "files", "bytes", ...)
+        fn: The timed call
+        reset: Untimed call before every run (clears caches, removes outputs)
+    """
+    return {"params": params, "items": items, "unit": unit, "fn": fn, "reset": reset}
+
+@contextlib.contextmanager
+def quiet():
+    """Discard stdout (the scripts print progress for every step), including subprocesses'."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+@contextlib.contextmanager
+def no_backoff(module):
+    """Skip a module's retry sleeps, so fault cases measure the retries rather than the backoff."""
+    real = module.time
+    module.time = types.SimpleNamespace(**{k: getattr(real, k) for k in dir(real) if not k.startswith("__")})
+    module.time.sleep = lambda seconds: None
+    try:
+        yield
+    finally:
+        module.time = real
+
+STANDIN_GRYPE = """#!/bin/sh
+# Stand-in grype: wait out the DB load, then print the pre-generated report for the source ($1)
+sleep "$BENCH_GRYPE_STARTUP"
+exec cat "$BENCH_GRYPE_REPORTS/$(printf %s "$1" | tr '/:\\\\' '___').json"
+"""
+
+@contextlib.contextmanager
+def standin_grype(ctx, reports_dir, startup):
+    """
+    Put a stand-in grype (printing reports from synth.write_habitat_scan_reports()) first
+    on the PATH of run.py's `bash -lc` commands. The login profile resets PATH, so HOME
+    points at a directory whose .bash_profile prepends the stand-in's bin directory.
+    """
+    home, bin_dir = os.path.join(ctx.tmp, "grype-home"), os.path.join(ctx.tmp, "grype-bin")
+    if not os.path.isdir(bin_dir):
+        os.makedirs(home)
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "grype"), "w", encoding="utf-8") as f:
+            f.write(STANDIN_GRYPE)
+        os.chmod(os.path.join(bin_dir, "grype"), 0o755)
+        with open(os.path.join(home, ".bash_profile"), "w", encoding="utf-8") as f:
+            f.write(f'PATH="{bin_dir}:$PATH"\n')
+    saved = {k: os.environ.get(k) for k in ("HOME", "BENCH_GRYPE_REPORTS", "BENCH_GRYPE_STARTUP")}
+    os.environ.update(HOME=home, BENCH_GRYPE_REPORTS=reports_dir, BENCH_GRYPE_STARTUP=str(startup))
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+class CountingCursor:
+    """DB cursor stand-in for insert.py: counts statements instead of sending them."""
+
+    def __init__(self):
+        self.rows = 0
+
+    def execute(self, sql, params=None):
+        self.rows += 1
+
+def report_sizes(quick):
+    return (1_000, 10_000) if quick else (1_000, 10_000, 50_000, 200_000)
+
+@case("count_severities")
+def bench_count_severities(ctx):
+    cases = []
+    for n in report_sizes(ctx.quick):
+        matches = synth.grype_report(n)["matches"]
+        cases.append(measurement(f"{n} matches", n, "matches", lambda m=matches: ctx.run.count_severities(m)))
+    return cases
+
+@case("stream_grype_report")
+def bench_stream_grype_report(ctx):
+    cases = []
+    out_path = os.path.join(ctx.tmp, "stream-out.json")
+    for n in report_sizes(ctx.quick):
+        src = synth.write_grype_report(os.path.join(ctx.tmp, "reports", f"grype-{n}.json"), n)
+
+        def stream(src=src):
+            with open(src, "r", encoding="utf-8") as f:
+                ctx.run.stream_grype_report(f, out_path, fmt="pretty")
+
+        def load_and_write(src=src):
+            with open(src, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+            ctx.run.count_severities(doc["matches"])
+            ctx.run.write_json(doc, out_path, "pretty")
+
+        cases.append(measurement(f"{n} matches", n, "matches", stream))
+        cases.append(measurement(f"{n} matches, json.load + write_json", n, "matches", load_and_write))
+    return cases
+
+@case("insert.native_cve_details")
+def bench_insert_native(ctx):
+    cases = []
+    env = {"SCAN_MODE": "native", "PRODUCT": "chef", "CHANNEL": "stable", "DOWNLOAD_SITE": "commercial"}
+    for n in report_sizes(ctx.quick):
+        out_dir = os.path.join(ctx.tmp, f"insert-native-{n}")
+        synth.write_grype_report(os.path.join(out_dir, "scanners", "grype.latest.json"), n, indent=2)
+
+        def insert(out_dir=out_dir):
+            ctx.insert.insert_native_cve_details(CountingCursor(), datetime.now(timezone.utc), dict(env, OUT_DIR=out_dir))
+
+        cases.append(measurement(f"{n} matches", n, "matches", insert))
+    return cases
+
+@case("insert.habitat_cve_details")
+def bench_insert_habitat(ctx):
+    deps, per_file = (10, 200) if ctx.quick else (60, 200)
+    pkg_dir = os.path.join(ctx.tmp, "insert-habitat", "core", "bench", "1.0.0", "20240101120000")
+    total = synth.make_habitat_scan_tree(pkg_dir, deps, per_file)
+    env = {"PRODUCT": "bench", "CHANNEL": "stable", "HAB_CHANNEL": "stable"}
+
+    def insert():
+        ctx.insert.insert_habitat_cve_details(CountingCursor(), datetime.now(timezone.utc), env,
+                                              "core/bench/1.0.0/20240101120000", Path(pkg_dir))
+
+    return [measurement(f"{deps + 1} reports x {per_file} matches", total, "matches", insert)]
+
+@case("get_directory_size")
+def bench_get_directory_size(ctx):
+    packages, files = (40, 50) if ctx.quick else (200, 100)
+    root = os.path.join(ctx.tmp, "hab", "pkgs")
+    _, total_bytes, total_files = synth.make_hab_pkgs(root, packages, files)
+    def walk_lstat():
+        # The walker get_directory_size() replaced: os.walk + os.lstat per file
+        size = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+        if size != total_bytes:
+            raise RuntimeError(f"os.walk: {size} bytes, expected {total_bytes}")
+
+    cases = [measurement(f"{total_files} files, os.walk + lstat", total_files, "files", walk_lstat)]
+    for workers in (1, 8):
+        def size(workers=workers):
+            result = ctx.run.get_directory_size(root, workers=workers)
+            if result["bytes"] != total_bytes:
+                raise RuntimeError(f"get_directory_size: {result['bytes']} bytes, expected {total_bytes}")
+        cases.append(measurement(f"{total_files} files, {workers} workers", total_files, "files", size))
+    return cases
+
+@case("prune_lru_cache")
+def bench_prune_lru_cache(ctx):
+    entries = 300 if ctx.quick else 2000
+    cache_root = os.path.join(ctx.tmp, "lru-cache")
+    synth.make_lru_cache(cache_root, entries)
+
+    def prune():
+        if ctx.run.prune_lru_cache(cache_root, 1 << 40):
+            raise RuntimeError("prune_lru_cache: evicted entries from a cache under its limit")
+
+    def per_entry_pool():
+        # What the prune walk cost with a get_directory_size() thread pool per entry
+        for shard in os.listdir(cache_root):
+            for key in os.listdir(os.path.join(cache_root, shard)):
+                ctx.run.get_directory_size(os.path.join(cache_root, shard, key))
+
+    return [
+        measurement(f"{entries} entries, under the limit", entries, "entries", prune),
+        measurement(f"{entries} entries, get_directory_size per entry", entries, "entries", per_entry_pool),
+    ]
+
+@case("habitat_scan_strategy")
+def bench_habitat_scan_strategy(ctx):
+    idents_count, matches_per_ident = (20, 50) if ctx.quick else (80, 200)
+    workers, startup = 4, 0.3
+    idents = [f"core/bench{i}/1.{i % 10}.{i % 7}/2024{i % 12 + 1:02d}01120000" for i in range(idents_count)]
+    reports_dir = os.path.join(ctx.tmp, "grype-reports")
+    total = synth.write_habitat_scan_reports(reports_dir, idents, matches_per_ident)
+    staging_dir = os.path.join(ctx.tmp, "habitat-scans")
+
+    def reset():
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def check(results):
+        matches = sum(r["matches_total"] for r in results.values())
+        if matches != total:
+            raise RuntimeError(f"habitat scan: {matches} matches, expected {total}")
+
+    def per_dep(startup):
+        def scan():
+            # As run.py scans a closure with HAB_SCAN_STRATEGY=per-dep: one grype run per ident
+            with standin_grype(ctx, reports_dir, startup), ThreadPoolExecutor(max_workers=workers) as pool:
+                check(dict(zip(idents, pool.map(lambda i: ctx.run.scan_habitat_ident(i, "linux", staging_dir), idents))))
+        return scan
+
+    def single_pass(startup):
+        def scan():
+            with standin_grype(ctx, reports_dir, startup):
+                check(ctx.run.scan_habitat_single_pass(idents, "linux", staging_dir, workers))
+        return scan
+
+    params = f"{idents_count} idents x {matches_per_ident} matches"
+    return [
+        measurement(f"per-dep, {params}, 0 s startup", total, "matches", per_dep(0), reset),
+        measurement(f"single-pass, {params}, 0 s startup", total, "matches", single_pass(0), reset),
+        measurement(f"per-dep, {params}, {startup} s startup", total, "matches", per_dep(startup), reset),
+        measurement(f"single-pass, {params}, {startup} s startup", total, "matches", single_pass(startup), reset),
+    ]
+
+@case("check_existing_version")
+def bench_check_existing_version(ctx):
+    products, hab_packages, hab_versions = (10, 10, 20) if ctx.quick else (40, 40, 50)
+    repo = os.path.join(ctx.tmp, "data-repo")
+    lookups = synth.make_data_repo(repo, products, hab_packages, hab_versions)
+
+    def native():
+        for (product, channel, site, os_name, os_ver, arch), version in lookups["native"]:
+            skip, _ = ctx.run.check_existing_version("native", repo, product, channel, site, os_name, os_ver, arch, resolved_version=version)
+            if not skip:
+                raise RuntimeError(f"check_existing_version: {product} {version} not found")
+
+    def habitat():
+        for hab_ident, ident in lookups["habitat"]:
+            ctx.run.check_existing_version("habitat", repo, "bench", "stable", "", "linux", "", "x86_64", resolved_version=ident, hab_ident=hab_ident)
+
+    def rebuild_ident_indexes():
+        ctx.run.rebuild_habitat_ident_indexes(repo)
+
+    n_native, n_habitat = len(lookups["native"]), len(lookups["habitat"])
+    history = f"{hab_packages} packages x {hab_versions} versions"
+    return [
+        measurement(f"native, {n_native} metadata.json", n_native, "lookups", native),
+        measurement(f"habitat, {history}, no ident-index", n_habitat, "lookups", habitat),
+        # Runs after the case above: builds the ident indexes the next one uses
+        measurement(f"rebuild-ident-index, {history}", hab_packages * hab_versions, "index.json", rebuild_ident_indexes),
+        measurement(f"habitat, {history}, ident-index", n_habitat, "lookups", habitat),
+    ]
+
+@case("download")
+def bench_download(ctx):
+    size = (16 if ctx.quick else 32) << 20
+    segments = min(4, size // ctx.run.DOWNLOAD_MIN_SEGMENT_BYTES)
+    standin = ctx.standin(size)
+    url = f"{ctx.base_url}/stable/chef/download?v=19.2.12&license_id=bench"
+    out_path = os.path.join(ctx.tmp, "download.pkg")
+
+    def reset(drops=0, errors=0, rate=0):
+        def apply():
+            for path in (out_path, out_path + ".part"):
+                if os.path.exists(path):
+                    os.remove(path)
+            standin.drops, standin.drop_after, standin.errors, standin.error_status = drops, size // 3, errors, 503
+            standin.rate, standin.latency = rate, 0.0
+        return apply
+
+    def check(stats):
+        if not stats or stats["bytes"] != size or os.path.getsize(out_path) != size:
+            raise RuntimeError(f"download: got {stats and stats['bytes']} bytes, expected {size}")
+
+    def single():
+        check(ctx.run.download_with_fallback(url, out_path))
+
+    def single_with_faults():
+        with no_backoff(ctx.run):
+            check(ctx.run.download_with_fallback(url, out_path))
+
+    def segmented():
+        with no_backoff(ctx.run):
+            check(ctx.run.download_segmented(url, out_path, segments))
+
+    rate = 16 << 20
+    return [
+        measurement("curl, clean", size, "bytes", single, reset()),
+        measurement("curl, 2 mid-stream drops (no backoff)", size, "bytes", single_with_faults, reset(drops=2)),
+        measurement("curl, HTTP 503 then ok (no backoff)", size, "bytes", single_with_faults, reset(errors=1)),
+        measurement("curl, 16 MiB/s per connection", size, "bytes", single, reset(rate=rate)),
+        measurement(f"{segments} segments, 16 MiB/s per connection", size, "bytes", segmented, reset(rate=rate)),
+    ]
+
+@case("resolve_native_version")
+def bench_resolve_native_version(ctx):
+    standin = ctx.standin()
+    latency = 0.05
+
+    def reset():
+        ctx.run.version_response_memo.clear()
+        ctx.run.version_memo_locks.clear()
+        ctx.run.stable_version_indexes.clear()
+        standin.latency = latency
+
+    def resolve(channel):
+        def call():
+            version = ctx.run.resolve_native_version(ctx.base_url, "chef", "chef", channel, "commercial", "bench")
+            if not version.startswith("19."):
+                raise RuntimeError(f"resolve_native_version: unexpected {version}")
+        return call
+
+    return [
+        measurement(f"current, {int(latency * 1000)} ms latency", 1, "lookups", resolve("current"), reset),
+        measurement(f"stable (major matching), {int(latency * 1000)} ms latency", 1, "lookups", resolve("stable"), reset),
+    ]
+
+@case("shell_startup")
+def bench_shell_startup(ctx):
+    # download_with_fallback() pays this once per curl attempt; it depends on the login profile
+    def start():
+        subprocess.run(["bash", "-lc", "true"], check=True, capture_output=True)
+    return [measurement("bash -lc true", 1, "runs", start)]
+
+def run_case(ctx, name, m, repeat):
+    times = []
+    for _ in range(repeat):
+        if m["reset"]:
+            m["reset"]()
+        with quiet():
+            started = time.perf_counter()
+            m["fn"]()
+            times.append(time.perf_counter() - started)
+        ctx.run.timing_spans.clear()
+    median = statistics.median(times)
+    return {
+        "name": name,
+        "params": m["params"],
+        "items": m["items"],
+        "unit": m["unit"],
+        "min_s": round(min(times), 6),
+        "median_s": round(median, 6),
+        "per_s": round(m["items"] / median, 1) if median else None,
+    }
+
+def result_key(result):
+    return f"{result['name']}[{result['params']}]"
+
+def format_rate(result):
+    if result["unit"] == "bytes":
+        return f"{result['per_s'] / (1 << 20):,.1f} MiB/s"
+    return f"{result['per_s']:,.0f} {result['unit']}/s"
+
+def print_result(result, baseline=None, tolerance=None):
+    line = f"{result_key(result):<78} {result['min_s']:>9.4f}s {result['median_s']:>9.4f}s  {format_rate(result):>22}"
+    slower = False
+    if baseline:
+        ratio = result["median_s"] / baseline["median_s"] if baseline["median_s"] else 1.0
+        slower = ratio > tolerance
+        line += f"  x{ratio:.2f}" + (" SLOWER" if slower else "")
+    print(line, flush=True)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller inputs (seconds instead of minutes)")
+    parser.add_argument("--only", nargs="+", default=[], metavar="NAME", help="Run cases whose name contains NAME")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (default 3)")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Median ratio counted as a regression (default 1.25)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    tmp = tempfile.mkdtemp(prefix="scan-bench-")
+    standins = []
+
+    def standin(payload_bytes=1 << 20):
+        s = StandIn(payload_bytes)
+        ctx.base_url = s.start()
+        standins.append(s)
+        return s
+
+    ctx = types.SimpleNamespace(tmp=tmp, quick=args.quick, standin=standin, base_url=None,
+                                run=load_run_py(), insert=load_insert_py())
+    results, regressions = [], []
+    print(f"{'case':<78} {'min':>10} {'median':>10}  {'rate':>22}")
+    try:
+        for name, build in CASES:
+            if args.only and not any(o in name for o in args.only):
+                continue
+            for m in build(ctx):
+                result = run_case(ctx, name, m, args.repeat)
+                results.append(result)
+                if print_result(result, baseline.get(result_key(result)), args.tolerance):
+                    regressions.append(result_key(result))
+    finally:
+        for s in standins:
+            s.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.output:
+        meta = {
+            "recorded": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": args.quick,
+            "repeat": args.repeat,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"Wrote {len(results)} results to {args.output}")
+    if regressions:
+        print(f"{len(regressions)} cases slower than {args.tolerance}x {args.compare}: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Local HTTP stand-in for the Chef download and version APIs.
+
+Serves, for any {channel}/{product} prefix:
+    GET /{channel}/{product}/versions/latest  - JSON string (current or stable latest)
+    GET /{channel}/{product}/versions/all     - JSON list of versions
+    GET/HEAD /{channel}/{product}/download    - the payload, with ETag and Range/If-Range support
+
+Latency, bandwidth and faults are attributes of the StandIn and can be changed between runs.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+class StandIn:
+    """
+    A threaded local server; start() returns its base URL.
+
+    Attributes:
+        latency: Seconds to wait before every response
+        rate: Payload bytes per second per connection (0: unlimited)
+        errors: Number of upcoming download requests answered with error_status
+        error_status: Status code for those (default 500)
+        drops: Number of upcoming download responses cut off after drop_after bytes
+        drop_after: Bytes sent before a dropped response closes the connection
+        current_versions / stable_versions: What the version endpoints return
+        requests: Count of requests served, by endpoint ("latest", "all", "download", "head")
+    """
+
+    def __init__(self, payload_bytes=8 << 20, seed=0):
+        self.payload = random.Random(seed).randbytes(payload_bytes)
+        self.etag = f'"bench-{seed}-{payload_bytes}"'
+        self.latency = 0.0
+        self.rate = 0
+        self.errors = 0
+        self.error_status = 500
+        self.drops = 0
+        self.drop_after = 0
+        self.current_versions = ["19.0.3", "19.1.7", "19.2.12"]
+        self.stable_versions = [f"{major}.{minor}.{patch}" for major in (17, 18, 19) for minor in range(12) for patch in (1, 9, 27)]
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """Start serving on 127.0.0.1 (ephemeral port); returns the base URL."""
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # Headers and body are separate writes: avoid delayed-ACK stalls on keep-alive
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                standin.handle(self, head=True)
+
+            def do_GET(self):
+                standin.handle(self, head=False)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def take(self, counter):
+        """Decrement a fault counter; True if a fault should be injected."""
+        with self.lock:
+            if getattr(self, counter) > 0:
+                setattr(self, counter, getattr(self, counter) - 1)
+                return True
+        return False
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def handle(self, req, head):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlparse(req.path).path.strip("/").split("/")
+        if len(parts) == 4 and parts[2] == "versions" and parts[3] in ("latest", "all"):
+            self.count(parts[3])
+            versions = self.current_versions if parts[0] == "current" else self.stable_versions
+            self.send(req, 200, json.dumps(versions[-1] if parts[3] == "latest" else versions).encode(), head=head,
+                      headers={"Content-Type": "application/json"})
+        elif len(parts) == 3 and parts[2] == "download":
+            self.count("head" if head else "download")
+            self.download(req, head)
+        else:
+            self.send(req, 404, b"not found", head=head)
+
+    def download(self, req, head):
+        if not head and self.take("errors"):
+            self.send(req, self.error_status, b"injected error")
+            return
+        size = len(self.payload)
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", req.headers.get("Range", ""))
+        if match and req.headers.get("If-Range", self.etag) == self.etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send(req, 416, b"", headers={"Content-Range": f"bytes */{size}"}, head=head)
+                return
+            status = 206
+        headers = {"ETag": self.etag, "Accept-Ranges": "bytes", "Content-Type": "application/octet-stream"}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        body = memoryview(self.payload)[start:end + 1]
+        cut = self.drop_after if not head and self.take("drops") else None
+        self.send(req, status, body, headers=headers, head=head, cut=cut)
+
+    def send(self, req, status, body, headers=None, head=False, cut=None):
+        """Send a response, paced at self.rate; cut=N closes the connection after N body bytes."""
+        req.send_response(status)
+        for k, v in (headers or {}).items():
+            req.send_header(k, v)
+        req.send_header("Content-Length", str(len(body)))
+        if cut is not None:
+            req.send_header("Connection", "close")
+        req.end_headers()
+        if head:
+            return
+        limit = len(body) if cut is None else min(cut, len(body))
+        chunk = 1 << 16
+        started = time.monotonic()
+        try:
+            for offset in range(0, limit, chunk):
+                req.wfile.write(body[offset:min(offset + chunk, limit)])
+                if self.rate:
+                    ahead = (offset + chunk) / self.rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            req.close_connection = True
+            return
+        if cut is not None:
+            req.wfile.flush()
+            req.close_connection = True
@@ -0,0 +1,223 @@
+"""
+Synthetic inputs for the benchmarks: grype reports, /hab/pkgs trees and data repos.
+
+Everything is generated from a seed, so a given size always produces the same files.
+"""
+import json
+import os
+import random
+
+SEVERITIES = ("Critical", "High", "Medium", "Low", "Negligible", "Unknown")
+SEVERITY_WEIGHTS = (2, 10, 30, 30, 18, 10)
+ARTIFACT_TYPES = ("deb", "gem", "go-module", "java-archive", "python", "npm", "binary")
+
+def grype_match(rng, i):
+    """One grype match in the shape `grype -o json` prints (the fields readers use, plus bulk)."""
+    vuln_id = f"CVE-{rng.randint(2015, 2026)}-{rng.randint(1000, 99999)}" if rng.random() < 0.9 else f"GHSA-{i:04x}-{rng.randint(0, 0xffff):04x}-bench"
+    severity = rng.choices(SEVERITIES, SEVERITY_WEIGHTS)[0]
+    artifact_type = rng.choice(ARTIFACT_TYPES)
+    name = f"pkg-{rng.randint(0, 4000)}"
+    version = f"{rng.randint(0, 9)}.{rng.randint(0, 30)}.{rng.randint(0, 99)}"
+    fixed = rng.random() < 0.6
+    return {
+        "vulnerability": {
+            "id": vuln_id,
+            "dataSource": f"https://nvd.nist.gov/vuln/detail/{vuln_id}",
+            "namespace": "nvd:cpe",
+            "severity": severity,
+            "urls": [f"https://example.invalid/advisories/{vuln_id}"],
+            "description": "Synthetic vulnerability used to benchmark report handling. " * 2,
+            "cvss": [{"version": "3.1", "vector": "CVSS:3.1/AV:N/AC:L/PR:N/UI:N/S:U/C:H/I:H/A:H",
+                      "metrics": {"baseScore": round(rng.uniform(0, 10), 1), "exploitabilityScore": 3.9, "impactScore": 5.9}}],
+            "fix": {"versions": [f"{version}.1"] if fixed else [], "state": "fixed" if fixed else "not-fixed"},
+            "advisories": []
+        },
+        "relatedVulnerabilities": [],
+        "matchDetails": [{"type": "cpe-match", "matcher": f"{artifact_type}-matcher",
+                          "searchedBy": {"cpes": [f"cpe:2.3:a:{name}:{name}:{version}:*:*:*:*:*:*:*"]},
+                          "found": {"vulnerabilityID": vuln_id, "versionConstraint": f"< {version}.1 (unknown)"}}],
+        "artifact": {
+            "id": f"{i:016x}",
+            "name": name,
+            "version": version,
+            "type": artifact_type,
+            "locations": [{"path": f"/opt/bench/embedded/lib/{name}-{version}/{name}.so", "layerID": ""}],
+            "language": "",
+            "licenses": ["MIT"],
+            "cpes": [f"cpe:2.3:a:{name}:{name}:{version}:*:*:*:*:*:*:*"],
+            "purl": f"pkg:generic/{name}@{version}",
+            "upstreams": []
+        }
+    }
+
+def grype_report(matches, seed=0, name="bench"):
+    """A grype report dict with the given number of matches."""
+    rng = random.Random(seed)
+    return {
+        "matches": [grype_match(rng, i) for i in range(matches)],
+        "ignoredMatches": [],
+        "source": {"type": "directory", "target": f"/tmp/{name}"},
+        "distro": {"name": "", "version": "", "idLike": None},
+        "descriptor": {"name": "grype", "version": "0.109.0", "db": {"built": "2026-01-01T00:00:00Z"}}
+    }
+
+def write_grype_report(path, matches, seed=0, indent=None):
+    """Write a synthetic report: compact like grype's stdout (indent=None) or pretty (indent=2)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(grype_report(matches, seed), f, indent=indent)
+    return path
+
+def make_hab_pkgs(root, packages, files_per_package, seed=0):
+    """
+    Create a /hab/pkgs-shaped tree: {origin}/{name}/{version}/{release}/ with bin/, lib/ and
+    share/ files (sparse, 0-64 KiB each) plus IDENT, DEPS and TDEPS.
+
+    Returns:
+        (idents, total_bytes, total_files)
+    """
+    rng = random.Random(seed)
+    idents = [f"core/bench{i}/1.{i % 10}.{i % 7}/2024{i % 12 + 1:02d}01120000" for i in range(packages)]
+    total_bytes = total_files = 0
+    for n, ident in enumerate(idents):
+        pkg_dir = os.path.join(root, *ident.split("/"))
+        deps = rng.sample(idents, min(len(idents) - 1, 5)) if len(idents) > 1 else []
+        deps = [d for d in deps if d != ident]
+        meta = {"IDENT": ident + "\n", "DEPS": "\n".join(deps) + "\n", "TDEPS": "\n".join(deps) + "\n"}
+        os.makedirs(pkg_dir, exist_ok=True)
+        for fname, text in meta.items():
+            with open(os.path.join(pkg_dir, fname), "w", encoding="utf-8") as f:
+                f.write(text)
+            total_bytes += len(text.encode())
+            total_files += 1
+        for k in range(files_per_package):
+            sub = ("bin", "lib", "lib/engines", "share/doc", "share/man/man1")[k % 5]
+            d = os.path.join(pkg_dir, sub)
+            os.makedirs(d, exist_ok=True)
+            size = rng.randint(0, 64 * 1024)
+            with open(os.path.join(d, f"f{k}"), "wb") as f:
+                f.truncate(size)
+            total_bytes += size
+            total_files += 1
+    return idents, total_bytes, total_files
+
+def write_habitat_scan_reports(reports_dir, idents, matches_per_ident, pkgs_root="/hab/pkgs", seed=0):
+    """
+    Write the reports a stand-in grype prints for habitat scans, one file per source
+    (see habitat_report_path()): a per-dep report for each dir:{pkgs_root}/{ident} with
+    locations relative to the package, and the single-pass report for dir:{pkgs_root}
+    with the same matches at absolute locations.
+
+    Returns:
+        Total number of matches
+    """
+    closure = grype_report(0, name="habitat-closure")
+    for n, ident in enumerate(idents):
+        report = grype_report(matches_per_ident, seed=seed + n, name=ident)
+        with open(habitat_report_path(reports_dir, f"dir:{pkgs_root}/{ident}"), "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        for m in report["matches"]:
+            locations = [dict(loc, path=f"{pkgs_root}/{ident}{loc['path']}") for loc in m["artifact"]["locations"]]
+            closure["matches"].append(dict(m, artifact=dict(m["artifact"], locations=locations)))
+    with open(habitat_report_path(reports_dir, f"dir:{pkgs_root}"), "w", encoding="utf-8") as f:
+        json.dump(closure, f)
+    return len(closure["matches"])
+
+def habitat_report_path(reports_dir, source):
+    """Report file for a grype source: the source with '/', ':' and '\\' replaced by '_'."""
+    os.makedirs(reports_dir, exist_ok=True)
+    return os.path.join(reports_dir, source.translate(str.maketrans("/:\\", "___")) + ".json")
+
+def make_lru_cache(root, entries, seed=0):
+    """
+    Create an LRU cache directory as store_cache_entry() lays it out: {key[:2]}/{key}/ with
+    an entry.json and a few small files per entry.
+    """
+    rng = random.Random(seed)
+    for i in range(entries):
+        key = f"{rng.getrandbits(64):016x}"
+        entry_dir = os.path.join(root, key[:2], key)
+        os.makedirs(entry_dir, exist_ok=True)
+        with open(os.path.join(entry_dir, "entry.json"), "w", encoding="utf-8") as f:
+            json.dump({"key": key}, f)
+        for name in ("grype.json", "syft.sbom.json", "metadata.json"):
+            with open(os.path.join(entry_dir, name), "wb") as f:
+                f.truncate(rng.randint(0, 16 * 1024))
+
+def make_habitat_scan_tree(pkg_dir, deps, matches_per_file, seed=0):
+    """
+    Create one package's published habitat tree (as write_habitat_index() lays it out):
+    the main report plus direct-deps/ and transitive-deps/ reports with .metadata.json files.
+
+    Returns:
+        Total number of matches written
+    """
+    total = 0
+    paths = [os.path.join(pkg_dir, "20240101120000.json")]
+    for i in range(deps):
+        layer = "direct-deps" if i % 4 == 0 else "transitive-deps"
+        paths.append(os.path.join(pkg_dir, layer, "core", f"dep{i}", "1.0", f"2024010{i % 9 + 1}120000.json"))
+    for i, path in enumerate(paths):
+        write_grype_report(path, matches_per_file, seed=seed + i, indent=2)
+        with open(path[:-len(".json")] + ".metadata.json", "w", encoding="utf-8") as f:
+            json.dump({"summary": {"matches_total": matches_per_file}}, f)
+        total += matches_per_file
+    return total
+
+def habitat_history_ident(name, v):
+    """Ident of the v-th published version of chef/{name} in make_data_repo()."""
+    return f"chef/{name}/{v // 10}.{v % 10}.0/2025{v % 12 + 1:02d}01000000"
+
+def make_data_repo(root, native_products, habitat_packages, habitat_versions, deps_per_index=40, seed=0):
+    """
+    Create a data repo with native metadata.json files and habitat {version}/index.json history.
+
+    Native: native/{product}/{channel}/{site}/ubuntu/{os_ver}/{arch}/metadata.json for every
+    combination of 2 channels, 2 sites, 3 OS versions and 2 arches (24 files per product).
+    Habitat: habitat/bench/stable/linux/x86_64/chef/{name}/{version}/index.json, habitat_versions
+    historical versions per package.
+
+    Returns:
+        Dict with "native" lookups (target tuples and their version) and "habitat" lookups
+        ((hab_ident, ident) pairs, half of them hits of older versions, half misses)
+    """
+    rng = random.Random(seed)
+    native = []
+    for p in range(native_products):
+        product = f"product{p}"
+        for channel in ("stable", "current"):
+            for site in ("commercial", "community"):
+                for os_ver in ("20.04", "22.04", "24.04"):
+                    for arch in ("x86_64", "aarch64"):
+                        version = f"{rng.randint(15, 19)}.{rng.randint(0, 20)}.{rng.randint(0, 99)}"
+                        target_dir = os.path.join(root, "native", product, channel, site, "ubuntu", os_ver, arch)
+                        os.makedirs(target_dir, exist_ok=True)
+                        with open(os.path.join(target_dir, "metadata.json"), "w", encoding="utf-8") as f:
+                            json.dump({"schema_version": "1.0", "snapshot": {"timestamp_utc": "2026-01-01T00:00:00Z"},
+                                       "target": {"product": product, "channel": channel, "resolved_version": version},
+                                       "summary": {"matches_total": rng.randint(0, 500)}}, f, indent=2)
+                        native.append(((product, channel, site, "ubuntu", os_ver, arch), version))
+
+    habitat = []
+    for p in range(habitat_packages):
+        name = f"hpkg{p}"
+        for v in range(habitat_versions):
+            ident = habitat_history_ident(name, v)
+            version_dir = os.path.join(root, "habitat", "bench", "stable", "linux", "x86_64", "chef", name, f"{v // 10}.{v % 10}.0")
+            os.makedirs(version_dir, exist_ok=True)
+            index = {
+                "schema_version": "1.0",
+                "snapshot": {"timestamp_utc": f"2025-{v % 12 + 1:02d}-01T00:00:00Z"},
+                "target": {"product": "bench", "channel": "stable",
+                           "package": {"ident": ident, "origin": "chef", "name": name}},
+                "scan": {"mode": "habitat", "grype": {"version": "0.109.0", "db": {"checksum": "sha256:bench"}}},
+                "summary": {"total_matches": rng.randint(0, 900), "dependencies_scanned": deps_per_index},
+                "dependencies": [{"ident": f"core/dep{d}/1.0/20240101000000", "type": "transitive",
+                                  "json_path": f"transitive-deps/core/dep{d}/1.0/20240101000000.json",
+                                  "size": {"installed_bytes": rng.randint(0, 1 << 24)}} for d in range(deps_per_index)]
+            }
+            with open(os.path.join(version_dir, "index.json"), "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=2)
+        habitat.append((f"chef/{name}", habitat_history_ident(name, habitat_versions // 2)))
+        habitat.append((f"chef/{name}", f"chef/{name}/99.0.0/20990101000000"))
+    return {"native": native, "habitat": habitat}